@@ -1,4 +1,5 @@
 import argparse
+import time
 import torch
 import os
 import json
@@ -32,12 +33,15 @@ def eval_model(args):
     model_path = os.path.expanduser(args.model_path)
     model_name = get_model_name_from_path(model_path)
     tokenizer, model, image_processor, context_len = load_pretrained_model(model_path, args.model_base, model_name)
+    if args.token_reduction is not None:
+        model.config.mm_token_reduction = args.token_reduction
 
     questions = [json.loads(q) for q in open(os.path.expanduser(args.question_file), "r")]
     questions = get_chunk(questions, args.num_chunks, args.chunk_idx)
     answers_file = os.path.expanduser(args.answers_file)
     os.makedirs(os.path.dirname(answers_file), exist_ok=True)
     ans_file = open(answers_file, "w")
+    start_time = time.time()
     for line in tqdm(questions):
         idx = line["question_id"]
         image_file = line["image"]
@@ -83,6 +87,14 @@ def eval_model(args):
         ans_file.flush()
     ans_file.close()
 
+    elapsed = time.time() - start_time
+    print(f"Evaluated {len(questions)} questions in {elapsed:.1f}s: {len(questions) / elapsed:.2f} questions/s")
+    stats = model.get_model().token_reduction_stats
+    if stats["images"] > 0:
+        print(f"Token reduction {model.config.mm_token_reduction}: {stats['tokens'] / stats['images']:.0f} -> "
+              f"{stats['reduced_tokens'] / stats['images']:.0f} image tokens per image "
+              f"({stats['reduced_tokens'] / stats['tokens']:.1%})")
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--model-path", type=str, default="facebook/opt-350m")
@@ -96,6 +108,8 @@ def eval_model(args):
     parser.add_argument("--temperature", type=float, default=0.2)
     parser.add_argument("--top_p", type=float, default=None)
     parser.add_argument("--num_beams", type=int, default=1)
+    parser.add_argument("--token-reduction", type=str, default=None,
+        help="Overrides mm_token_reduction of the model config, e.g. pool2, tome0.5, prune0.25 or none.")
     args = parser.parse_args()
 
     eval_model(args)
@@ -1,4 +1,6 @@
 import argparse
+import functools
+import time
 import torch
 import os
 import json
@@ -9,7 +11,7 @@
 from llava.conversation import conv_templates, SeparatorStyle
 from llava.model.builder import load_pretrained_model
 from llava.utils import disable_torch_init
-from llava.mm_utils import tokenizer_image_token, process_images, get_model_name_from_path
+from llava.mm_utils import tokenizer_image_token, process_images, get_model_name_from_path, KeywordsStoppingCriteria
 from torch.utils.data import Dataset, DataLoader
 
 from PIL import Image
@@ -61,27 +63,52 @@ def __len__(self):
         return len(self.questions)
 
 
-def collate_fn(batch):
+def collate_fn(batch, pad_token_id=0):
     input_ids, image_tensors, image_sizes = zip(*batch)
-    input_ids = torch.stack(input_ids, dim=0)
-    image_tensors = torch.stack(image_tensors, dim=0)
-    return input_ids, image_tensors, image_sizes
+    # prompts are left-padded, so that generation continues from the last position of every row
+    max_len = max(x.shape[0] for x in input_ids)
+    attention_mask = torch.stack([
+        torch.arange(max_len) >= max_len - x.shape[0] for x in input_ids
+    ], dim=0)
+    input_ids = torch.stack([
+        torch.cat((x.new_full((max_len - x.shape[0],), pad_token_id), x)) for x in input_ids
+    ], dim=0)
+    if all(x.shape == image_tensors[0].shape for x in image_tensors):
+        image_tensors = torch.stack(image_tensors, dim=0)
+    else:
+        # anyres images have a different number of patches
+        image_tensors = list(image_tensors)
+    return input_ids, attention_mask, image_tensors, image_sizes
 
 
 # DataLoader
 def create_data_loader(questions, image_folder, tokenizer, image_processor, model_config, batch_size=1, num_workers=4):
-    assert batch_size == 1, "batch_size must be 1"
     dataset = CustomDataset(questions, image_folder, tokenizer, image_processor, model_config)
-    data_loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False, collate_fn=collate_fn)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.unk_token_id
+    data_loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False,
+                             collate_fn=functools.partial(collate_fn, pad_token_id=pad_token_id or 0))
     return data_loader
 
 
+def num_generated_tokens(output_ids, eos_token_id):
+    """Number of generated tokens of every row, up to and including the first EOS."""
+    counts = []
+    for ids in output_ids:
+        ids = ids.tolist()
+        counts.append(ids.index(eos_token_id) + 1 if eos_token_id in ids else len(ids))
+    return counts
+
+
 def eval_model(args):
     # Model
     disable_torch_init()
     model_path = os.path.expanduser(args.model_path)
     model_name = get_model_name_from_path(model_path)
     tokenizer, model, image_processor, context_len = load_pretrained_model(model_path, args.model_base, model_name)
+    if args.image_feature_cache_dir is not None:
+        model.get_model().enable_image_feature_cache(max_entries=0, disk_dir=args.image_feature_cache_dir)
+    if args.token_reduction is not None:
+        model.config.mm_token_reduction = args.token_reduction
 
     questions = [json.loads(q) for q in open(os.path.expanduser(args.question_file), "r")]
     questions = get_chunk(questions, args.num_chunks, args.chunk_idx)
@@ -93,38 +120,74 @@ def eval_model(args):
         args.conv_mode = args.conv_mode + '_mmtag'
         print(f'It seems that this is a plain model, but it is not using a mmtag prompt, auto switching to {args.conv_mode}.')
 
-    data_loader = create_data_loader(questions, args.image_folder, tokenizer, image_processor, model.config)
-
-    for (input_ids, image_tensor, image_sizes), line in tqdm(zip(data_loader, questions), total=len(questions)):
-        idx = line["question_id"]
-        cur_prompt = line["text"]
-
+    # the merged multimodal inputs must stay left-padded for batched generation
+    model.config.tokenizer_padding_side = 'left'
+    data_loader = create_data_loader(questions, args.image_folder, tokenizer, image_processor, model.config, batch_size=args.batch_size)
+    conv = conv_templates[args.conv_mode]
+    stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
+
+    start_time = time.time()
+    total_tokens = 0
+    line_iter = iter(questions)
+    progress = tqdm(total=len(questions))
+    for input_ids, attention_mask, image_tensor, image_sizes in data_loader:
         input_ids = input_ids.to(device='cuda', non_blocking=True)
+        attention_mask = attention_mask.to(device='cuda', non_blocking=True)
+        if type(image_tensor) is list:
+            images = [x.to(dtype=torch.float16, device='cuda', non_blocking=True) for x in image_tensor]
+        else:
+            images = image_tensor.to(dtype=torch.float16, device='cuda', non_blocking=True)
 
+        # beam search reorders the rows, so only greedy and sampled rows are stopped at the separator
+        stopping_criteria = KeywordsStoppingCriteria([stop_str], tokenizer, input_ids) if args.num_beams == 1 else None
         with torch.inference_mode():
             output_ids = model.generate(
                 input_ids,
-                images=image_tensor.to(dtype=torch.float16, device='cuda', non_blocking=True),
+                attention_mask=attention_mask,
+                images=images,
                 image_sizes=image_sizes,
                 do_sample=True if args.temperature > 0 else False,
                 temperature=args.temperature,
                 top_p=args.top_p,
                 num_beams=args.num_beams,
                 max_new_tokens=args.max_new_tokens,
+                pad_token_id=tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id,
+                stopping_criteria=[stopping_criteria] if stopping_criteria is not None else None,
                 use_cache=True)
 
-        outputs = tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0].strip()
-
-        ans_id = shortuuid.uuid()
-        ans_file.write(json.dumps({"question_id": idx,
-                                   "prompt": cur_prompt,
-                                   "text": outputs,
-                                   "answer_id": ans_id,
-                                   "model_id": model_name,
-                                   "metadata": {}}) + "\n")
+        if stopping_criteria is not None:
+            # the rows that stopped before the others kept generating until the whole batch stopped
+            output_ids = stopping_criteria.trim(output_ids)
+        total_tokens += sum(num_generated_tokens(output_ids, tokenizer.eos_token_id))
+        outputs = [x.split(stop_str)[0].strip() for x in tokenizer.batch_decode(output_ids, skip_special_tokens=True)]
+
+        # batches follow the question order
+        for output in outputs:
+            line = next(line_iter)
+            ans_id = shortuuid.uuid()
+            ans_file.write(json.dumps({"question_id": line["question_id"],
+                                       "prompt": line["text"],
+                                       "text": output,
+                                       "answer_id": ans_id,
+                                       "model_id": model_name,
+                                       "metadata": {}}) + "\n")
         # ans_file.flush()
+        progress.update(len(outputs))
+    progress.close()
     ans_file.close()
 
+    elapsed = time.time() - start_time
+    print(f"Evaluated {len(questions)} questions in {elapsed:.1f}s (batch size {args.batch_size}): "
+          f"{len(questions) / elapsed:.2f} questions/s, {total_tokens / elapsed:.1f} tokens/s")
+
+    if model.get_model().image_feature_cache is not None:
+        print(f"Image feature cache: {model.get_model().image_feature_cache.stats}")
+    stats = model.get_model().token_reduction_stats
+    if stats["images"] > 0:
+        print(f"Token reduction {model.config.mm_token_reduction}: {stats['tokens'] / stats['images']:.0f} -> "
+              f"{stats['reduced_tokens'] / stats['images']:.0f} image tokens per image "
+              f"({stats['reduced_tokens'] / stats['tokens']:.1%})")
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--model-path", type=str, default="facebook/opt-350m")
@@ -139,6 +202,10 @@ def eval_model(args):
     parser.add_argument("--top_p", type=float, default=None)
     parser.add_argument("--num_beams", type=int, default=1)
     parser.add_argument("--max_new_tokens", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--image-feature-cache-dir", type=str, default=None)
+    parser.add_argument("--token-reduction", type=str, default=None,
+        help="Overrides mm_token_reduction of the model config, e.g. pool2, tome0.5, prune0.25 or none.")
     args = parser.parse_args()
 
     eval_model(args)
@@ -1,10 +1,17 @@
 from PIL import Image
 from io import BytesIO
 import base64
+from collections import namedtuple, OrderedDict
+import functools
+import threading
+import numpy as np
 import torch
 import math
 import ast
+import re
 
+import transformers
+from packaging import version
 from transformers import StoppingCriteria
 from llava.constants import IMAGE_TOKEN_INDEX
 
@@ -20,23 +27,7 @@ def select_best_resolution(original_size, possible_resolutions):
     Returns:
         tuple: The best fit resolution in the format (width, height).
     """
-    original_width, original_height = original_size
-    best_fit = None
-    max_effective_resolution = 0
-    min_wasted_resolution = float('inf')
-
-    for width, height in possible_resolutions:
-        scale = min(width / original_width, height / original_height)
-        downscaled_width, downscaled_height = int(original_width * scale), int(original_height * scale)
-        effective_resolution = min(downscaled_width * downscaled_height, original_width * original_height)
-        wasted_resolution = (width * height) - effective_resolution
-
-        if effective_resolution > max_effective_resolution or (effective_resolution == max_effective_resolution and wasted_resolution < min_wasted_resolution):
-            max_effective_resolution = effective_resolution
-            min_wasted_resolution = wasted_resolution
-            best_fit = (width, height)
-
-    return best_fit
+    return get_anyres_planner(possible_resolutions, 1).select_best_resolution(original_size)
 
 
 def resize_and_pad_image(image, target_resolution):
@@ -50,26 +41,11 @@ def resize_and_pad_image(image, target_resolution):
     Returns:
         PIL.Image.Image: The resized and padded image.
     """
-    original_width, original_height = image.size
-    target_width, target_height = target_resolution
-
-    scale_w = target_width / original_width
-    scale_h = target_height / original_height
-
-    if scale_w < scale_h:
-        new_width = target_width
-        new_height = min(math.ceil(original_height * scale_w), target_height)
-    else:
-        new_height = target_height
-        new_width = min(math.ceil(original_width * scale_h), target_width)
-
-    # Resize the image
-    resized_image = image.resize((new_width, new_height))
+    plan = get_anyres_planner([target_resolution], 1).plan(image.size)
+    resized_image = image.resize(plan.resized_size)
 
-    new_image = Image.new('RGB', (target_width, target_height), (0, 0, 0))
-    paste_x = (target_width - new_width) // 2
-    paste_y = (target_height - new_height) // 2
-    new_image.paste(resized_image, (paste_x, paste_y))
+    new_image = Image.new('RGB', plan.target_resolution, (0, 0, 0))
+    new_image.paste(resized_image, plan.paste_offset)
 
     return new_image
 
@@ -96,6 +72,177 @@ def divide_to_patches(image, patch_size):
     return patches
 
 
+AnyresPlan = namedtuple("AnyresPlan", [
+    "target_resolution",  # (width, height) the image is resized and padded to
+    "resized_size",  # (width, height) of the resized image, before padding
+    "paste_offset",  # (x, y) of the resized image on the padded canvas
+    "grid_shape",  # (width, height) of the patch grid
+    "unpad_box",  # (top, bottom, left, right) of the unpadded features, or None
+    "num_tokens",  # number of image features the model inserts, or None
+])
+
+
+class AnyresPlanner:
+    """
+    Plans the anyres processing of images, shared by the preprocessing, the model
+    merge step and token budgeting. The grid pinpoints are parsed once, the best
+    resolution is selected with array ops, and plans are memoized by image size.
+
+    Args:
+        grid_pinpoints (str or list): The possible resolutions.
+        image_size (int): The input resolution of the vision tower (the patch size of the grid).
+        num_patches_per_side (int): Features per side of one patch; needed for `unpad_box` and `num_tokens`.
+        mm_patch_merge_type (str): How the model merges the patch features, for `num_tokens`.
+    """
+
+    def __init__(self, grid_pinpoints, image_size, num_patches_per_side=None, mm_patch_merge_type='flat'):
+        if type(grid_pinpoints) is str:
+            grid_pinpoints = ast.literal_eval(grid_pinpoints)
+        self.resolutions = np.array(grid_pinpoints, dtype=np.int64).reshape(-1, 2)
+        self.image_size = image_size
+        self.num_patches_per_side = num_patches_per_side
+        self.mm_patch_merge_type = mm_patch_merge_type
+        self._plan = functools.lru_cache(maxsize=4096)(self._make_plan)
+
+    def select_best_resolution(self, original_size):
+        """The resolution with the largest effective resolution and the least waste, over all candidates at once."""
+        original_width, original_height = original_size
+        widths, heights = self.resolutions[:, 0], self.resolutions[:, 1]
+        scales = np.minimum(widths / original_width, heights / original_height)
+        downscaled = (original_width * scales).astype(np.int64) * (original_height * scales).astype(np.int64)
+        effective = np.minimum(downscaled, original_width * original_height)
+        wasted = widths * heights - effective
+        # the largest effective resolution, then the least waste, then the first candidate
+        best = np.lexsort((np.arange(len(widths)), wasted, -effective))[0]
+        return int(widths[best]), int(heights[best])
+
+    def plan(self, original_size):
+        """
+        Args:
+            original_size (tuple): The size of the image in the format (width, height).
+
+        Returns:
+            AnyresPlan: The plan of the image.
+        """
+        return self._plan(tuple(int(x) for x in original_size))
+
+    def _make_plan(self, original_size):
+        original_width, original_height = original_size
+        target_width, target_height = self.select_best_resolution(original_size)
+
+        scale_w = target_width / original_width
+        scale_h = target_height / original_height
+        if scale_w < scale_h:
+            new_width = target_width
+            new_height = min(math.ceil(original_height * scale_w), target_height)
+        else:
+            new_height = target_height
+            new_width = min(math.ceil(original_width * scale_h), target_width)
+        paste_offset = ((target_width - new_width) // 2, (target_height - new_height) // 2)
+        grid_shape = (target_width // self.image_size, target_height // self.image_size)
+
+        unpad_box = num_tokens = None
+        side = self.num_patches_per_side
+        if side is not None:
+            # the (grid_height * side, grid_width * side) features, cropped back to the aspect ratio of the image
+            current_height, current_width = grid_shape[1] * side, grid_shape[0] * side
+            if original_width / original_height > current_width / current_height:
+                padding = (current_height - int(original_height * (current_width / original_width))) // 2
+                unpad_box = (padding, current_height - padding, 0, current_width)
+            else:
+                padding = (current_width - int(original_width * (current_height / original_height))) // 2
+                unpad_box = (0, current_height, padding, current_width - padding)
+            if 'unpad' in self.mm_patch_merge_type:
+                # the base image, then the unpadded features with one newline feature per row
+                top, bottom, left, right = unpad_box
+                num_tokens = side * side + (bottom - top) * (right - left + 1)
+            else:
+                num_tokens = side * side * (1 + grid_shape[0] * grid_shape[1])
+
+        return AnyresPlan((target_width, target_height), (new_width, new_height), paste_offset, grid_shape, unpad_box, num_tokens)
+
+
+def get_anyres_planner(grid_pinpoints, image_size, num_patches_per_side=None, mm_patch_merge_type='flat'):
+    """Returns the shared `AnyresPlanner` of these settings."""
+    if type(grid_pinpoints) is not str:
+        grid_pinpoints = tuple(tuple(x) for x in grid_pinpoints)
+    return _get_anyres_planner(grid_pinpoints, image_size, num_patches_per_side, mm_patch_merge_type)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_anyres_planner(grid_pinpoints, image_size, num_patches_per_side, mm_patch_merge_type):
+    return AnyresPlanner(grid_pinpoints, image_size, num_patches_per_side, mm_patch_merge_type)
+
+
+class TokenReduction(namedtuple("TokenReduction", ["method", "value"])):
+    """
+    The token reduction of the image features, parsed from `mm_token_reduction`:
+      - `pool<stride>`, e.g. `pool2`: average pooling of the feature grid of every
+        patch, before the patches are merged;
+      - `tome<keep_ratio>`, e.g. `tome0.5`: merging of the most similar features;
+      - `prune<keep_ratio>`, e.g. `prune0.25`: keeps the features that get the most attention.
+    The last two reduce the merged features of every image, except the newline features.
+    `none` (or no value) disables the reduction.
+    """
+
+    METHODS = ("pool", "tome", "prune")
+
+    @classmethod
+    def parse(cls, mm_token_reduction):
+        if mm_token_reduction is None or mm_token_reduction == 'none':
+            return cls(None, None)
+        for method in cls.METHODS:
+            if mm_token_reduction.startswith(method):
+                value = mm_token_reduction[len(method):]
+                try:
+                    value = int(value) if method == 'pool' else float(value)
+                except ValueError:
+                    break
+                if (method == 'pool' and value >= 1) or (method != 'pool' and 0 < value <= 1):
+                    return cls(method, value)
+                break
+        raise ValueError(f'Unexpected mm_token_reduction: {mm_token_reduction}')
+
+    @property
+    def is_spatial(self):
+        return self.method == 'pool'
+
+    @property
+    def is_sequential(self):
+        return self.method in ('tome', 'prune')
+
+    def grid_side(self, num_patches_per_side):
+        """Features per side of one patch after the spatial reduction."""
+        if self.is_spatial:
+            return math.ceil(num_patches_per_side / self.value)
+        return num_patches_per_side
+
+    def num_kept(self, num_tokens, num_protected=0):
+        """Number of features the sequential reduction keeps of `num_tokens`, `num_protected` of which are kept anyway."""
+        if self.is_sequential:
+            return num_protected + math.ceil((num_tokens - num_protected) * self.value)
+        return num_tokens
+
+
+def projector_grid_side(mm_projector_type, num_patches_per_side):
+    """
+    Features per side of one patch after the projector: the projectors of
+    `llava.model.multimodal_projector.builder` that shrink the token count output
+    a smaller square grid.
+    """
+    downsample_match = re.match(r'^downsample(\d+)x_mlp\d+x_gelu$', mm_projector_type or '')
+    if downsample_match:
+        return math.ceil(num_patches_per_side / int(downsample_match.group(1)))
+    resampler_match = re.match(r'^resampler(\d+)$', mm_projector_type or '')
+    if resampler_match:
+        return math.isqrt(int(resampler_match.group(1)))
+    return num_patches_per_side
+
+
+def get_token_reduction(model_cfg):
+    return TokenReduction.parse(getattr(model_cfg, 'mm_token_reduction', None))
+
+
 def get_anyres_image_grid_shape(image_size, grid_pinpoints, patch_size):
     """
     Calculate the shape of the image patch grid after the preprocessing for images of any resolution.
@@ -108,12 +255,44 @@ def get_anyres_image_grid_shape(image_size, grid_pinpoints, patch_size):
     Returns:
         tuple: The shape of the image patch grid in the format (width, height).
     """
-    if type(grid_pinpoints) is list:
-        possible_resolutions = grid_pinpoints
-    else:
-        possible_resolutions = ast.literal_eval(grid_pinpoints)
-    width, height = select_best_resolution(image_size, possible_resolutions)
-    return width // patch_size, height // patch_size
+    return get_anyres_planner(grid_pinpoints, patch_size).plan(image_size).grid_shape
+
+
+def count_image_tokens(image_size, model_cfg, vision_tower, token_reduction=None):
+    """
+    Number of image features `prepare_inputs_labels_for_multimodal` inserts for one image.
+
+    Args:
+        image_size (tuple): The size of the input image in the format (width, height).
+        model_cfg: The config of the model.
+        vision_tower: The vision tower of the model.
+        token_reduction (TokenReduction): The token reduction; that of `model_cfg` if None.
+
+    Returns:
+        int: The number of image features.
+    """
+    if token_reduction is None:
+        token_reduction = get_token_reduction(model_cfg)
+    image_aspect_ratio = getattr(model_cfg, 'image_aspect_ratio', 'square')
+    mm_patch_merge_type = getattr(model_cfg, 'mm_patch_merge_type', 'flat')
+    side = token_reduction.grid_side(projector_grid_side(
+        getattr(model_cfg, 'mm_projector_type', 'linear'), vision_tower.num_patches_per_side))
+    # the cls feature of every patch, kept by `cls_patch`
+    num_cls = int(getattr(vision_tower, 'select_feature', 'patch') == 'cls_patch')
+    if image_aspect_ratio != 'anyres':
+        # images of the same size are batched in one tensor, whose features are used as they are,
+        # without a newline feature
+        return token_reduction.num_kept(side * side + num_cls)
+    planner = get_anyres_planner(
+        model_cfg.image_grid_pinpoints, vision_tower.config.image_size,
+        side, mm_patch_merge_type)
+    plan = planner.plan(image_size)
+    num_newlines = 0
+    if mm_patch_merge_type.startswith('spatial') and 'unpad' in mm_patch_merge_type:
+        num_newlines = plan.unpad_box[1] - plan.unpad_box[0]
+    if mm_patch_merge_type == 'flat':
+        return token_reduction.num_kept(plan.num_tokens + num_cls * (1 + plan.grid_shape[0] * plan.grid_shape[1]))
+    return token_reduction.num_kept(plan.num_tokens, num_newlines)
 
 
 def process_anyres_image(image, processor, grid_pinpoints):
@@ -128,11 +307,7 @@ def process_anyres_image(image, processor, grid_pinpoints):
     Returns:
         torch.Tensor: A tensor containing the processed image patches.
     """
-    if type(grid_pinpoints) is list:
-        possible_resolutions = grid_pinpoints
-    else:
-        possible_resolutions = ast.literal_eval(grid_pinpoints)
-    best_resolution = select_best_resolution(image.size, possible_resolutions)
+    best_resolution = get_anyres_planner(grid_pinpoints, processor.crop_size['height']).plan(image.size).target_resolution
     image_padded = resize_and_pad_image(image, best_resolution)
 
     patches = divide_to_patches(image_padded, processor.crop_size['height'])
@@ -145,6 +320,63 @@ def process_anyres_image(image, processor, grid_pinpoints):
     return torch.stack(image_patches, dim=0)
 
 
+def _to_uint8_tensor(image):
+    """Converts a PIL image to a (3, height, width) uint8 tensor."""
+    return torch.from_numpy(np.asarray(image.convert('RGB'))).permute(2, 0, 1)
+
+
+def anyres_image_to_patches(image, processor, grid_pinpoints):
+    """
+    Tensor version of the resize, pad and patch steps of `process_anyres_image`.
+
+    The image is resized once to the best resolution and pasted on a black canvas,
+    and the patches are cut with a single view, in the order of `divide_to_patches`.
+
+    Returns:
+        torch.Tensor: The uint8 base image and patches, in the shape of (1 + num_patches, 3, patch_size, patch_size).
+    """
+    patch_size = processor.crop_size['height']
+    plan = get_anyres_planner(grid_pinpoints, patch_size).plan(image.size)
+    target_width, target_height = plan.target_resolution
+    new_width, new_height = plan.resized_size
+    resized = _to_uint8_tensor(image.resize((new_width, new_height)))
+
+    # `divide_to_patches` crops beyond the border as black, like the padding
+    num_rows, num_cols = math.ceil(target_height / patch_size), math.ceil(target_width / patch_size)
+    canvas = torch.zeros((3, num_rows * patch_size, num_cols * patch_size), dtype=torch.uint8)
+    paste_x, paste_y = plan.paste_offset
+    canvas[:, paste_y:paste_y + new_height, paste_x:paste_x + new_width] = resized
+    patches = canvas.view(3, num_rows, patch_size, num_cols, patch_size).permute(1, 3, 0, 2, 4).reshape(-1, 3, patch_size, patch_size)
+
+    shortest_edge = processor.size['shortest_edge']
+    base = _to_uint8_tensor(image.resize((shortest_edge, shortest_edge)))
+    return torch.cat((base[None], patches), dim=0)
+
+
+def normalize_pixels(pixels, processor):
+    """Rescales and normalizes uint8 pixels of shape (..., 3, height, width) like `processor.preprocess`."""
+    mean = torch.tensor(processor.image_mean, dtype=torch.float32).view(3, 1, 1)
+    std = torch.tensor(processor.image_std, dtype=torch.float32).view(3, 1, 1)
+    return (pixels.float() * processor.rescale_factor - mean) / std
+
+
+def process_anyres_images(images, processor, grid_pinpoints):
+    """
+    Batched, tensor-based `process_anyres_image`: every image is resized once, and the
+    patches of all images are normalized together.
+
+    Returns:
+        list: The processed base image and patches of every image.
+    """
+    shortest_edge = processor.size['shortest_edge']
+    if shortest_edge != processor.crop_size['height'] or shortest_edge != processor.crop_size['width']:
+        # the base image would also need a center crop
+        return [process_anyres_image(image, processor, grid_pinpoints) for image in images]
+    pixels = [anyres_image_to_patches(image, processor, grid_pinpoints) for image in images]
+    normalized = normalize_pixels(torch.cat(pixels, dim=0), processor)
+    return list(torch.split(normalized, [x.shape[0] for x in pixels], dim=0))
+
+
 def load_image_from_base64(image):
     return Image.open(BytesIO(base64.b64decode(image)))
 
@@ -172,9 +404,7 @@ def process_images(images, image_processor, model_cfg):
             image = image_processor.preprocess(image, return_tensors='pt')['pixel_values'][0]
             new_images.append(image)
     elif image_aspect_ratio == "anyres":
-        for image in images:
-            image = process_anyres_image(image, image_processor, model_cfg.image_grid_pinpoints)
-            new_images.append(image)
+        new_images = process_anyres_images(images, image_processor, model_cfg.image_grid_pinpoints)
     else:
         return image_processor(images, return_tensors='pt')['pixel_values']
     if all(x.shape == new_images[0].shape for x in new_images):
@@ -212,36 +442,227 @@ def get_model_name_from_path(model_path):
     else:
         return model_paths[-1]
 
+def _may_end_keyword(text, keyword):
+    """Whether a stop string can end inside a token that decodes to `text`."""
+    return keyword in text or any(text.startswith(keyword[-j:]) for j in range(1, len(keyword)))
+
+
+class _TokenizerCache:
+    """
+    Bounded LRU cache of objects built for a tokenizer. An entry holds its tokenizer,
+    so that the `id` of the key is not reused by another tokenizer while it is cached.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, tokenizer, key, build):
+        cache_key = (id(tokenizer), key)
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry is not None and entry[0] is tokenizer:
+                self.entries.move_to_end(cache_key)
+                return entry[1]
+        value = build()
+        with self.lock:
+            self.entries[cache_key] = (tokenizer, value)
+            self.entries.move_to_end(cache_key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+
+class _VocabTexts:
+    """The texts of every token of a tokenizer, decoded once and shared by all its stop strings."""
+
+    def __init__(self, tokenizer):
+        token_ids = list(range(len(tokenizer)))
+        pieces = tokenizer.convert_ids_to_tokens(token_ids)
+        # the decoded token, and its piece, as decoding strips the leading space of some tokenizers
+        self.texts = [
+            (tokenizer.decode([token_id]), (piece or "").replace('\u2581', ' ').replace('\u0120', ' ').replace('\u010a', '\n'))
+            for token_id, piece in zip(token_ids, pieces)]
+        # byte tokens of multi-byte characters
+        self.partial = torch.tensor(['\ufffd' in texts[0] for texts in self.texts], dtype=torch.bool)
+
+
+_vocab_texts = _TokenizerCache(max_entries=4)
+
+
+class StopSequenceMatcher:
+    """
+    Matches stop strings in generated token ids, for a whole batch at once.
+
+    The token ids of the stop strings form an Aho-Corasick automaton, compiled to
+    a dense (num_states, vocab_size + 1) transition table, so that a step is a
+    single lookup for every row. A stop string can also be generated with other
+    tokens; only the rows whose last token may end a stop string in its decoded
+    text, without matching in the automaton, decode their last few tokens.
+    Use `get_stop_sequence_matcher` to share the matcher of a tokenizer.
+    """
+
+    def __init__(self, keywords, tokenizer):
+        self.keywords = list(keywords)
+        self.tokenizer = tokenizer
+        vocab_size = max(len(tokenizer), tokenizer.vocab_size)
+        # token ids out of the vocabulary, e.g. from padded embeddings, map to the last column
+        self.vocab_size = vocab_size
+
+        children, accepting = [{}], [False]
+        for keyword in self.keywords:
+            keyword_ids = tokenizer(keyword).input_ids
+            if len(keyword_ids) > 1 and keyword_ids[0] == tokenizer.bos_token_id:
+                keyword_ids = keyword_ids[1:]
+            state = 0
+            for token_id in keyword_ids:
+                if token_id not in children[state]:
+                    children.append({})
+                    accepting.append(False)
+                    children[state][token_id] = len(children) - 1
+                state = children[state][token_id]
+            accepting[state] = True
+
+        transitions = torch.zeros((len(children), vocab_size + 1), dtype=torch.long)
+        fail = [0] * len(children)
+        order = [0]
+        for state in order:
+            for token_id, child in children[state].items():
+                fail[child] = transitions[fail[state], token_id].item() if state != 0 else 0
+                accepting[child] = accepting[child] or accepting[fail[child]]
+                order.append(child)
+            if state != 0:
+                transitions[state] = transitions[fail[state]]
+            for token_id, child in children[state].items():
+                transitions[state, token_id] = child
+        self.transitions = transitions
+        self.accepting = torch.tensor(accepting, dtype=torch.bool)
+
+        vocab = _vocab_texts.get(tokenizer, None, lambda: _VocabTexts(tokenizer))
+        ambiguous = torch.zeros(vocab_size + 1, dtype=torch.bool)
+        if any(ord(c) > 127 for keyword in self.keywords for c in keyword):
+            ambiguous[:vocab.partial.shape[0]] = vocab.partial
+        for token_id, texts in enumerate(vocab.texts):
+            if any(_may_end_keyword(text, keyword) for text in texts for keyword in self.keywords):
+                ambiguous[token_id] = True
+        self.ambiguous = ambiguous
+        # enough tokens to decode any stop string, with a few byte tokens
+        self.window = max(len(keyword) for keyword in self.keywords) + 4
+        self._device_tables = {}
+
+    def tables(self, device):
+        if device not in self._device_tables:
+            self._device_tables[device] = (
+                self.transitions.to(device), self.accepting.to(device), self.ambiguous.to(device))
+        return self._device_tables[device]
+
+    def initial_states(self, batch_size, device=None):
+        return torch.zeros(batch_size, dtype=torch.long, device=device)
+
+    def step(self, states, token_ids, output_ids=None):
+        """
+        Advances the automaton of every row by one token.
+
+        Args:
+            states (torch.LongTensor): The states of the rows, in the shape of (batch_size,).
+            token_ids (torch.LongTensor): The new token of every row, in the shape of (batch_size,).
+            output_ids (torch.LongTensor or list): The generated ids of every row, ending with `token_ids`,
+                for the decoded fallback; the fallback is skipped if None.
+
+        Returns:
+            tuple: The new states, and whether a stop string ends at the new token of every row.
+        """
+        transitions, accepting, ambiguous = self.tables(states.device)
+        token_ids = token_ids.to(states.device).clamp(0, self.vocab_size)
+        states = transitions[states, token_ids]
+        matched = accepting[states]
+        if output_ids is not None:
+            check = ambiguous[token_ids] & ~matched
+            if check.any():
+                for i in check.nonzero()[:, 0].tolist():
+                    tail = output_ids[i][-self.window:]
+                    if torch.is_tensor(tail):
+                        tail = tail.tolist()
+                    text = self.tokenizer.decode(tail, skip_special_tokens=True)
+                    if any(keyword in text for keyword in self.keywords):
+                        matched[i] = True
+        return states, matched
+
+
+# stop strings come from the requests, so only the most recent matchers are kept
+_stop_sequence_matchers = _TokenizerCache(max_entries=32)
+
+
+def get_stop_sequence_matcher(keywords, tokenizer):
+    """Returns the shared `StopSequenceMatcher` of these stop strings and tokenizer."""
+    keywords = tuple(keywords)
+    return _stop_sequence_matchers.get(tokenizer, keywords, lambda: StopSequenceMatcher(keywords, tokenizer))
+
+
+# transformers >= 4.39 stops the rows of a batch individually on a per-row bool tensor
+_PER_ROW_STOPPING = version.parse(transformers.__version__) >= version.parse("4.39.0")
+
+
 class KeywordsStoppingCriteria(StoppingCriteria):
+    """
+    Stops generation at any of the `keywords`, with a `StopSequenceMatcher`.
+
+    `stopped` holds the rows that generated a keyword. Older transformers only
+    stop once every row has; the rows that stopped earlier keep generating, and
+    are cut by `trim`.
+    """
+
     def __init__(self, keywords, tokenizer, input_ids):
         self.keywords = keywords
-        self.keyword_ids = []
-        self.max_keyword_len = 0
-        for keyword in keywords:
-            cur_keyword_ids = tokenizer(keyword).input_ids
-            if len(cur_keyword_ids) > 1 and cur_keyword_ids[0] == tokenizer.bos_token_id:
-                cur_keyword_ids = cur_keyword_ids[1:]
-            if len(cur_keyword_ids) > self.max_keyword_len:
-                self.max_keyword_len = len(cur_keyword_ids)
-            self.keyword_ids.append(torch.tensor(cur_keyword_ids))
         self.tokenizer = tokenizer
+        self.matcher = get_stop_sequence_matcher(keywords, tokenizer)
         self.start_len = input_ids.shape[1]
-    
-    def call_for_batch(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        offset = min(output_ids.shape[1] - self.start_len, self.max_keyword_len)
-        self.keyword_ids = [keyword_id.to(output_ids.device) for keyword_id in self.keyword_ids]
-        for keyword_id in self.keyword_ids:
-            truncated_output_ids = output_ids[0, -keyword_id.shape[0]:]
-            if torch.equal(truncated_output_ids, keyword_id):
-                return True
-        outputs = self.tokenizer.batch_decode(output_ids[:, -offset:], skip_special_tokens=True)[0]
-        for keyword in self.keywords:
-            if keyword in outputs:
-                return True
-        return False
-    
-    def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        outputs = []
-        for i in range(output_ids.shape[0]):
-            outputs.append(self.call_for_batch(output_ids[i].unsqueeze(0), scores))
-        return all(outputs)
+        self.num_seen = self.start_len
+        self.states = None
+        self.stopped = None
+        # length of the outputs of every row when it stopped
+        self.stop_lengths = None
+
+    def __call__(self, output_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs):
+        if self.states is None:
+            # generating from inputs_embeds, as with images, the outputs do not include the prompt
+            if output_ids.shape[1] <= self.start_len:
+                self.start_len = self.num_seen = 0
+            self.states = self.matcher.initial_states(output_ids.shape[0], output_ids.device)
+            self.stopped = torch.zeros(output_ids.shape[0], dtype=torch.bool, device=output_ids.device)
+            self.stop_lengths = [None] * output_ids.shape[0]
+        # usually one new token per call, several with assisted generation
+        for end in range(self.num_seen + 1, output_ids.shape[1] + 1):
+            self.states, matched = self.matcher.step(
+                self.states, output_ids[:, end - 1], output_ids[:, self.start_len:end])
+            newly_stopped = matched & ~self.stopped
+            if newly_stopped.any():
+                for i in newly_stopped.nonzero()[:, 0].tolist():
+                    self.stop_lengths[i] = end
+            self.stopped |= matched
+        self.num_seen = output_ids.shape[1]
+        if _PER_ROW_STOPPING:
+            return self.stopped.clone()
+        return bool(self.stopped.all())
+
+    def call_for_batch(self, output_ids: torch.LongTensor, scores: torch.FloatTensor = None, **kwargs) -> bool:
+        """Whether the outputs of a single row end with a keyword; does not change the state of the batch."""
+        start = self.start_len if output_ids.shape[1] > self.start_len else 0
+        tail = output_ids[0, start:][-self.matcher.window:]
+        states = self.matcher.initial_states(1, output_ids.device)
+        matched = torch.zeros(1, dtype=torch.bool)
+        for end in range(1, tail.shape[0] + 1):
+            states, matched = self.matcher.step(states, tail[end - 1:end], [tail[:end]])
+        return bool(matched[0])
+
+    def trim(self, output_ids):
+        """
+        Cuts every row of the outputs of `generate` after the token that ended its
+        keyword, and keeps the rows that did not stop as they are.
+
+        Returns:
+            list: The token ids of every row.
+        """
+        stop_lengths = self.stop_lengths or [None] * output_ids.shape[0]
+        return [row if stop_length is None else row[:stop_length] for row, stop_length in zip(output_ids, stop_lengths)]
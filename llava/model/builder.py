@@ -20,10 +20,29 @@
 from transformers import AutoTokenizer, AutoModelForCausalLM, AutoConfig, BitsAndBytesConfig
 import torch
 from llava.model import *
+from llava.model.fast_load import LoadTimer, find_safetensors_shards, load_safetensors_model
 from llava.constants import DEFAULT_IMAGE_PATCH_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
 
 
-def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, load_4bit=False, device_map="auto", device="cuda", use_flash_attn=False, **kwargs):
+def get_fast_load_device(device_map, device):
+    """The device of the safetensors fast path, or None if the model is dispatched over several devices."""
+    if device != "cuda":
+        return device
+    if device_map == "auto":
+        return "cuda" if torch.cuda.device_count() <= 1 else None
+    if type(device_map) is str:
+        return device_map
+    return None
+
+
+def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, load_4bit=False, device_map="auto", device="cuda", use_flash_attn=False, fast_load=False, **kwargs):
+    timer = LoadTimer()
+    fast_load_device = None
+    if fast_load and 'llava' in model_name.lower() and 'mpt' not in model_name.lower() and model_base is None \
+            and not load_8bit and not load_4bit and find_safetensors_shards(model_path) is not None:
+        # a merged safetensors checkpoint, e.g. from llava.model.convert_checkpoint
+        fast_load_device = get_fast_load_device(device_map, device)
+
     kwargs = {"device_map": device_map, **kwargs}
 
     if device != "cuda":
@@ -45,7 +64,19 @@ def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, l
     if use_flash_attn:
         kwargs['attn_implementation'] = 'flash_attention_2'
 
-    if 'llava' in model_name.lower():
+    if fast_load_device is not None:
+        print(f'Loading LLaVA from the safetensors checkpoint {model_path} on {fast_load_device}...')
+        if 'mistral' in model_name.lower():
+            tokenizer = AutoTokenizer.from_pretrained(model_path)
+            model_cls = LlavaMistralForCausalLM
+        else:
+            tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False)
+            model_cls = LlavaLlamaForCausalLM
+        timer.mark("tokenizer")
+        model = load_safetensors_model(
+            model_cls, model_path, fast_load_device, dtype=torch.float16,
+            attn_implementation=kwargs.get('attn_implementation', None), timer=timer)
+    elif 'llava' in model_name.lower():
         # Load LLaVA model
         if 'lora' in model_name.lower() and model_base is None:
             warnings.warn('There is `lora` in model name but no `model_base` is provided. If you are loading a LoRA model, please provide the `model_base` argument. Detailed instruction: https://github.com/haotian-liu/LLaVA#launch-a-model-worker-lora-weights-unmerged.')
@@ -55,6 +86,7 @@ def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, l
             tokenizer = AutoTokenizer.from_pretrained(model_base, use_fast=False)
             print('Loading LLaVA from base model...')
             model = LlavaLlamaForCausalLM.from_pretrained(model_base, low_cpu_mem_usage=True, config=lora_cfg_pretrained, **kwargs)
+            timer.mark("base model")
             token_num, tokem_dim = model.lm_head.out_features, model.lm_head.in_features
             if model.lm_head.weight.shape[0] != token_num:
                 model.lm_head.weight = torch.nn.Parameter(torch.empty(token_num, tokem_dim, device=model.device, dtype=model.dtype))
@@ -77,12 +109,15 @@ def load_from_hf(repo_id, filename, subfolder=None):
             if any(k.startswith('model.model.') for k in non_lora_trainables):
                 non_lora_trainables = {(k[6:] if k.startswith('model.') else k): v for k, v in non_lora_trainables.items()}
             model.load_state_dict(non_lora_trainables, strict=False)
+            timer.mark("non-LoRA weights")
 
             from peft import PeftModel
             print('Loading LoRA weights...')
             model = PeftModel.from_pretrained(model, model_path)
+            timer.mark("LoRA weights")
             print('Merging LoRA weights...')
             model = model.merge_and_unload()
+            timer.mark("LoRA merge")
             print('Model is loaded...')
         elif model_base is not None:
             # this may be mm projector only
@@ -98,9 +133,12 @@ def load_from_hf(repo_id, filename, subfolder=None):
                 cfg_pretrained = AutoConfig.from_pretrained(model_path)
                 model = LlavaLlamaForCausalLM.from_pretrained(model_base, low_cpu_mem_usage=True, config=cfg_pretrained, **kwargs)
 
+            timer.mark("base model")
+
             mm_projector_weights = torch.load(os.path.join(model_path, 'mm_projector.bin'), map_location='cpu')
             mm_projector_weights = {k: v.to(torch.float16) for k, v in mm_projector_weights.items()}
             model.load_state_dict(mm_projector_weights, strict=False)
+            timer.mark("projector weights")
         else:
             if 'mpt' in model_name.lower():
                 tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
@@ -119,6 +157,7 @@ def load_from_hf(repo_id, filename, subfolder=None):
                     low_cpu_mem_usage=True,
                     **kwargs
                 )
+            timer.mark("model")
     else:
         # Load language model
         if model_base is not None:
@@ -132,6 +171,7 @@ def load_from_hf(repo_id, filename, subfolder=None):
             model = model.merge_and_unload()
             print('Convert to FP16...')
             model.to(torch.float16)
+            timer.mark("LoRA merge")
         else:
             use_fast = False
             if 'mpt' in model_name.lower():
@@ -140,6 +180,7 @@ def load_from_hf(repo_id, filename, subfolder=None):
             else:
                 tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=False)
                 model = AutoModelForCausalLM.from_pretrained(model_path, low_cpu_mem_usage=True, **kwargs)
+            timer.mark("model")
 
     image_processor = None
 
@@ -151,6 +192,7 @@ def load_from_hf(repo_id, filename, subfolder=None):
         if mm_use_im_start_end:
             tokenizer.add_tokens([DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN], special_tokens=True)
         model.resize_token_embeddings(len(tokenizer))
+        timer.mark("embeddings")
 
         vision_tower = model.get_vision_tower()
         if not vision_tower.is_loaded:
@@ -158,10 +200,12 @@ def load_from_hf(repo_id, filename, subfolder=None):
         if device_map != 'auto':
             vision_tower.to(device=device_map, dtype=torch.float16)
         image_processor = vision_tower.image_processor
+        timer.mark("vision tower")
 
     if hasattr(model.config, "max_sequence_length"):
         context_len = model.config.max_sequence_length
     else:
         context_len = 2048
 
+    print(timer.summary())
     return tokenizer, model, image_processor, context_len
@@ -0,0 +1,52 @@
+"""
+Converts a LLaVA checkpoint once into a merged fp16 safetensors checkpoint, for
+the fast path of `load_pretrained_model` (see llava/model/fast_load.py).
+
+LoRA weights are merged, the projector of a projector-only checkpoint and the
+non-LoRA trainables are loaded into the model, and the model, its config and
+the tokenizer (with the image tokens) are saved as safetensors shards.
+
+Usage:
+python3 -m llava.model.convert_checkpoint --model-path ./checkpoints/llava-v1.5-13b-lora --model-base lmsys/vicuna-13b-v1.5 --dst ./checkpoints/llava-v1.5-13b-merged
+python3 -m llava.model.convert_checkpoint --model-path liuhaotian/llava-v1.5-7b --dst ~/model_weights/llava-v1.5-7b
+python3 -m llava.serve.model_worker --model-path ~/model_weights/llava-v1.5-7b --fast-load ...
+"""
+import argparse
+import os
+import warnings
+
+import torch
+
+from llava.mm_utils import get_model_name_from_path
+from llava.model.builder import load_pretrained_model
+from llava.model.fast_load import find_safetensors_shards
+
+
+def convert_checkpoint(model_path, model_base, dst_path, max_shard_size="5GB"):
+    dst_name = os.path.basename(os.path.normpath(dst_path)).lower()
+    if 'llava' not in dst_name or 'lora' in dst_name:
+        warnings.warn(f'`load_pretrained_model` detects the model type from its name: the name of {dst_path} '
+                      'should contain `llava`, and not `lora`.')
+
+    model_name = get_model_name_from_path(model_path)
+    tokenizer, model, image_processor, context_len = load_pretrained_model(
+        model_path, model_base, model_name, device_map='cpu', device='cpu', fast_load=False)
+    model.to(torch.float16)
+
+    print(f"Saving to {dst_path}")
+    model.save_pretrained(dst_path, safe_serialization=True, max_shard_size=max_shard_size)
+    tokenizer.save_pretrained(dst_path)
+    print(f"Saved {len(find_safetensors_shards(dst_path))} safetensors shards")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--model-base", type=str, default=None)
+    parser.add_argument("--dst", type=str, required=True)
+    parser.add_argument("--max-shard-size", type=str, default="5GB",
+        help="Smaller shards are read by more threads in parallel at startup.")
+
+    args = parser.parse_args()
+
+    convert_checkpoint(args.model_path, args.model_base, args.dst, args.max_shard_size)
@@ -0,0 +1,132 @@
+"""
+Fast loading of merged LLaVA checkpoints in the safetensors format.
+
+With `fast_load=True` (`--fast-load` of the model worker), `load_pretrained_model`
+uses this path for a local checkpoint of safetensors shards, such as the ones
+written by `llava.model.convert_checkpoint`, so that no LoRA merge or pickle load
+happens at startup. The model is created without allocating its weights, and
+the shards are memory mapped and read in parallel, every tensor cast to the
+target dtype as it is copied to the target device.
+"""
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from safetensors import safe_open
+from transformers import AutoConfig, GenerationConfig
+
+
+SAFE_WEIGHTS_NAME = "model.safetensors"
+SAFE_WEIGHTS_INDEX_NAME = "model.safetensors.index.json"
+
+
+class LoadTimer:
+    """
+    Wall time of the phases of a model load, for the timing breakdown of worker
+    startup. `mark(name)` ends the phase `name`, which started at the previous mark.
+    """
+
+    def __init__(self):
+        self.phases = []
+        self.start_time = self.last_time = time.perf_counter()
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last_time))
+        self.last_time = now
+
+    def summary(self):
+        total = time.perf_counter() - self.start_time
+        parts = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.phases)
+        return f"Model loaded in {total:.2f}s: {parts}"
+
+
+def find_safetensors_shards(model_path):
+    """Returns the safetensors files of a local checkpoint, or None if it has none."""
+    if not os.path.isdir(model_path):
+        return None
+    index_file = os.path.join(model_path, SAFE_WEIGHTS_INDEX_NAME)
+    if os.path.isfile(index_file):
+        with open(index_file) as f:
+            weight_map = json.load(f)["weight_map"]
+        return [os.path.join(model_path, shard) for shard in sorted(set(weight_map.values()))]
+    weights_file = os.path.join(model_path, SAFE_WEIGHTS_NAME)
+    if os.path.isfile(weights_file):
+        return [weights_file]
+    return None
+
+
+def _load_shard(model, shard, device, dtype, expected_keys):
+    loaded_keys = []
+    with safe_open(shard, framework="pt", device="cpu") as f:
+        for key in f.keys():
+            if key not in expected_keys:
+                # e.g. the weights of a vision tower that is loaded separately
+                continue
+            tensor = f.get_tensor(key)
+            # without `dtype`, the value is cast back to the dtype of the empty parameter, i.e. float32
+            set_module_tensor_to_device(model, key, device, value=tensor,
+                                        dtype=dtype if tensor.is_floating_point() else None)
+            loaded_keys.append(key)
+    return loaded_keys
+
+
+def load_safetensors_model(model_cls, model_path, device, dtype=torch.float16,
+                           attn_implementation=None, num_workers=8, timer=None):
+    """
+    Creates `model_cls` from the config of `model_path` without allocating its
+    weights, and loads the safetensors shards into it, in parallel.
+
+    Args:
+        model_cls: The model class, e.g. `LlavaLlamaForCausalLM`.
+        model_path (str): A local checkpoint with safetensors shards.
+        device (str or torch.device): The device of the model.
+        dtype (torch.dtype): The dtype of the floating point weights.
+        attn_implementation (str): E.g. `flash_attention_2`; the default attention if None.
+        num_workers (int): Number of shards read at the same time.
+        timer (LoadTimer): Records the phases of the load.
+
+    Returns:
+        The model, in eval mode.
+    """
+    timer = timer or LoadTimer()
+    shards = find_safetensors_shards(model_path)
+    if shards is None:
+        raise ValueError(f"No safetensors checkpoint in {model_path}")
+
+    config = AutoConfig.from_pretrained(model_path)
+    if attn_implementation is not None:
+        config._attn_implementation = attn_implementation
+    with init_empty_weights():
+        model = model_cls(config)
+    expected_keys = set(model.state_dict().keys())
+    timer.mark("model init")
+
+    with ThreadPoolExecutor(max_workers=max(1, min(num_workers, len(shards)))) as executor:
+        loaded_keys = set()
+        for keys in executor.map(lambda shard: _load_shard(model, shard, device, dtype, expected_keys), shards):
+            loaded_keys.update(keys)
+    missing_keys = expected_keys - loaded_keys
+    if getattr(config, "tie_word_embeddings", False):
+        # tied to the input embeddings below
+        missing_keys.discard("lm_head.weight")
+    if len(missing_keys) > 0:
+        raise ValueError(f"Weights missing from the checkpoint {model_path}: {sorted(missing_keys)[:10]}")
+    model.tie_weights()
+    wrong_dtype = [name for name, param in model.named_parameters() if param.is_floating_point() and param.dtype != dtype]
+    if len(wrong_dtype) > 0:
+        raise ValueError(f"Weights not loaded in {dtype}: {wrong_dtype[:10]}")
+    # buffers, e.g. the rotary embeddings, are created on the CPU
+    model.to(device)
+    timer.mark(f"weights ({len(shards)} shards)")
+
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(model_path)
+    except OSError:
+        pass
+    model.eval()
+    return model
@@ -0,0 +1,159 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def tensor_digest(tensor):
+    """
+    Computes a content hash of a tensor, including its shape and dtype.
+
+    Args:
+        tensor (torch.Tensor): The tensor to hash. It is copied to CPU if needed.
+
+    Returns:
+        str: The hex digest of the tensor contents.
+    """
+    tensor = tensor.detach().contiguous()
+    h = hashlib.sha1()
+    h.update(f"{tuple(tensor.shape)}|{tensor.dtype}".encode())
+    h.update(tensor.view(-1).view(torch.uint8).cpu().numpy().tobytes())
+    return h.hexdigest()
+
+
+def get_feature_namespace(model):
+    """
+    Builds a string identifying the vision tower and projector that produce the image features.
+    Features computed by different towers, selected layers or projector weights never share keys.
+    """
+    vision_tower = model.get_vision_tower()
+    h = hashlib.sha1()
+    for name, param in sorted(model.mm_projector.state_dict().items()):
+        h.update(name.encode())
+        h.update(param.detach().contiguous().view(-1).view(torch.uint8).cpu().numpy().tobytes())
+    return "|".join([
+        str(vision_tower.vision_tower_name),
+        str(vision_tower.select_layer),
+        str(vision_tower.select_feature),
+        str(getattr(model.config, 'mm_projector_type', 'linear')),
+        h.hexdigest(),
+    ])
+
+
+class ImageFeatureCache:
+    """
+    Bounded LRU cache of projected image features, keyed by the hash of the preprocessed pixels.
+
+    The in-memory tier keeps up to `max_entries` features on `device` (or on the device they were
+    computed on if `device` is None); with `max_entries=0` only the disk tier is used. If `disk_dir` is given, features are also written there with
+    `torch.save`, so that they survive worker restarts and evaluation reruns.
+    """
+
+    def __init__(self, max_entries=256, device=None, disk_dir=None, max_disk_entries=None):
+        self.max_entries = max_entries
+        self.device = device
+        self.disk_dir = disk_dir
+        self.max_disk_entries = max_disk_entries
+        self.namespace = None
+
+        self._entries = OrderedDict()
+        self._disk_entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+        if self.disk_dir is not None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            files = [f for f in os.listdir(self.disk_dir) if f.endswith('.pt')]
+            files.sort(key=lambda f: os.path.getmtime(os.path.join(self.disk_dir, f)))
+            for f in files:
+                self._disk_entries[f[:-3]] = None
+
+    def make_key(self, image):
+        return hashlib.sha1(f"{self.namespace}|{tensor_digest(image)}".encode()).hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.pt")
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            in_disk = self.disk_dir is not None and key in self._disk_entries
+        if in_disk:
+            try:
+                feature = torch.load(self._disk_path(key), map_location=self.device or 'cpu')
+            except (OSError, RuntimeError, EOFError):
+                feature = None
+            if feature is not None:
+                with self._lock:
+                    self._disk_entries.move_to_end(key)
+                    self.disk_hits += 1
+                self._put_memory(key, feature)
+                return feature
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _put_memory(self, key, feature):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = feature
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def put(self, key, feature):
+        # Copy so that a cached row does not keep the whole batch of features alive.
+        feature = feature.detach().to(self.device or feature.device, copy=True)
+        self._put_memory(key, feature)
+        if self.disk_dir is None:
+            return
+        with self._lock:
+            if key in self._disk_entries:
+                return
+            self._disk_entries[key] = None
+            to_evict = []
+            if self.max_disk_entries is not None:
+                while len(self._disk_entries) > self.max_disk_entries:
+                    to_evict.append(self._disk_entries.popitem(last=False)[0])
+                    self.disk_evictions += 1
+        tmp_path = self._disk_path(key) + f".{os.getpid()}.tmp"
+        torch.save(feature.cpu(), tmp_path)
+        os.replace(tmp_path, self._disk_path(key))
+        for old_key in to_evict:
+            try:
+                os.remove(self._disk_path(old_key))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "disk_entries": len(self._disk_entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "disk_evictions": self.disk_evictions,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups > 0 else 0.0,
+        }
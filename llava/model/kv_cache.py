@@ -0,0 +1,342 @@
+"""
+A block-based (paged) KV cache for the LLaVA language models.
+
+Keys and values of all sequences live in one preallocated pool of fixed-size
+blocks. Each sequence owns a block table (the list of its blocks), so sequences
+grow one block at a time and release their blocks to a free list when they
+finish, instead of concatenating and re-padding per-request tensors.
+
+Full blocks can be shared between sequences. `PrefixCache` uses this to keep the
+KV states of finished sequences and fork them into new sequences that start
+with the same prefix, e.g. the next turn of a conversation.
+"""
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from transformers.cache_utils import Cache
+
+
+class BlockAllocator:
+    """Free-list allocator of KV cache blocks, with reference counts for shared blocks."""
+
+    def __init__(self, num_blocks):
+        self.num_blocks = num_blocks
+        self.free_blocks = deque(range(num_blocks))
+        self.ref_counts = [0] * num_blocks
+
+    @property
+    def num_free_blocks(self):
+        return len(self.free_blocks)
+
+    def allocate(self):
+        if len(self.free_blocks) == 0:
+            raise RuntimeError("Out of KV cache blocks.")
+        block = self.free_blocks.popleft()
+        self.ref_counts[block] = 1
+        return block
+
+    def share(self, block):
+        self.ref_counts[block] += 1
+
+    def free(self, block):
+        self.ref_counts[block] -= 1
+        if self.ref_counts[block] == 0:
+            self.free_blocks.append(block)
+
+
+class PagedKVCache(Cache):
+    """
+    A `transformers` Cache whose storage is a pool of fixed-size blocks.
+
+    Before every forward pass, `begin_forward` selects the sequences in the batch
+    (one per row) and how many of the trailing input positions of each row are new
+    tokens; left-padded positions are not written. `update` scatters the new keys
+    and values into the blocks of each sequence and gathers the keys and values of
+    the whole batch, right-aligned, to match the mask returned by `attention_mask`.
+    """
+
+    def __init__(self, num_layers, num_kv_heads, head_dim, num_blocks, block_size=16,
+                 dtype=torch.float16, device="cpu"):
+        self.num_layers = num_layers
+        self.num_kv_heads = num_kv_heads
+        self.head_dim = head_dim
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.dtype = dtype
+        self.device = device
+
+        self.key_cache = [torch.zeros(num_blocks * block_size, num_kv_heads, head_dim, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.value_cache = [torch.zeros(num_blocks * block_size, num_kv_heads, head_dim, dtype=dtype, device=device) for _ in range(num_layers)]
+
+        self.allocator = BlockAllocator(num_blocks)
+        self.block_tables: Dict[Any, List[int]] = {}
+        self.seq_lens: Dict[Any, int] = {}
+
+        self.seen_tokens = 0
+        self._batch = None
+        self._past_length = 0
+
+    @classmethod
+    def from_model_config(cls, config, num_blocks, block_size=16, dtype=torch.float16, device="cpu"):
+        num_kv_heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+        return cls(
+            num_layers=config.num_hidden_layers,
+            num_kv_heads=num_kv_heads,
+            head_dim=config.hidden_size // config.num_attention_heads,
+            num_blocks=num_blocks,
+            block_size=block_size,
+            dtype=dtype,
+            device=device,
+        )
+
+    @staticmethod
+    def num_blocks_for_memory(config, memory_bytes, block_size=16, dtype=torch.float16):
+        """Returns how many blocks fit in `memory_bytes` for the given model config."""
+        num_kv_heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+        head_dim = config.hidden_size // config.num_attention_heads
+        element_size = torch.tensor([], dtype=dtype).element_size()
+        block_bytes = 2 * config.num_hidden_layers * num_kv_heads * head_dim * block_size * element_size
+        return int(memory_bytes // block_bytes)
+
+    # sequence management
+
+    def add_sequence(self, seq_id):
+        if seq_id in self.block_tables:
+            raise ValueError(f"Sequence {seq_id} already exists in the KV cache.")
+        self.block_tables[seq_id] = []
+        self.seq_lens[seq_id] = 0
+
+    def free_sequence(self, seq_id):
+        for block in self.block_tables.pop(seq_id):
+            self.allocator.free(block)
+        del self.seq_lens[seq_id]
+
+    def fork_sequence(self, src_seq_id, seq_id, num_tokens):
+        """
+        Creates a sequence holding the first `num_tokens` positions of another sequence.
+        Full blocks are shared; the trailing partial block, if any, is copied, so that
+        shared blocks are never written again.
+        """
+        if num_tokens > self.seq_lens[src_seq_id]:
+            raise ValueError(f"Cannot fork {num_tokens} tokens of a sequence of length {self.seq_lens[src_seq_id]}.")
+        self.add_sequence(seq_id)
+        src_table, block_table = self.block_tables[src_seq_id], self.block_tables[seq_id]
+        num_full_blocks, rest = divmod(num_tokens, self.block_size)
+        for block in src_table[:num_full_blocks]:
+            self.allocator.share(block)
+            block_table.append(block)
+        if rest > 0:
+            block = self.allocator.allocate()
+            src = src_table[num_full_blocks] * self.block_size
+            dst = block * self.block_size
+            for cache in self.key_cache + self.value_cache:
+                cache[dst:dst + rest] = cache[src:src + rest]
+            block_table.append(block)
+        self.seq_lens[seq_id] = num_tokens
+
+    def blocks_needed(self, seq_id, num_tokens):
+        """Number of new blocks a sequence needs to grow by `num_tokens`."""
+        seq_len = self.seq_lens.get(seq_id, 0)
+        num_blocks = len(self.block_tables.get(seq_id, []))
+        return max(0, -(-(seq_len + num_tokens) // self.block_size) - num_blocks)
+
+    def can_allocate(self, num_tokens_per_seq):
+        return sum(self.blocks_needed(seq_id, n) for seq_id, n in num_tokens_per_seq.items()) <= self.allocator.num_free_blocks
+
+    def _reserve(self, seq_id, num_tokens):
+        block_table = self.block_tables[seq_id]
+        for _ in range(self.blocks_needed(seq_id, num_tokens)):
+            block_table.append(self.allocator.allocate())
+
+    # forward pass
+
+    def begin_forward(self, seq_ids, num_new_tokens, input_length):
+        """
+        Prepares the cache for a forward pass over `input_length` positions.
+
+        Args:
+            seq_ids (list): The sequence of each batch row.
+            num_new_tokens (list): The number of new (non-padding) trailing positions of each row.
+            input_length (int): The sequence length of the forward inputs.
+        """
+        old_lens = [self.seq_lens[seq_id] for seq_id in seq_ids]
+        new_lens = [old + n for old, n in zip(old_lens, num_new_tokens)]
+        total_length = max(new_lens)
+        for seq_id, n, new_len in zip(seq_ids, num_new_tokens, new_lens):
+            self._reserve(seq_id, n)
+            self.seq_lens[seq_id] = new_len
+
+        max_blocks = max(len(self.block_tables[seq_id]) for seq_id in seq_ids)
+        block_tables = torch.tensor([self.block_tables[seq_id] + [0] * (max_blocks - len(self.block_tables[seq_id])) for seq_id in seq_ids], dtype=torch.long)
+        old_lens = torch.tensor(old_lens, dtype=torch.long)
+        new_lens = torch.tensor(new_lens, dtype=torch.long)
+        num_new_tokens = torch.tensor(num_new_tokens, dtype=torch.long)
+
+        def to_slots(rows, positions):
+            return block_tables[rows, positions // self.block_size] * self.block_size + positions % self.block_size
+
+        # the trailing `n` input positions of each row are written at positions [old_len, new_len) of its sequence
+        rows = torch.arange(len(seq_ids), dtype=torch.long).repeat_interleave(num_new_tokens)
+        offsets = torch.arange(rows.shape[0], dtype=torch.long) - (num_new_tokens.cumsum(0) - num_new_tokens).repeat_interleave(num_new_tokens)
+        cols = input_length - num_new_tokens[rows] + offsets
+        write_slots = to_slots(rows, old_lens[rows] + offsets)
+
+        # keys are read right-aligned; padded positions read slot 0 and are masked out by `attention_mask`
+        positions = torch.arange(total_length, dtype=torch.long)[None] - (total_length - new_lens)[:, None]
+        read_index = to_slots(torch.arange(len(seq_ids))[:, None], positions.clamp(min=0))
+        read_index = read_index.masked_fill(positions < 0, 0)
+
+        self._batch = {
+            "rows": rows.to(self.device),
+            "cols": cols.to(self.device),
+            "write_slots": write_slots.to(self.device),
+            "read_index": read_index.to(self.device),
+            "lengths": new_lens.to(self.device),
+        }
+        self._past_length = total_length - input_length
+        self.seen_tokens += input_length
+
+    def attention_mask(self):
+        """The (batch_size, total_length) mask matching the keys returned by `update`."""
+        read_index = self._batch["read_index"]
+        total_length = read_index.shape[1]
+        positions = torch.arange(total_length, device=read_index.device)
+        return (positions[None] >= total_length - self._batch["lengths"][:, None]).long()
+
+    def position_ids(self, input_length):
+        """Position ids of the forward inputs; left-padded positions are clamped to 0."""
+        lengths = self._batch["lengths"]
+        positions = torch.arange(input_length, device=lengths.device)
+        return (lengths[:, None] - input_length + positions[None]).clamp(min=0)
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        batch = self._batch
+        rows, cols = batch["rows"], batch["cols"]
+        # (batch, heads, seq, dim) -> (num_new_tokens, heads, dim)
+        self.key_cache[layer_idx][batch["write_slots"]] = key_states.transpose(1, 2)[rows, cols].to(self.dtype)
+        self.value_cache[layer_idx][batch["write_slots"]] = value_states.transpose(1, 2)[rows, cols].to(self.dtype)
+
+        keys = self.key_cache[layer_idx][batch["read_index"]].transpose(1, 2)
+        values = self.value_cache[layer_idx][batch["read_index"]].transpose(1, 2)
+        return keys.to(key_states.dtype), values.to(value_states.dtype)
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        return self._past_length
+
+    def get_max_length(self) -> Optional[int]:
+        return None
+
+    # metrics
+
+    @property
+    def stats(self):
+        used_blocks = self.num_blocks - self.allocator.num_free_blocks
+        # shared blocks are counted once
+        block_fill = {}
+        for seq_id, block_table in self.block_tables.items():
+            seq_len = self.seq_lens[seq_id]
+            for i, block in enumerate(block_table):
+                fill = min(self.block_size, max(0, seq_len - i * self.block_size))
+                block_fill[block] = max(block_fill.get(block, 0), fill)
+        used_slots = sum(block_fill.values())
+        return {
+            "num_blocks": self.num_blocks,
+            "block_size": self.block_size,
+            "used_blocks": used_blocks,
+            "free_blocks": self.allocator.num_free_blocks,
+            "num_sequences": len(self.block_tables),
+            "block_utilization": used_blocks / self.num_blocks if self.num_blocks > 0 else 0.0,
+            # share of the allocated slots that are not filled (only the last block of each sequence can be partial)
+            "fragmentation": 1 - used_slots / (used_blocks * self.block_size) if used_blocks > 0 else 0.0,
+        }
+
+
+def common_prefix_length(units, other_units):
+    """Number of positions covered by the common leading units of two prefixes."""
+    length = 0
+    for unit, other in zip(units, other_units):
+        if unit != other:
+            break
+        length += unit[1]
+    return length
+
+
+class PrefixCache:
+    """
+    LRU set of finished sequences whose KV states are kept in a `PagedKVCache`,
+    so that new requests starting with the same prefix (e.g. the next turn of a
+    conversation with the same image and system prompt) only prefill the rest.
+
+    A prefix is a list of `(key, length)` units covering consecutive positions of
+    the input embeddings, compared as a whole: e.g. one unit per text token, keyed
+    by its id, and one unit for the image features, keyed by the image digests.
+    """
+
+    def __init__(self, kv_cache, max_entries=64):
+        self.kv_cache = kv_cache
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # seq_id -> units
+
+        self.lookups = 0
+        self.hits = 0
+        self.reused_tokens = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def match(self, units):
+        """Returns the cached sequence sharing the longest prefix with `units`, and the prefix length."""
+        best_seq_id, best_length = None, 0
+        for seq_id, cached_units in self.entries.items():
+            length = common_prefix_length(units, cached_units)
+            if length > best_length:
+                best_seq_id, best_length = seq_id, length
+        return best_seq_id, best_length
+
+    def fork(self, src_seq_id, seq_id, num_tokens):
+        """Starts `seq_id` with the first `num_tokens` positions of a cached sequence (none if `src_seq_id` is None)."""
+        self.lookups += 1
+        if src_seq_id is None or num_tokens <= 0:
+            self.kv_cache.add_sequence(seq_id)
+            return
+        self.kv_cache.fork_sequence(src_seq_id, seq_id, num_tokens)
+        self.entries.move_to_end(src_seq_id)
+        self.hits += 1
+        self.reused_tokens += num_tokens
+
+    def insert(self, seq_id, units):
+        """Keeps a finished sequence of the KV cache; `units` must cover its positions."""
+        self.entries[seq_id] = units
+        while len(self.entries) > self.max_entries:
+            self.evict()
+
+    def evict(self, exclude=None):
+        """Frees the least recently used sequence other than `exclude`. Returns False if there is none."""
+        for seq_id in self.entries:
+            if seq_id != exclude:
+                del self.entries[seq_id]
+                self.kv_cache.free_sequence(seq_id)
+                return True
+        return False
+
+    def clear(self):
+        for seq_id in self.entries:
+            self.kv_cache.free_sequence(seq_id)
+        self.entries.clear()
+
+    @property
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups > 0 else 0.0,
+            "reused_tokens": self.reused_tokens,
+        }
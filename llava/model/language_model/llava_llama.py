@@ -25,6 +25,7 @@
 from transformers.generation.utils import GenerateOutput
 
 from ..llava_arch import LlavaMetaModel, LlavaMetaForCausalLM
+from ..speculative import speculative_generate
 
 
 class LlavaConfig(LlamaConfig):
@@ -111,8 +112,11 @@ def generate(
     ) -> Union[GenerateOutput, torch.LongTensor]:
         position_ids = kwargs.pop("position_ids", None)
         attention_mask = kwargs.pop("attention_mask", None)
+        # a `Drafter` from llava.model.speculative enables speculative decoding (greedy, batch size 1)
+        drafter = kwargs.pop("drafter", None)
         if "inputs_embeds" in kwargs:
             raise NotImplementedError("`inputs_embeds` is not supported")
+        prompt_ids = inputs
 
         if images is not None:
             (
@@ -134,6 +138,16 @@ def generate(
         else:
             inputs_embeds = self.get_model().embed_tokens(inputs)
 
+        if drafter is not None:
+            return speculative_generate(
+                self,
+                inputs_embeds,
+                drafter,
+                prompt_ids=prompt_ids,
+                attention_mask=attention_mask,
+                **kwargs
+            )
+
         return super().generate(
             position_ids=position_ids,
             attention_mask=attention_mask,
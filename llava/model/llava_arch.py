@@ -17,19 +17,27 @@
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from .multimodal_encoder.builder import build_vision_tower
 from .multimodal_projector.builder import build_vision_projector
+from .feature_cache import ImageFeatureCache, get_feature_namespace
+from .token_reduction import reduce_grid, reduce_sequence
 
 from llava.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_PATCH_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
 
-from llava.mm_utils import get_anyres_image_grid_shape
+from llava.mm_utils import get_anyres_planner, get_token_reduction, count_image_tokens, projector_grid_side, TokenReduction
 
 
 class LlavaMetaModel:
 
     def __init__(self, config):
         super(LlavaMetaModel, self).__init__(config)
+        self.image_feature_cache = None
+        # When set, `images` already are the selected vision tower features (see llava/train/feature_store.py).
+        self.use_precomputed_image_features = False
+        # image features before and after `mm_token_reduction`
+        self.token_reduction_stats = {"images": 0, "tokens": 0, "reduced_tokens": 0}
 
         if hasattr(config, "mm_vision_tower"):
             self.vision_tower = build_vision_tower(config, delay_load=True)
@@ -46,6 +54,15 @@ def get_vision_tower(self):
             vision_tower = vision_tower[0]
         return vision_tower
 
+    def enable_image_feature_cache(self, max_entries=256, device=None, disk_dir=None, max_disk_entries=None):
+        self.image_feature_cache = ImageFeatureCache(
+            max_entries=max_entries,
+            device=device,
+            disk_dir=disk_dir,
+            max_disk_entries=max_disk_entries,
+        )
+        return self.image_feature_cache
+
     def initialize_vision_modules(self, model_args, fsdp=None):
         vision_tower = model_args.vision_tower
         mm_vision_select_layer = model_args.mm_vision_select_layer
@@ -75,6 +92,7 @@ def initialize_vision_modules(self, model_args, fsdp=None):
         self.config.mm_vision_select_layer = mm_vision_select_layer
         self.config.mm_vision_select_feature = mm_vision_select_feature
         self.config.mm_patch_merge_type = mm_patch_merge_type
+        self.config.mm_token_reduction = getattr(model_args, 'mm_token_reduction', None)
 
         if getattr(self, 'mm_projector', None) is None:
             self.mm_projector = build_vision_projector(self.config)
@@ -97,37 +115,6 @@ def get_w(weights, keyword):
             self.mm_projector.load_state_dict(get_w(mm_projector_weights, 'mm_projector'))
 
 
-def unpad_image(tensor, original_size):
-    """
-    Unpads a PyTorch tensor of a padded and resized image.
-
-    Args:
-    tensor (torch.Tensor): The image tensor, assumed to be in CxHxW format.
-    original_size (tuple): The original size of PIL image (width, height).
-
-    Returns:
-    torch.Tensor: The unpadded image tensor.
-    """
-    original_width, original_height = original_size
-    current_height, current_width = tensor.shape[1:]
-
-    original_aspect_ratio = original_width / original_height
-    current_aspect_ratio = current_width / current_height
-
-    if original_aspect_ratio > current_aspect_ratio:
-        scale_factor = current_width / original_width
-        new_height = int(original_height * scale_factor)
-        padding = (current_height - new_height) // 2
-        unpadded_tensor = tensor[:, padding:current_height - padding, :]
-    else:
-        scale_factor = current_height / original_height
-        new_width = int(original_width * scale_factor)
-        padding = (current_width - new_width) // 2
-        unpadded_tensor = tensor[:, :, padding:current_width - padding]
-
-    return unpadded_tensor
-
-
 class LlavaMetaForCausalLM(ABC):
 
     @abstractmethod
@@ -138,9 +125,54 @@ def get_vision_tower(self):
         return self.get_model().get_vision_tower()
 
     def encode_images(self, images):
-        image_features = self.get_model().get_vision_tower()(images)
-        image_features = self.get_model().mm_projector(image_features)
-        return image_features
+        if getattr(self.get_model(), 'use_precomputed_image_features', False):
+            # the feature store keeps fp16 features, whatever the dtype of the projector
+            projector_param = next(self.get_model().mm_projector.parameters())
+            images = images.to(device=projector_param.device, dtype=projector_param.dtype)
+            return self.get_model().mm_projector(images)
+
+        image_feature_cache = getattr(self.get_model(), 'image_feature_cache', None)
+        if image_feature_cache is None or self.training:
+            image_features = self.get_model().get_vision_tower()(images)
+            image_features = self.get_model().mm_projector(image_features)
+            return image_features
+
+        # Only the images that are not cached go through the vision tower and the projector.
+        if image_feature_cache.namespace is None:
+            image_feature_cache.namespace = get_feature_namespace(self.get_model())
+        keys = [image_feature_cache.make_key(image) for image in images]
+        image_features = [image_feature_cache.get(key) for key in keys]
+        missing = [i for i, x in enumerate(image_features) if x is None]
+        if len(missing) > 0:
+            new_image_features = self.get_model().get_vision_tower()(images[missing])
+            new_image_features = self.get_model().mm_projector(new_image_features)
+            for i, image_feature in zip(missing, new_image_features):
+                image_feature_cache.put(keys[i], image_feature)
+                image_features[i] = image_feature
+        image_features = [x.to(device=self.device) for x in image_features]
+        return torch.stack(image_features, dim=0)
+
+    def reduce_image_features(self, image_features, image_sizes, token_reduction):
+        """Applies the sequential token reduction to the merged features of every image, and counts the reduction."""
+        image_newline = getattr(self.get_model(), 'image_newline', None)
+        if 'unpad' not in getattr(self.config, 'mm_patch_merge_type', 'flat'):
+            image_newline = None
+        reduced_features = []
+        for image_feature in image_features:
+            protected = None
+            if image_newline is not None:
+                protected = (image_feature == image_newline.to(image_feature.dtype)).all(dim=-1)
+            reduced_features.append(reduce_sequence(image_feature, token_reduction, protected))
+
+        stats = self.get_model().token_reduction_stats
+        no_reduction = TokenReduction(None, None)
+        stats["images"] += len(image_features)
+        stats["tokens"] += sum(
+            count_image_tokens(image_sizes[i] if image_sizes is not None else None,
+                               self.config, self.get_vision_tower(), no_reduction)
+            for i in range(len(image_features)))
+        stats["reduced_tokens"] += sum(x.shape[0] for x in reduced_features)
+        return reduced_features
 
     def prepare_inputs_labels_for_multimodal(
         self, input_ids, position_ids, attention_mask, past_key_values, labels,
@@ -150,11 +182,12 @@ def prepare_inputs_labels_for_multimodal(
         if vision_tower is None or images is None or input_ids.shape[1] == 1:
             return input_ids, position_ids, attention_mask, past_key_values, None, labels
 
+        token_reduction = get_token_reduction(self.config)
         if type(images) is list or images.ndim == 5:
             if type(images) is list:
                 images = [x.unsqueeze(0) if x.ndim == 3 else x for x in images]
             concat_images = torch.cat([image for image in images], dim=0)
-            image_features = self.encode_images(concat_images)
+            image_features = reduce_grid(self.encode_images(concat_images), token_reduction)
             split_sizes = [image.shape[0] for image in images]
             image_features = torch.split(image_features, split_sizes, dim=0)
             mm_patch_merge_type = getattr(self.config, 'mm_patch_merge_type', 'flat')
@@ -167,17 +200,23 @@ def prepare_inputs_labels_for_multimodal(
                     if image_feature.shape[0] > 1:
                         base_image_feature = image_feature[0]
                         image_feature = image_feature[1:]
-                        height = width = self.get_vision_tower().num_patches_per_side
+                        # the projector and the token reduction may shrink the feature grid of every patch
+                        height = width = token_reduction.grid_side(projector_grid_side(
+                            getattr(self.config, 'mm_projector_type', 'linear'), self.get_vision_tower().num_patches_per_side))
                         assert height * width == base_image_feature.shape[0]
                         if image_aspect_ratio == 'anyres':
-                            num_patch_width, num_patch_height = get_anyres_image_grid_shape(image_sizes[image_idx], self.config.image_grid_pinpoints, self.get_vision_tower().config.image_size)
+                            plan = get_anyres_planner(
+                                self.config.image_grid_pinpoints, self.get_vision_tower().config.image_size,
+                                height, mm_patch_merge_type).plan(image_sizes[image_idx])
+                            num_patch_width, num_patch_height = plan.grid_shape
                             image_feature = image_feature.view(num_patch_height, num_patch_width, height, width, -1)
                         else:
                             raise NotImplementedError
                         if 'unpad' in mm_patch_merge_type:
                             image_feature = image_feature.permute(4, 0, 2, 1, 3).contiguous()
                             image_feature = image_feature.flatten(1, 2).flatten(2, 3)
-                            image_feature = unpad_image(image_feature, image_sizes[image_idx])
+                            top, bottom, left, right = plan.unpad_box
+                            image_feature = image_feature[:, top:bottom, left:right]
                             image_feature = torch.cat((
                                 image_feature,
                                 self.model.image_newline[:, None, None].expand(*image_feature.shape[:-1], 1).to(image_feature.device)
@@ -199,7 +238,10 @@ def prepare_inputs_labels_for_multimodal(
             else:
                 raise ValueError(f"Unexpected mm_patch_merge_type: {self.config.mm_patch_merge_type}")
         else:
-            image_features = self.encode_images(images)
+            image_features = reduce_grid(self.encode_images(images), token_reduction)
+
+        if token_reduction.method is not None:
+            image_features = self.reduce_image_features(image_features, image_sizes, token_reduction)
 
         # TODO: image start / end is not implemented here to support pretraining.
         if getattr(self.config, 'tune_mm_mlp_adapter', False) and getattr(self.config, 'mm_use_im_start_end', False):
@@ -221,8 +263,37 @@ def prepare_inputs_labels_for_multimodal(
         if labels is None:
             labels = torch.full_like(input_ids, IGNORE_INDEX)
 
+        if getattr(self.config, 'sequence_packing', False) and self.training and _attention_mask is not None:
+            # packed batches carry the sample index of every token in the attention mask (see llava/train/packing.py)
+            new_input_embeds, new_labels, attention_mask, position_ids = self.merge_multimodal_inputs_batched(
+                input_ids, attention_mask, position_ids, labels, image_features, segment_ids=_attention_mask)
+        else:
+            if getattr(self.config, 'mm_batched_merge', True):
+                merge_inputs = self.merge_multimodal_inputs_batched
+            else:
+                merge_inputs = self.merge_multimodal_inputs_loop
+            new_input_embeds, new_labels, attention_mask, position_ids = merge_inputs(
+                input_ids, attention_mask, position_ids, labels, image_features)
+
+        if _labels is None:
+            new_labels = None
+
+        if _attention_mask is None:
+            attention_mask = None
+        else:
+            attention_mask = attention_mask.to(dtype=_attention_mask.dtype)
+
+        if _position_ids is None:
+            position_ids = None
+
+        return None, position_ids, attention_mask, past_key_values, new_input_embeds, new_labels
+
+    def merge_multimodal_inputs_loop(self, input_ids, attention_mask, position_ids, labels, image_features):
+        """
+        Replaces the image tokens with their image features and pads the batch, one sample at a time.
+        Reference implementation of `merge_multimodal_inputs_batched`.
+        """
         # remove the padding using attention_mask -- FIXME
-        _input_ids = input_ids
         input_ids = [cur_input_ids[cur_attention_mask] for cur_input_ids, cur_attention_mask in zip(input_ids, attention_mask)]
         labels = [cur_labels[cur_attention_mask] for cur_labels, cur_attention_mask in zip(labels, attention_mask)]
 
@@ -308,20 +379,111 @@ def prepare_inputs_labels_for_multimodal(
 
         new_input_embeds = torch.stack(new_input_embeds_padded, dim=0)
 
-        if _labels is None:
-            new_labels = None
+        return new_input_embeds, new_labels_padded, attention_mask, position_ids
+
+    def merge_multimodal_inputs_batched(self, input_ids, attention_mask, position_ids, labels, image_features, segment_ids=None):
+        """
+        Same as `merge_multimodal_inputs_loop`, for the whole batch at once: the output
+        position of every text token and image feature is computed on the device, and
+        the embeddings and labels are scattered into the padded outputs. The only host
+        sync is reading the output length.
+
+        If `segment_ids` (the sample index of every token of a packed batch) is given,
+        the returned attention mask holds the sample index of every output position,
+        and the position ids restart at every sample.
+        """
+        batch_size, seq_len = input_ids.shape
+        device = input_ids.device
+        if type(image_features) is list or type(image_features) is tuple:
+            feature_lens = [x.shape[0] for x in image_features]
+            image_features = torch.cat(list(image_features), dim=0)
         else:
-            new_labels = new_labels_padded
-
-        if _attention_mask is None:
-            attention_mask = None
+            feature_lens = [image_features.shape[1]] * image_features.shape[0]
+            image_features = image_features.flatten(0, 1)
+        num_images = len(feature_lens)
+
+        is_image = (input_ids == IMAGE_TOKEN_INDEX) & attention_mask
+        is_text = attention_mask & ~is_image
+        text_embeds = self.get_model().embed_tokens(torch.where(is_text, input_ids, torch.zeros_like(input_ids)))
+        embeds_dtype = torch.promote_types(text_embeds.dtype, image_features.dtype)
+        image_features = image_features.to(device=text_embeds.device)
+
+        # global index of the image of every image token; samples without image tokens still consume one image
+        image_counts = is_image.long().sum(1)
+        image_offsets = image_counts.clamp(min=1).cumsum(0) - image_counts.clamp(min=1)
+        image_index = image_offsets[:, None] + is_image.long().cumsum(1) - 1
+        image_index = torch.where(is_image, image_index, torch.full_like(image_index, num_images)).clamp(max=num_images)
+
+        # output length of every input position, and where it starts in its row
+        feature_lens_t = torch.tensor(feature_lens + [0], dtype=torch.long, device=device)
+        spans = torch.where(is_image, feature_lens_t[image_index], is_text.long())
+        starts = spans.cumsum(1) - spans
+        lengths = spans.sum(1)
+        tokenizer_model_max_length = getattr(self.config, 'tokenizer_model_max_length', None)
+        if tokenizer_model_max_length is not None:
+            lengths = lengths.clamp(max=tokenizer_model_max_length)
+        max_len = int(lengths.max())
+        if segment_ids is not None:
+            # transformers drops a flash attention mask without padding, which would let packed samples attend to each other
+            max_len += 1
+
+        if getattr(self.config, 'tokenizer_padding_side', 'right') == "left":
+            pad = max_len - lengths
         else:
-            attention_mask = attention_mask.to(dtype=_attention_mask.dtype)
-
-        if _position_ids is None:
-            position_ids = None
-
-        return None, position_ids, attention_mask, past_key_values, new_input_embeds, new_labels
+            pad = torch.zeros_like(lengths)
+        # flat output index of every position; dropped positions go to an extra row at the end
+        dummy = batch_size * max_len
+        rows = torch.arange(batch_size, device=device)[:, None]
+        text_dest = rows * max_len + pad[:, None] + starts
+        text_dest = torch.where(is_text & (starts < lengths[:, None]), text_dest, torch.full_like(text_dest, dummy))
+
+        new_input_embeds = torch.zeros((dummy + 1, text_embeds.shape[-1]), dtype=embeds_dtype, device=text_embeds.device)
+        new_input_embeds[text_dest.view(-1).to(text_embeds.device)] = text_embeds.view(-1, text_embeds.shape[-1]).to(embeds_dtype)
+
+        if image_features.shape[0] > 0:
+            # row and start of every image in the output (-1 for images without a token)
+            image_rows = torch.full((num_images + 1,), -1, dtype=torch.long, device=device)
+            image_rows.scatter_(0, image_index.view(-1), rows.expand(batch_size, seq_len).reshape(-1))
+            image_starts = torch.zeros((num_images + 1,), dtype=torch.long, device=device)
+            image_starts.scatter_(0, image_index.view(-1), starts.view(-1))
+            image_rows[num_images] = -1
+            if segment_ids is not None:
+                image_segments = torch.zeros((num_images + 1,), dtype=torch.long, device=device)
+                image_segments.scatter_(0, image_index.view(-1), segment_ids.long().reshape(-1))
+
+            feature_image = torch.repeat_interleave(
+                torch.arange(num_images, device=device), feature_lens_t[:-1], output_size=image_features.shape[0])
+            feature_starts = feature_lens_t[:-1].cumsum(0) - feature_lens_t[:-1]
+            feature_pos = image_starts[feature_image] + torch.arange(image_features.shape[0], device=device) - feature_starts[feature_image]
+            feature_rows = image_rows[feature_image]
+            valid = (feature_rows >= 0) & (feature_pos < lengths[feature_rows.clamp(min=0)])
+            feature_dest = feature_rows * max_len + pad[feature_rows.clamp(min=0)] + feature_pos
+            feature_dest = torch.where(valid, feature_dest, torch.full_like(feature_dest, dummy))
+            new_input_embeds[feature_dest.to(text_embeds.device)] = image_features.to(embeds_dtype)
+        new_input_embeds = new_input_embeds[:dummy].view(batch_size, max_len, -1)
+
+        new_labels = torch.full((dummy + 1,), IGNORE_INDEX, dtype=labels.dtype, device=labels.device)
+        new_labels[text_dest.view(-1).to(labels.device)] = labels.reshape(-1)
+        new_labels = new_labels[:dummy].view(batch_size, max_len)
+
+        if segment_ids is not None:
+            new_segments = torch.zeros((dummy + 1,), dtype=torch.long, device=device)
+            new_segments[text_dest.view(-1)] = segment_ids.long().reshape(-1)
+            if image_features.shape[0] > 0:
+                new_segments[feature_dest] = image_segments[feature_image]
+            new_segments = new_segments[:dummy].view(batch_size, max_len)
+            # position of every output position within its sample
+            columns = torch.arange(max_len, device=device)[None].expand(batch_size, max_len)
+            is_first = new_segments != F.pad(new_segments[:, :-1], (1, 0), value=-1)
+            sample_starts = torch.where(is_first, columns, torch.zeros_like(columns)).cummax(dim=1).values
+            new_position_ids = torch.where(new_segments > 0, columns - sample_starts, torch.zeros_like(columns))
+            return new_input_embeds, new_labels, new_segments.to(attention_mask.device), new_position_ids.to(device=position_ids.device, dtype=position_ids.dtype)
+
+        positions = torch.arange(max_len, device=device)[None] - pad[:, None]
+        new_attention_mask = (positions >= 0) & (positions < lengths[:, None])
+        new_position_ids = torch.where(new_attention_mask, positions, torch.zeros_like(positions)).to(position_ids.dtype)
+        new_attention_mask = new_attention_mask.to(dtype=attention_mask.dtype)
+        return new_input_embeds, new_labels, new_attention_mask, new_position_ids.to(position_ids.device)
 
     def initialize_vision_tokenizer(self, model_args, tokenizer):
         if model_args.mm_use_im_patch_token:
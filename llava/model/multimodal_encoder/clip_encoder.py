@@ -4,6 +4,33 @@
 from transformers import CLIPVisionModel, CLIPImageProcessor, CLIPVisionConfig
 
 
+def forward_in_micro_batches(forward, images, micro_batch_size=0):
+    """
+    Runs `forward` on a batch of images, `micro_batch_size` images at a time
+    (all at once if 0), and concatenates the features.
+    """
+    if micro_batch_size <= 0 or images.shape[0] <= micro_batch_size:
+        return forward(images)
+    return torch.cat([forward(batch) for batch in images.split(micro_batch_size)], dim=0)
+
+
+def forward_in_buckets(forward, images, micro_batch_size=0):
+    """
+    Runs `forward` on a list of images: the images of the same shape and dtype are
+    stacked and run as one batch, `micro_batch_size` at a time (all at once if 0).
+    Returns the features of each image, with a batch dimension of 1, in the order of `images`.
+    """
+    buckets = {}
+    for i, image in enumerate(images):
+        buckets.setdefault((tuple(image.shape), image.dtype), []).append(i)
+    image_features = [None] * len(images)
+    for indices in buckets.values():
+        batch_features = forward_in_micro_batches(forward, torch.stack([images[i] for i in indices]), micro_batch_size)
+        for i, image_feature in zip(indices, batch_features.split(1)):
+            image_features[i] = image_feature
+    return image_features
+
+
 class CLIPVisionTower(nn.Module):
     def __init__(self, vision_tower, args, delay_load=False):
         super().__init__()
@@ -13,6 +40,10 @@ def __init__(self, vision_tower, args, delay_load=False):
         self.vision_tower_name = vision_tower
         self.select_layer = args.mm_vision_select_layer
         self.select_feature = getattr(args, 'mm_vision_select_feature', 'patch')
+        # caps the number of images per forward of the vision model; 0 runs the whole batch at once
+        self.micro_batch_size = getattr(args, 'mm_vision_micro_batch_size', 0)
+        # runs the encoder only up to the selected layer, instead of all layers with every hidden state
+        self.truncate_layers = getattr(args, 'mm_vision_truncate_layers', True)
 
         if not delay_load:
             self.load_model()
@@ -33,7 +64,9 @@ def load_model(self, device_map=None):
         self.is_loaded = True
 
     def feature_select(self, image_forward_outs):
-        image_features = image_forward_outs.hidden_states[self.select_layer]
+        return self.token_select(image_forward_outs.hidden_states[self.select_layer])
+
+    def token_select(self, image_features):
         if self.select_feature == 'patch':
             image_features = image_features[:, 1:]
         elif self.select_feature == 'cls_patch':
@@ -42,17 +75,44 @@ def feature_select(self, image_forward_outs):
             raise ValueError(f'Unexpected select feature: {self.select_feature}')
         return image_features
 
+    @property
+    def num_selected_layers(self):
+        """Number of encoder layers that `hidden_states[select_layer]` goes through."""
+        if self.select_layer < 0:
+            return self.config.num_hidden_layers + 1 + self.select_layer
+        return self.select_layer
+
+    def forward_selected_layer(self, images):
+        """
+        The hidden states of the selected layer, computed as by `CLIPVisionTransformer`
+        but without the layers after it, and without keeping the other hidden states.
+        """
+        vision_model = self.vision_tower.vision_model
+        encoder = vision_model.encoder
+        hidden_states = vision_model.pre_layrnorm(vision_model.embeddings(images))
+        for encoder_layer in encoder.layers[:self.num_selected_layers]:
+            if encoder.gradient_checkpointing and encoder.training:
+                layer_outputs = encoder._gradient_checkpointing_func(encoder_layer.__call__, hidden_states, None, None, False)
+            else:
+                layer_outputs = encoder_layer(hidden_states, None, None)
+            hidden_states = layer_outputs[0]
+        return hidden_states
+
+    @torch.no_grad()
+    def forward_feature(self, images):
+        if self.truncate_layers:
+            image_features = self.forward_selected_layer(images.to(device=self.device, dtype=self.dtype))
+            return self.token_select(image_features).to(images.dtype)
+        image_forward_outs = self.vision_tower(images.to(device=self.device, dtype=self.dtype), output_hidden_states=True)
+        image_features = self.feature_select(image_forward_outs).to(images.dtype)
+        return image_features
+
     @torch.no_grad()
     def forward(self, images):
         if type(images) is list:
-            image_features = []
-            for image in images:
-                image_forward_out = self.vision_tower(image.to(device=self.device, dtype=self.dtype).unsqueeze(0), output_hidden_states=True)
-                image_feature = self.feature_select(image_forward_out).to(image.dtype)
-                image_features.append(image_feature)
+            image_features = forward_in_buckets(self.forward_feature, images, self.micro_batch_size)
         else:
-            image_forward_outs = self.vision_tower(images.to(device=self.device, dtype=self.dtype), output_hidden_states=True)
-            image_features = self.feature_select(image_forward_outs).to(images.dtype)
+            image_features = forward_in_micro_batches(self.forward_feature, images, self.micro_batch_size)
 
         return image_features
 
@@ -125,20 +185,16 @@ def load_model(self, device_map=None):
         self.is_loaded = True
 
     @torch.no_grad()
-    def forward_feature(self, images):
-        image_forward_outs = self.vision_tower(images.to(device=self.device, dtype=self.dtype), output_hidden_states=True)
-        image_features = self.feature_select(image_forward_outs).to(images.dtype)
-        return image_features
+    def forward_multiscale(self, images):
+        return self.multiscale_forward(self.forward_feature, images, img_sizes=self.s2_scales, max_split_size=self.s2_split_size)
 
     @torch.no_grad()
     def forward(self, images):
+        # the micro-batches count images; every image runs through the vision model at all scales
         if type(images) is list:
-            image_features = []
-            for image in images:
-                image_feature = self.multiscale_forward(self.forward_feature, image.unsqueeze(0), img_sizes=self.s2_scales, max_split_size=self.s2_split_size)
-                image_features.append(image_feature)
+            image_features = forward_in_buckets(self.forward_multiscale, images, self.micro_batch_size)
         else:
-            image_features = self.multiscale_forward(self.forward_feature, images, img_sizes=self.s2_scales, max_split_size=self.s2_split_size)
+            image_features = forward_in_micro_batches(self.forward_multiscale, images, self.micro_batch_size)
 
         return image_features
 
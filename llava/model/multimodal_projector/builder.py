@@ -1,5 +1,7 @@
+import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import re
 
 
@@ -30,6 +32,90 @@ def forward(self, x):
         return x + self.proj(x)
 
 
+def get_2d_sincos_pos_embed(dim, side, ref_side=None, device=None):
+    """
+    Fixed 2D sin-cos positions of a square grid of `side` x `side` features, in the
+    coordinates of a grid of `ref_side` x `ref_side`, so that grids of different sizes align.
+    """
+    ref_side = side if ref_side is None else ref_side
+    coords = (torch.arange(side, dtype=torch.float32, device=device) + 0.5) * (ref_side / side) - 0.5
+    omega = 1.0 / 10000 ** (torch.arange(dim // 4, dtype=torch.float32, device=device) / (dim // 4))
+    grid_y, grid_x = torch.meshgrid(coords, coords, indexing='ij')
+    out_y = grid_y.flatten()[:, None] * omega[None]
+    out_x = grid_x.flatten()[:, None] * omega[None]
+    pos_embed = torch.cat((out_y.sin(), out_y.cos(), out_x.sin(), out_x.cos()), dim=1)
+    return F.pad(pos_embed, (0, dim - pos_embed.shape[1]))
+
+
+class DownsampleProjector(nn.Module):
+    """
+    Shrinks the square grid of vision features by `factor` per side with a pixel
+    shuffle (every factor x factor block of features is concatenated into one),
+    then maps the features to the LLM with an MLP. Grids that are not a multiple
+    of `factor` are padded with zeros.
+    """
+
+    def __init__(self, mm_hidden_size, hidden_size, factor, mlp_depth):
+        super().__init__()
+        self.factor = factor
+        modules = [nn.Linear(mm_hidden_size * factor * factor, hidden_size)]
+        for _ in range(1, mlp_depth):
+            modules.append(nn.GELU())
+            modules.append(nn.Linear(hidden_size, hidden_size))
+        self.mlp = nn.Sequential(*modules)
+
+    def forward(self, x):
+        num_images, num_tokens, dim = x.shape
+        side = math.isqrt(num_tokens)
+        if side * side != num_tokens:
+            raise ValueError(f"The downsample projector needs a square grid of features, got {num_tokens} "
+                             "(mm_vision_select_feature must be 'patch').")
+        factor = self.factor
+        x = x.view(num_images, side, side, dim)
+        padding = (-side) % factor
+        if padding > 0:
+            x = F.pad(x, (0, 0, 0, padding, 0, padding))
+        new_side = (side + padding) // factor
+        x = x.view(num_images, new_side, factor, new_side, factor, dim)
+        x = x.permute(0, 1, 3, 2, 4, 5).reshape(num_images, new_side * new_side, factor * factor * dim)
+        return self.mlp(x)
+
+
+class Resampler(nn.Module):
+    """
+    Cross-attention of `num_queries` learned queries to the vision features, with
+    fixed 2D positions on both: the queries are placed on a square grid over the
+    input grid. Every image, or patch of an anyres image, comes out as
+    `num_queries` features, which the `spatial` merges treat as that square grid.
+    """
+
+    def __init__(self, mm_hidden_size, hidden_size, num_queries, head_dim=128):
+        super().__init__()
+        self.num_queries = num_queries
+        self.query = nn.Parameter(torch.randn(num_queries, hidden_size) * 0.02)
+        self.kv_proj = nn.Linear(mm_hidden_size, hidden_size)
+        self.ln_q = nn.LayerNorm(hidden_size)
+        self.ln_kv = nn.LayerNorm(hidden_size)
+        self.attn = nn.MultiheadAttention(hidden_size, max(1, hidden_size // head_dim), batch_first=True)
+        self.ln_post = nn.LayerNorm(hidden_size)
+        self.proj = nn.Linear(hidden_size, hidden_size)
+
+    def forward(self, x):
+        num_images, num_tokens, _ = x.shape
+        kv = self.ln_kv(self.kv_proj(x))
+        query = self.ln_q(self.query)
+        side = math.isqrt(num_tokens)
+        if side * side == num_tokens:
+            dim = query.shape[-1]
+            query_side = math.isqrt(self.num_queries)
+            query = query + get_2d_sincos_pos_embed(dim, query_side, side, device=x.device).to(query.dtype)
+            key = kv + get_2d_sincos_pos_embed(dim, side, device=x.device).to(kv.dtype)
+        else:
+            key = kv
+        out = self.attn(query.unsqueeze(0).expand(num_images, -1, -1), key, kv, need_weights=False)[0]
+        return self.proj(self.ln_post(out))
+
+
 def build_vision_projector(config, delay_load=False, **kwargs):
     projector_type = getattr(config, 'mm_projector_type', 'linear')
 
@@ -48,4 +134,18 @@ def build_vision_projector(config, delay_load=False, **kwargs):
     if projector_type == 'identity':
         return IdentityMap()
 
+    # projectors that also shrink the number of image features; see `projector_grid_side` in llava/mm_utils.py
+    downsample_match = re.match(r'^downsample(\d+)x_mlp(\d+)x_gelu$', projector_type)
+    if downsample_match:
+        factor = int(downsample_match.group(1))
+        mlp_depth = int(downsample_match.group(2))
+        return DownsampleProjector(config.mm_hidden_size, config.hidden_size, factor, mlp_depth)
+
+    resampler_match = re.match(r'^resampler(\d+)$', projector_type)
+    if resampler_match:
+        num_queries = int(resampler_match.group(1))
+        if math.isqrt(num_queries) ** 2 != num_queries:
+            raise ValueError(f'The number of queries of the resampler must be a square, got {num_queries}')
+        return Resampler(config.mm_hidden_size, config.hidden_size, num_queries)
+
     raise ValueError(f'Unknown projector type: {projector_type}')
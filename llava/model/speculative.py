@@ -0,0 +1,219 @@
+"""
+Speculative decoding for the LLaVA language models.
+
+Every step, a drafter proposes a few tokens that continue the output, and the
+model checks all of them in a single forward pass. The proposals are kept up
+to the first one the model would not have generated, and the model's own token
+at that position is added for free. Decoding is greedy, so the output is the
+same as that of `generate(do_sample=False)`, in fewer forward passes of the
+large model.
+
+Two drafters are provided:
+  - `PromptLookupDrafter` looks up the last n-gram of the text in the prompt and
+    the output so far, and proposes what followed it. It needs no extra model and
+    works well for answers that copy from the prompt, e.g. OCR and extraction.
+  - `DraftModelDrafter` runs a small language model with the same tokenizer.
+
+The multimodal prefix (the prompt with the image features in place of the image
+tokens) is prefilled once from `inputs_embeds`, and the draft tokens are
+verified against the KV cache of that prefix. The drafters only see the text:
+the prompt ids without the image tokens, followed by the output.
+"""
+from typing import List, Optional
+
+import torch
+
+
+class Drafter:
+    """Proposes the next tokens of a sequence; counts the proposals the model accepted."""
+
+    def __init__(self, num_draft_tokens=5):
+        self.num_draft_tokens = num_draft_tokens
+        self.num_steps = 0
+        self.num_drafted = 0
+        self.num_accepted = 0
+
+    def propose(self, token_ids: List[int], max_tokens: int) -> List[int]:
+        raise NotImplementedError
+
+    def record(self, num_drafted, num_accepted):
+        self.num_steps += 1
+        self.num_drafted += num_drafted
+        self.num_accepted += num_accepted
+
+    @property
+    def stats(self):
+        return {
+            "steps": self.num_steps,
+            "drafted": self.num_drafted,
+            "accepted": self.num_accepted,
+            "acceptance_rate": self.num_accepted / max(self.num_drafted, 1),
+        }
+
+
+class PromptLookupDrafter(Drafter):
+    """
+    Finds the most recent earlier occurrence of the last `max_ngram_size` tokens
+    (down to `min_ngram_size`), and proposes the tokens that followed it.
+    """
+
+    def __init__(self, num_draft_tokens=10, max_ngram_size=3, min_ngram_size=1):
+        super().__init__(num_draft_tokens)
+        self.max_ngram_size = max_ngram_size
+        self.min_ngram_size = min_ngram_size
+
+    def propose(self, token_ids, max_tokens):
+        max_tokens = min(max_tokens, self.num_draft_tokens)
+        if max_tokens < 1:
+            return []
+        ids = torch.tensor(token_ids, dtype=torch.long)
+        for n in range(min(self.max_ngram_size, len(token_ids) - 1), self.min_ngram_size - 1, -1):
+            # windows of the n-grams that end before the last token
+            windows = ids[:-1].unfold(0, n, 1)
+            starts = (windows == ids[-n:]).all(dim=1).nonzero()[:, 0]
+            if len(starts) > 0:
+                start = int(starts[-1]) + n
+                return token_ids[start:start + max_tokens]
+        return []
+
+
+class DraftModelDrafter(Drafter):
+    """
+    Proposes the greedy continuation of a small causal LM with the same vocabulary.
+    Keeps the KV cache of the draft model between steps, cut back to the tokens
+    the large model accepted.
+    """
+
+    def __init__(self, draft_model, num_draft_tokens=5):
+        super().__init__(num_draft_tokens)
+        self.draft_model = draft_model
+        self.past_key_values = None
+        self.cached_ids = []
+
+    @torch.no_grad()
+    def propose(self, token_ids, max_tokens):
+        max_tokens = min(max_tokens, self.num_draft_tokens)
+        if max_tokens < 1:
+            return []
+        num_common = 0
+        for cached, token in zip(self.cached_ids, token_ids):
+            if cached != token:
+                break
+            num_common += 1
+        # at least one token is fed, for the logits of the next position
+        num_common = min(num_common, len(token_ids) - 1)
+        past_key_values = crop_past_key_values(self.past_key_values, num_common) if num_common > 0 else None
+
+        device = self.draft_model.device
+        new_ids = torch.tensor([token_ids[num_common:]], dtype=torch.long, device=device)
+        draft = []
+        for i in range(max_tokens):
+            outputs = self.draft_model(input_ids=new_ids, past_key_values=past_key_values,
+                                       use_cache=True, return_dict=True)
+            past_key_values = outputs.past_key_values
+            draft.append(int(outputs.logits[0, -1].argmax()))
+            new_ids = torch.tensor([draft[-1:]], dtype=torch.long, device=device)
+        # the last draft token is not in the cache
+        self.past_key_values = past_key_values
+        self.cached_ids = token_ids + draft[:-1]
+        return draft
+
+
+def crop_past_key_values(past_key_values, length):
+    """Keeps the first `length` positions of a KV cache, legacy tuples or a `Cache`."""
+    if hasattr(past_key_values, "crop"):
+        past_key_values.crop(length)
+        return past_key_values
+    if hasattr(past_key_values, "to_legacy_cache"):
+        past_key_values = past_key_values.to_legacy_cache()
+    return tuple((key[:, :, :length], value[:, :, :length]) for key, value in past_key_values)
+
+
+def _eos_token_ids(model, eos_token_id):
+    if eos_token_id is None:
+        eos_token_id = model.generation_config.eos_token_id
+    if eos_token_id is None:
+        return set()
+    if isinstance(eos_token_id, int):
+        return {eos_token_id}
+    return set(eos_token_id)
+
+
+@torch.no_grad()
+def speculative_generate(
+    model,
+    inputs_embeds: torch.FloatTensor,
+    drafter: Drafter,
+    prompt_ids: Optional[torch.LongTensor] = None,
+    attention_mask: Optional[torch.Tensor] = None,
+    max_new_tokens: int = 256,
+    eos_token_id=None,
+    stopping_criteria=None,
+    streamer=None,
+    do_sample: bool = False,
+    num_beams: int = 1,
+    **kwargs,
+) -> torch.LongTensor:
+    """
+    Greedy generation of one sequence from `inputs_embeds`, with the draft tokens
+    of `drafter`. `prompt_ids` are the ids of the prompt, where negative ids (the
+    image tokens) are left out of the text the drafter sees. Returns the
+    generated ids, without the prompt, as `generate` does for `inputs_embeds`.
+    Other generation arguments (temperature, top_p, use_cache, ...) have no effect.
+    """
+    if do_sample or num_beams > 1:
+        raise ValueError("Speculative decoding only supports greedy decoding (do_sample=False, num_beams=1).")
+    if inputs_embeds.shape[0] != 1:
+        raise ValueError("Speculative decoding only supports a batch size of 1.")
+    if attention_mask is not None and not bool(attention_mask.all()):
+        raise ValueError("Speculative decoding does not support padded inputs.")
+    eos_token_ids = _eos_token_ids(model, eos_token_id)
+    if stopping_criteria is not None:
+        stopping_criteria = list(stopping_criteria)
+    device = inputs_embeds.device
+
+    context = []
+    if prompt_ids is not None:
+        context = [token for token in prompt_ids[0].tolist() if token >= 0]
+    if streamer is not None:
+        streamer.put(prompt_ids.cpu() if prompt_ids is not None else torch.zeros((1, 0), dtype=torch.long))
+
+    outputs = model(inputs_embeds=inputs_embeds, use_cache=True, return_dict=True)
+    past_key_values = outputs.past_key_values
+    num_cached = inputs_embeds.shape[1]
+    new_tokens = [int(outputs.logits[0, -1].argmax())]
+    output_ids = []
+
+    while True:
+        finished = False
+        for i, token in enumerate(new_tokens):
+            if token in eos_token_ids or len(output_ids) + i + 1 >= max_new_tokens:
+                new_tokens = new_tokens[:i + 1]
+                finished = True
+                break
+        output_ids += new_tokens
+        if streamer is not None:
+            streamer.put(torch.tensor(new_tokens))
+        if not finished and stopping_criteria:
+            ids = torch.tensor([output_ids], dtype=torch.long, device=device)
+            finished = any(bool(torch.as_tensor(criteria(ids, None)).all()) for criteria in stopping_criteria)
+        if finished:
+            break
+
+        # the last output token is not in the KV cache yet; it is verified with the draft
+        draft = drafter.propose(context + output_ids, max_new_tokens - len(output_ids) - 1)
+        input_ids = torch.tensor([output_ids[-1:] + draft], dtype=torch.long, device=device)
+        outputs = model(input_ids=input_ids, past_key_values=past_key_values, use_cache=True, return_dict=True)
+        predicted = outputs.logits[0].argmax(dim=-1).tolist()
+        num_accepted = 0
+        while num_accepted < len(draft) and draft[num_accepted] == predicted[num_accepted]:
+            num_accepted += 1
+        drafter.record(len(draft), num_accepted)
+
+        num_cached += 1 + num_accepted
+        past_key_values = crop_past_key_values(outputs.past_key_values, num_cached)
+        new_tokens = draft[:num_accepted] + [predicted[num_accepted]]
+
+    if streamer is not None:
+        streamer.end()
+    return torch.tensor([output_ids], dtype=torch.long, device=device)
@@ -0,0 +1,135 @@
+"""
+Token reduction of the image features, between `encode_images` and the
+assembly of the input sequence, selected with `mm_token_reduction` in the
+config (see `llava.mm_utils.TokenReduction`).
+
+Spatial reductions apply to the feature grid of every patch (every tile of an
+anyres image), before the patches are merged, so that the `spatial` and
+`spatial_unpad` merges work on the reduced grid. Sequential reductions apply to
+the merged features of every image, keep the order of the features they keep,
+and never drop the newline features of `spatial_unpad`.
+"""
+import torch
+import torch.nn.functional as F
+
+
+def spatial_pool(image_features, stride):
+    """
+    Average pools the square feature grid of every patch.
+
+    Args:
+        image_features (torch.Tensor): Features in the shape of (num_patches, side * side, dim).
+        stride (int): Pooling window and stride; the last window of a row may be smaller.
+
+    Returns:
+        torch.Tensor: Features in the shape of (num_patches, ceil(side / stride) ** 2, dim).
+    """
+    num_patches, num_tokens, dim = image_features.shape
+    side = int(num_tokens ** 0.5)
+    if side * side != num_tokens:
+        raise ValueError(f"Spatial token reduction needs a square grid of features, got {num_tokens} "
+                         "(mm_vision_select_feature must be 'patch').")
+    grid = image_features.view(num_patches, side, side, dim).permute(0, 3, 1, 2)
+    grid = F.avg_pool2d(grid, kernel_size=stride, stride=stride, ceil_mode=True)
+    return grid.flatten(2).transpose(1, 2)
+
+
+def _bipartite_merge(x, size, position, r):
+    # tokens at even positions are merged into their most similar token at an odd position
+    a, b = x[::2], x[1::2]
+    size_a, size_b = size[::2], size[1::2]
+    scores = F.normalize(a, dim=-1) @ F.normalize(b, dim=-1).T
+    node_max, node_idx = scores.max(dim=-1)
+    order = node_max.argsort(descending=True)
+    src, unmerged = order[:r], order[r:]
+    dst = node_idx[src]
+    # size-weighted average of the merged tokens
+    b = (b * size_b[:, None]).index_add(0, dst, a[src] * size_a[src, None])
+    size_b = size_b.index_add(0, dst, size_a[src])
+    b = b / size_b[:, None]
+    x = torch.cat((a[unmerged], b))
+    size = torch.cat((size_a[unmerged], size_b))
+    position = torch.cat((position[::2][unmerged], position[1::2]))
+    order = position.argsort()
+    return x[order], size[order], position[order]
+
+
+def merge_tokens(x, num_keep):
+    """
+    Merges the most similar features, by bipartite soft matching (ToMe), until
+    `num_keep` are left. Every merged feature is the size-weighted average of its
+    sources, at the position of the feature the others were merged into.
+
+    Args:
+        x (torch.Tensor): Features in the shape of (num_tokens, dim).
+        num_keep (int): Number of features to keep.
+
+    Returns:
+        tuple: The kept features, and their positions in `x`, in increasing order.
+    """
+    dtype = x.dtype
+    x = x.float()
+    size = torch.ones(x.shape[0], device=x.device)
+    position = torch.arange(x.shape[0], device=x.device)
+    while x.shape[0] > num_keep:
+        # one matching merges at most half of the tokens
+        r = min(x.shape[0] - num_keep, (x.shape[0] + 1) // 2)
+        x, size, position = _bipartite_merge(x, size, position, r)
+    return x.to(dtype), position
+
+
+def prune_tokens(x, num_keep):
+    """
+    Keeps the `num_keep` features that get the most attention, averaged over all
+    features as queries, in a parameter-free self-attention of the features.
+
+    Args:
+        x (torch.Tensor): Features in the shape of (num_tokens, dim).
+        num_keep (int): Number of features to keep.
+
+    Returns:
+        tuple: The kept features, and their positions in `x`, in increasing order.
+    """
+    if x.shape[0] <= num_keep:
+        return x, torch.arange(x.shape[0], device=x.device)
+    xf = x.float()
+    attention = torch.softmax(xf @ xf.T / xf.shape[-1] ** 0.5, dim=-1)
+    keep = attention.mean(dim=0).topk(num_keep).indices.sort().values
+    return x[keep], keep
+
+
+SEQUENTIAL_REDUCTIONS = {
+    'tome': merge_tokens,
+    'prune': prune_tokens,
+}
+
+
+def reduce_grid(image_features, token_reduction):
+    """Applies the spatial reduction, if any, to features in the shape of (num_patches, side * side, dim)."""
+    if not token_reduction.is_spatial:
+        return image_features
+    return spatial_pool(image_features, token_reduction.value)
+
+
+def reduce_sequence(image_feature, token_reduction, protected=None):
+    """
+    Applies the sequential reduction, if any, to the merged features of one image.
+
+    Args:
+        image_feature (torch.Tensor): Features in the shape of (num_tokens, dim).
+        token_reduction (TokenReduction): The token reduction.
+        protected (torch.Tensor): Bool mask of the features to keep in place, e.g. the newline features.
+    """
+    if not token_reduction.is_sequential:
+        return image_feature
+    reduce = SEQUENTIAL_REDUCTIONS[token_reduction.method]
+    num_protected = 0 if protected is None else int(protected.sum())
+    num_keep = token_reduction.num_kept(image_feature.shape[0], num_protected) - num_protected
+    if num_protected == 0:
+        return reduce(image_feature, num_keep)[0]
+    # the protected features are put back at their positions, between the kept ones
+    free = (~protected).nonzero()[:, 0]
+    kept, kept_positions = reduce(image_feature[free], num_keep)
+    positions = torch.cat((free[kept_positions], protected.nonzero()[:, 0]))
+    features = torch.cat((kept, image_feature[protected]))
+    return features[positions.argsort()]
@@ -4,18 +4,19 @@
 """
 import argparse
 import asyncio
+import collections
 import dataclasses
 from enum import Enum, auto
+import hashlib
 import json
 import logging
 import time
-from typing import List, Union
-import threading
+from typing import List, Optional, Union
 
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
+import httpx
 import numpy as np
-import requests
 import uvicorn
 
 from llava.constants import CONTROLLER_HEART_BEAT_EXPIRATION
@@ -28,6 +29,7 @@
 class DispatchMethod(Enum):
     LOTTERY = auto()
     SHORTEST_QUEUE = auto()
+    LOAD_AWARE = auto()
 
     @classmethod
     def from_str(cls, name):
@@ -35,6 +37,8 @@ def from_str(cls, name):
             return cls.LOTTERY
         elif name == "shortest_queue":
             return cls.SHORTEST_QUEUE
+        elif name == "load_aware":
+            return cls.LOAD_AWARE
         else:
             raise ValueError(f"Invalid dispatch method")
 
@@ -46,49 +50,100 @@ class WorkerInfo:
     queue_length: int
     check_heart_beat: bool
     last_heart_beat: str
-
-
-def heart_beat_controller(controller):
+    # live metrics of the last heart beat, see llava/serve/worker_metrics.py
+    metrics: Optional[dict] = None
+    # requests dispatched since the last heart beat
+    num_dispatched: int = 0
+
+
+def estimate_wait_time(w_info: WorkerInfo):
+    """Expected seconds before a request dispatched to the worker gets its first token."""
+    metrics = w_info.metrics
+    if not metrics or not metrics.get("tokens_per_second"):
+        # no telemetry yet, e.g. a worker that has not served a request
+        return (w_info.queue_length + w_info.num_dispatched) / w_info.speed
+    mean_request_tokens = metrics.get("mean_request_tokens") or 0
+    dispatched_tokens = w_info.num_dispatched * mean_request_tokens
+    wait_time = (metrics["pending_tokens"] + dispatched_tokens) / metrics["tokens_per_second"]
+    # the recent time to first token, when the pending work underestimates it
+    wait_time = max(wait_time, metrics.get("ttft") or 0)
+    kv_cache_free_tokens = metrics.get("kv_cache_free_tokens")
+    if kv_cache_free_tokens is not None and kv_cache_free_tokens < dispatched_tokens + mean_request_tokens:
+        # the request would wait for KV cache blocks to be released
+        wait_time *= 2
+    return wait_time
+
+
+def rendezvous_worker(session_id: str, worker_names: List[str]):
+    """Highest random weight hashing: only the sessions of a removed worker move elsewhere."""
+    return max(worker_names, key=lambda w_name: hashlib.md5(f"{session_id}@{w_name}".encode()).digest())
+
+
+async def heart_beat_controller(controller):
     while True:
-        time.sleep(CONTROLLER_HEART_BEAT_EXPIRATION)
-        controller.remove_stable_workers_by_expiration()
+        await asyncio.sleep(CONTROLLER_HEART_BEAT_EXPIRATION)
+        await controller.remove_stable_workers_by_expiration()
 
 
 class Controller:
-    def __init__(self, dispatch_method: str):
+    def __init__(self, dispatch_method: str, max_keepalive_connections: int = 64,
+                 session_affinity: bool = False, affinity_max_wait: float = 10.0, max_sessions: int = 100000):
         # Dict[str -> WorkerInfo]
         self.worker_info = {}
         self.dispatch_method = DispatchMethod.from_str(dispatch_method)
-
-        self.heart_beat_thread = threading.Thread(
-            target=heart_beat_controller, args=(self,), daemon=True)
-        self.heart_beat_thread.start()
+        # Dict[str -> httpx.AsyncClient], a keep-alive connection pool per worker
+        self.clients = {}
+        self.max_keepalive_connections = max_keepalive_connections
+
+        # Requests with a session id go to the worker that served the session last,
+        # which holds its image features and prefix cache, unless it is gone or
+        # overloaded. New sessions are spread by rendezvous hashing.
+        self.session_affinity = session_affinity
+        self.affinity_max_wait = affinity_max_wait
+        self.max_sessions = max_sessions
+        # OrderedDict[str -> str], session id to worker name, least recently used first
+        self.sessions = collections.OrderedDict()
+        self.affinity_stats = collections.Counter()
 
         logger.info("Init controller")
 
-    def register_worker(self, worker_name: str, check_heart_beat: bool,
-                        worker_status: dict):
+    def get_client(self, worker_name: str):
+        client = self.clients.get(worker_name)
+        if client is None:
+            # no cap on the connections, every in-flight stream holds one
+            client = httpx.AsyncClient(
+                base_url=worker_name, timeout=5,
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=self.max_keepalive_connections))
+            self.clients[worker_name] = client
+        return client
+
+    async def close(self):
+        clients, self.clients = self.clients, {}
+        await asyncio.gather(*[client.aclose() for client in clients.values()])
+
+    async def register_worker(self, worker_name: str, check_heart_beat: bool,
+                              worker_status: dict):
         if worker_name not in self.worker_info:
             logger.info(f"Register a new worker: {worker_name}")
         else:
             logger.info(f"Register an existing worker: {worker_name}")
 
         if not worker_status:
-            worker_status = self.get_worker_status(worker_name)
+            worker_status = await self.get_worker_status(worker_name)
         if not worker_status:
             return False
 
         self.worker_info[worker_name] = WorkerInfo(
             worker_status["model_names"], worker_status["speed"], worker_status["queue_length"],
-            check_heart_beat, time.time())
+            check_heart_beat, time.time(), worker_status.get("metrics"))
 
         logger.info(f"Register done: {worker_name}, {worker_status}")
         return True
 
-    def get_worker_status(self, worker_name: str):
+    async def get_worker_status(self, worker_name: str):
         try:
-            r = requests.post(worker_name + "/worker_get_status", timeout=5)
-        except requests.exceptions.RequestException as e:
+            r = await self.get_client(worker_name).post("/worker_get_status")
+        except httpx.HTTPError as e:
             logger.error(f"Get status fails: {worker_name}, {e}")
             return None
 
@@ -98,16 +153,25 @@ def get_worker_status(self, worker_name: str):
 
         return r.json()
 
-    def remove_worker(self, worker_name: str):
+    async def remove_worker(self, worker_name: str):
         del self.worker_info[worker_name]
+        client = self.clients.pop(worker_name, None)
+        if client is not None:
+            await client.aclose()
 
-    def refresh_all_workers(self):
+    async def refresh_all_workers(self):
         old_info = dict(self.worker_info)
         self.worker_info = {}
 
-        for w_name, w_info in old_info.items():
-            if not self.register_worker(w_name, w_info.check_heart_beat, None):
+        registered = await asyncio.gather(*[
+            self.register_worker(w_name, w_info.check_heart_beat, None)
+            for w_name, w_info in old_info.items()])
+        for w_name, ok in zip(old_info, registered):
+            if not ok:
                 logger.info(f"Remove stale worker: {w_name}")
+                client = self.clients.pop(w_name, None)
+                if client is not None:
+                    await client.aclose()
 
     def list_models(self):
         model_names = set()
@@ -117,7 +181,50 @@ def list_models(self):
 
         return list(model_names)
 
-    def get_worker_address(self, model_name: str):
+    async def get_worker_address(self, model_name: str, session_id: Optional[str] = None):
+        if not self.session_affinity or not session_id:
+            return await self.dispatch(model_name)
+
+        worker_names = [w_name for w_name, w_info in self.worker_info.items()
+                        if model_name in w_info.model_names]
+        if len(worker_names) == 0:
+            return ""
+        previous = self.sessions.get(session_id)
+        w_name = previous if previous in worker_names else rendezvous_worker(session_id, worker_names)
+        # estimated seconds, or queued requests for workers without telemetry
+        overloaded = estimate_wait_time(self.worker_info[w_name]) > self.affinity_max_wait
+        if overloaded:
+            w_name = await self.dispatch(model_name)
+        else:
+            self.worker_info[w_name].num_dispatched += 1
+
+        self.affinity_stats["requests"] += 1
+        if previous is None:
+            self.affinity_stats["new_sessions"] += 1
+        elif w_name == previous:
+            self.affinity_stats["hits"] += 1
+        elif previous not in worker_names:
+            self.affinity_stats["worker_gone"] += 1
+        elif overloaded:
+            self.affinity_stats["overloaded"] += 1
+        if not w_name:
+            return ""
+
+        self.sessions[session_id] = w_name
+        self.sessions.move_to_end(session_id)
+        if len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+        return w_name
+
+    def get_affinity_stats(self):
+        stats = dict(self.affinity_stats)
+        stats["sessions"] = len(self.sessions)
+        # the share of follow-up requests routed to the worker holding their cache
+        num_follow_ups = self.affinity_stats["requests"] - self.affinity_stats["new_sessions"]
+        stats["hit_rate"] = self.affinity_stats["hits"] / num_follow_ups if num_follow_ups > 0 else None
+        return stats
+
+    async def dispatch(self, model_name: str):
         if self.dispatch_method == DispatchMethod.LOTTERY:
             worker_names = []
             worker_speeds = []
@@ -142,10 +249,10 @@ def get_worker_address(self, model_name: str):
                     p=worker_speeds)
                 worker_name = worker_names[pt]
 
-                if self.get_worker_status(worker_name):
+                if await self.get_worker_status(worker_name):
                     break
                 else:
-                    self.remove_worker(worker_name)
+                    await self.remove_worker(worker_name)
                     worker_speeds[pt] = 0
                     norm = np.sum(worker_speeds)
                     if norm < 1e-4:
@@ -167,20 +274,36 @@ def get_worker_address(self, model_name: str):
             self.worker_info[w_name].queue_length += 1
             logger.info(f"names: {worker_names}, queue_lens: {worker_qlen}, ret: {w_name}")
             return w_name
+        elif self.dispatch_method == DispatchMethod.LOAD_AWARE:
+            worker_names = [w_name for w_name, w_info in self.worker_info.items()
+                            if model_name in w_info.model_names]
+            if len(worker_names) == 0:
+                return ""
+            # power of two choices: the less loaded of two random workers, which
+            # avoids herding every request onto the same worker between heart beats
+            candidates = np.random.choice(len(worker_names), min(2, len(worker_names)), replace=False)
+            wait_times = [estimate_wait_time(self.worker_info[worker_names[i]]) for i in candidates]
+            w_name = worker_names[candidates[int(np.argmin(wait_times))]]
+            self.worker_info[w_name].num_dispatched += 1
+            logger.info(f"candidates: {[worker_names[i] for i in candidates]}, wait_times: {wait_times}, ret: {w_name}")
+            return w_name
         else:
             raise ValueError(f"Invalid dispatch method: {self.dispatch_method}")
 
-    def receive_heart_beat(self, worker_name: str, queue_length: int):
+    def receive_heart_beat(self, worker_name: str, queue_length: int, metrics: Optional[dict] = None):
         if worker_name not in self.worker_info:
             logger.info(f"Receive unknown heart beat. {worker_name}")
             return False
 
         self.worker_info[worker_name].queue_length = queue_length
+        self.worker_info[worker_name].num_dispatched = 0
+        if metrics is not None:
+            self.worker_info[worker_name].metrics = metrics
         self.worker_info[worker_name].last_heart_beat = time.time()
         logger.info(f"Receive heart beat. {worker_name}")
         return True
 
-    def remove_stable_workers_by_expiration(self):
+    async def remove_stable_workers_by_expiration(self):
         expire = time.time() - CONTROLLER_HEART_BEAT_EXPIRATION
         to_delete = []
         for worker_name, w_info in self.worker_info.items():
@@ -188,10 +311,10 @@ def remove_stable_workers_by_expiration(self):
                 to_delete.append(worker_name)
 
         for worker_name in to_delete:
-            self.remove_worker(worker_name)
+            await self.remove_worker(worker_name)
 
-    def worker_api_generate_stream(self, params):
-        worker_addr = self.get_worker_address(params["model"])
+    async def worker_api_generate_stream(self, params):
+        worker_addr = await self.get_worker_address(params["model"], params.get("session_id", None))
         if not worker_addr:
             logger.info(f"no worker: {params['model']}")
             ret = {
@@ -199,14 +322,22 @@ def worker_api_generate_stream(self, params):
                 "error_code": 2,
             }
             yield json.dumps(ret).encode() + b"\0"
+            return
 
         try:
-            response = requests.post(worker_addr + "/worker_generate_stream",
-                json=params, stream=True, timeout=5)
-            for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-                if chunk:
-                    yield chunk + b"\0"
-        except requests.exceptions.RequestException as e:
+            async with self.get_client(worker_addr).stream(
+                    "POST", "/worker_generate_stream", json=params) as response:
+                # pass every null-delimited chunk through as soon as it is complete
+                buffer = b""
+                async for data in response.aiter_bytes():
+                    buffer += data
+                    *chunks, buffer = buffer.split(b"\0")
+                    for chunk in chunks:
+                        if chunk:
+                            yield chunk + b"\0"
+                if buffer:
+                    yield buffer + b"\0"
+        except httpx.HTTPError as e:
             logger.info(f"worker timeout: {worker_addr}")
             ret = {
                 "text": server_error_msg,
@@ -217,39 +348,53 @@ def worker_api_generate_stream(self, params):
 
     # Let the controller act as a worker to achieve hierarchical
     # management. This can be used to connect isolated sub networks.
-    def worker_api_get_status(self):
+    async def worker_api_get_status(self):
         model_names = set()
         speed = 0
         queue_length = 0
 
-        for w_name in self.worker_info:
-            worker_status = self.get_worker_status(w_name)
+        worker_statuses = await asyncio.gather(*[self.get_worker_status(w_name) for w_name in self.worker_info])
+        for worker_status in worker_statuses:
             if worker_status is not None:
                 model_names.update(worker_status["model_names"])
                 speed += worker_status["speed"]
                 queue_length += worker_status["queue_length"]
 
-        return {
+        status = {
             "model_names": list(model_names),
             "speed": speed,
             "queue_length": queue_length,
         }
+        if self.session_affinity:
+            status["affinity"] = self.get_affinity_stats()
+        return status
 
 
 app = FastAPI()
 
 
+@app.on_event("startup")
+async def startup():
+    app.state.heart_beat_task = asyncio.create_task(heart_beat_controller(controller))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.heart_beat_task.cancel()
+    await controller.close()
+
+
 @app.post("/register_worker")
 async def register_worker(request: Request):
     data = await request.json()
-    controller.register_worker(
+    await controller.register_worker(
         data["worker_name"], data["check_heart_beat"],
         data.get("worker_status", None))
 
 
 @app.post("/refresh_all_workers")
 async def refresh_all_workers():
-    models = controller.refresh_all_workers()
+    models = await controller.refresh_all_workers()
 
 
 @app.post("/list_models")
@@ -261,15 +406,20 @@ async def list_models():
 @app.post("/get_worker_address")
 async def get_worker_address(request: Request):
     data = await request.json()
-    addr = controller.get_worker_address(data["model"])
+    addr = await controller.get_worker_address(data["model"], data.get("session_id", None))
     return {"address": addr}
 
 
+@app.post("/get_affinity_stats")
+async def get_affinity_stats():
+    return controller.get_affinity_stats()
+
+
 @app.post("/receive_heart_beat")
 async def receive_heart_beat(request: Request):
     data = await request.json()
     exist = controller.receive_heart_beat(
-        data["worker_name"], data["queue_length"])
+        data["worker_name"], data["queue_length"], data.get("metrics", None))
     return {"exist": exist}
 
 
@@ -282,7 +432,7 @@ async def worker_api_generate_stream(request: Request):
 
 @app.post("/worker_get_status")
 async def worker_api_get_status(request: Request):
-    return controller.worker_api_get_status()
+    return await controller.worker_api_get_status()
 
 
 if __name__ == "__main__":
@@ -290,9 +440,16 @@ async def worker_api_get_status(request: Request):
     parser.add_argument("--host", type=str, default="localhost")
     parser.add_argument("--port", type=int, default=21001)
     parser.add_argument("--dispatch-method", type=str, choices=[
-        "lottery", "shortest_queue"], default="shortest_queue")
+        "lottery", "shortest_queue", "load_aware"], default="shortest_queue")
+    parser.add_argument("--max-keepalive-connections", type=int, default=64,
+        help="Idle connections kept open per worker; in-flight streams are not limited.")
+    parser.add_argument("--session-affinity", action="store_true",
+        help="Route the requests of a session to the worker that served it last, to reuse its caches.")
+    parser.add_argument("--affinity-max-wait", type=float, default=10.0,
+        help="Estimated wait (seconds, or queued requests without worker telemetry) above which a session is dispatched by load instead.")
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
-    controller = Controller(args.dispatch_method)
+    controller = Controller(args.dispatch_method, max_keepalive_connections=args.max_keepalive_connections,
+                            session_affinity=args.session_affinity, affinity_max_wait=args.affinity_max_wait)
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
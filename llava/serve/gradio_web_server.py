@@ -1,5 +1,7 @@
 import argparse
+import base64
 import datetime
+from io import BytesIO
 import json
 import os
 import time
@@ -13,6 +15,8 @@
 from llava.utils import (build_logger, server_error_msg,
     violates_moderation, moderation_msg)
 import hashlib
+from llava.serve.image_store import ImageNotInStoreError, image_hash, image_ref
+from llava.serve.streaming import DELTA_PROTOCOL
 
 
 logger = build_logger("gradio_web_server", "gradio_web_server.log")
@@ -151,6 +155,44 @@ def add_text(state, text, image, image_process_mode, request: gr.Request):
     return (state, state.to_gradio_chatbot(), "", None) + (disable_btn,) * 5
 
 
+def send_images(worker_addr, images, hashes):
+    """
+    Uploads, in binary, the images the worker does not have yet, and returns
+    references to them for the request. Workers without an image store get the
+    images as base64.
+    """
+    if len(images) == 0:
+        return []
+    try:
+        ret = requests.post(worker_addr + "/worker_check_images", json={"hashes": hashes}, timeout=5)
+        ret.raise_for_status()
+        missing = set(ret.json()["missing"])
+        for image, hash in zip(images, hashes):
+            if hash not in missing:
+                continue
+            buffered = BytesIO()
+            image.save(buffered, format="PNG", compress_level=1)
+            ret = requests.post(worker_addr + "/worker_upload_image", params={"hash": hash},
+                data=buffered.getvalue(), headers={"Content-Type": "application/octet-stream"}, timeout=10)
+            ret.raise_for_status()
+            if not ret.json()["ok"]:
+                raise ValueError(f"The worker rejected the upload of image {hash}.")
+            missing.discard(hash)
+        return [image_ref(hash) for hash in hashes]
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.info(f"Sending the images as base64: {e}")
+    return encode_images_base64(images)
+
+
+def encode_images_base64(images):
+    b64_images = []
+    for image in images:
+        buffered = BytesIO()
+        image.save(buffered, format="PNG")
+        b64_images.append(base64.b64encode(buffered.getvalue()).decode())
+    return b64_images
+
+
 def http_bot(state, model_selector, temperature, top_p, max_new_tokens, request: gr.Request):
     logger.info(f"http_bot. ip: {request.client.host}")
     start_tstamp = time.time()
@@ -202,10 +244,30 @@ def http_bot(state, model_selector, temperature, top_p, max_new_tokens, request:
         new_state.append_message(new_state.roles[1], None)
         state = new_state
 
+    # Construct prompt
+    prompt = state.get_prompt()
+
+    all_images = state.get_images(return_pil=True)
+    all_image_hash = [image_hash(image) for image in all_images]
+    for image, hash in zip(all_images, all_image_hash):
+        t = datetime.datetime.now()
+        filename = os.path.join(LOGDIR, "serve_images", f"{t.year}-{t.month:02d}-{t.day:02d}", f"{hash}.jpg")
+        if not os.path.isfile(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            image.save(filename)
+
+    # Every turn of a conversation has the same session id, so that the controller
+    # can route follow-up turns to the worker holding the cached image features
+    # and prompt prefix.
+    first_message = state.messages[state.offset][1]
+    if type(first_message) is tuple:
+        first_message = first_message[0]
+    session_id = hashlib.md5(json.dumps([state.system, first_message, all_image_hash[:1]]).encode()).hexdigest()
+
     # Query worker address
     controller_url = args.controller_url
     ret = requests.post(controller_url + "/get_worker_address",
-            json={"model": model_name})
+            json={"model": model_name, "session_id": session_id})
     worker_addr = ret.json()["address"]
     logger.info(f"model_name: {model_name}, worker_addr: {worker_addr}")
 
@@ -215,18 +277,6 @@ def http_bot(state, model_selector, temperature, top_p, max_new_tokens, request:
         yield (state, state.to_gradio_chatbot(), disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
         return
 
-    # Construct prompt
-    prompt = state.get_prompt()
-
-    all_images = state.get_images(return_pil=True)
-    all_image_hash = [hashlib.md5(image.tobytes()).hexdigest() for image in all_images]
-    for image, hash in zip(all_images, all_image_hash):
-        t = datetime.datetime.now()
-        filename = os.path.join(LOGDIR, "serve_images", f"{t.year}-{t.month:02d}-{t.day:02d}", f"{hash}.jpg")
-        if not os.path.isfile(filename):
-            os.makedirs(os.path.dirname(filename), exist_ok=True)
-            image.save(filename)
-
     # Make requests
     pload = {
         "model": model_name,
@@ -235,32 +285,50 @@ def http_bot(state, model_selector, temperature, top_p, max_new_tokens, request:
         "top_p": float(top_p),
         "max_new_tokens": min(int(max_new_tokens), 1536),
         "stop": state.sep if state.sep_style in [SeparatorStyle.SINGLE, SeparatorStyle.MPT] else state.sep2,
-        "images": f'List of {len(state.get_images())} images: {all_image_hash}',
+        "images": f'List of {len(all_images)} images: {all_image_hash}',
+        "stream_protocol": DELTA_PROTOCOL,
     }
     logger.info(f"==== request ====\n{pload}")
 
-    pload['images'] = state.get_images()
+    # the images the worker already has are sent as their hash only
+    pload['images'] = send_images(worker_addr, all_images, all_image_hash)
 
     state.messages[-1][-1] = "▌"
     yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
 
     try:
-        # Stream output
-        response = requests.post(worker_addr + "/worker_generate_stream",
-            headers=headers, json=pload, stream=True, timeout=10)
-        for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-            if chunk:
-                data = json.loads(chunk.decode())
-                if data["error_code"] == 0:
-                    output = data["text"][len(prompt):].strip()
-                    state.messages[-1][-1] = output + "▌"
-                    yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
-                else:
-                    output = data["text"] + f" (error_code: {data['error_code']})"
-                    state.messages[-1][-1] = output
-                    yield (state, state.to_gradio_chatbot()) + (disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
-                    return
-                time.sleep(0.03)
+        for attempt in range(2):
+            # Stream output
+            response = requests.post(worker_addr + "/worker_generate_stream",
+                headers=headers, json=pload, stream=True, timeout=10)
+            generated_text = ""
+            for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
+                if chunk:
+                    data = json.loads(chunk.decode())
+                    if data["error_code"] == 0:
+                        # workers that predate the delta protocol send the prompt and the whole text
+                        if "delta" in data:
+                            generated_text += data["delta"]
+                        elif data.get("done", False):
+                            generated_text = data["text"]
+                        else:
+                            generated_text = data["text"][len(prompt):]
+                        output = generated_text.strip()
+                        state.messages[-1][-1] = output + "▌"
+                        yield (state, state.to_gradio_chatbot()) + (disable_btn,) * 5
+                    elif data["error_code"] == ImageNotInStoreError.error_code and attempt == 0:
+                        # evicted from the image store of the worker since the check: send the images inline
+                        logger.info(f"Sending the images as base64: {data['text']}")
+                        pload['images'] = encode_images_base64(all_images)
+                        break
+                    else:
+                        output = data["text"] + f" (error_code: {data['error_code']})"
+                        state.messages[-1][-1] = output
+                        yield (state, state.to_gradio_chatbot()) + (disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
+                        return
+                    time.sleep(0.03)
+            else:
+                break
     except requests.exceptions.RequestException as e:
         state.messages[-1][-1] = server_error_msg
         yield (state, state.to_gradio_chatbot()) + (disable_btn, disable_btn, disable_btn, enable_btn, enable_btn)
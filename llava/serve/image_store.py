@@ -0,0 +1,105 @@
+"""
+Images uploaded to a worker once, in binary, and referenced by content hash in
+later requests instead of being sent again as base64.
+"""
+import collections
+import hashlib
+from io import BytesIO
+import threading
+
+from PIL import Image
+
+
+# prefix of the image references in the `images` of a generate request
+IMAGE_REF_PREFIX = "md5:"
+
+
+def image_hash(image):
+    """Content hash of the pixels of a PIL image, as computed by the web server."""
+    return hashlib.md5(image.tobytes()).hexdigest()
+
+
+def image_ref(image_hash):
+    return IMAGE_REF_PREFIX + image_hash
+
+
+def is_image_ref(image):
+    return type(image) is str and image.startswith(IMAGE_REF_PREFIX)
+
+
+class ImageNotInStoreError(ValueError):
+    """
+    A request references an image that is not in the store, e.g. evicted between the
+    image check and the generate call; the client should send the image again.
+    """
+
+    # error code of the worker stream, distinct from the generic error code 1
+    error_code = 2
+
+
+class ImageStore:
+    """LRU store of decoded images by the hash of their pixels."""
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self.images = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.uploads = 0
+
+    def missing(self, hashes):
+        """Returns the hashes that are not in the store, and keeps the others from eviction."""
+        missing = []
+        with self.lock:
+            for h in hashes:
+                if h in self.images:
+                    self.images.move_to_end(h)
+                else:
+                    missing.append(h)
+        return missing
+
+    def put(self, expected_hash, data):
+        """
+        Decodes an uploaded image file; returns False if it is not an image, or if its
+        pixels do not match `expected_hash`.
+        """
+        try:
+            image = Image.open(BytesIO(data))
+            image.load()
+        except (OSError, Image.DecompressionBombError):
+            return False
+        if image_hash(image) != expected_hash:
+            return False
+        with self.lock:
+            self.images[expected_hash] = image
+            self.images.move_to_end(expected_hash)
+            self.uploads += 1
+            while len(self.images) > self.max_entries:
+                self.images.popitem(last=False)
+        return True
+
+    def get(self, h):
+        with self.lock:
+            image = self.images.get(h)
+            if image is None:
+                self.misses += 1
+                return None
+            self.images.move_to_end(h)
+            self.hits += 1
+        return image
+
+    def load(self, ref):
+        image = self.get(ref[len(IMAGE_REF_PREFIX):])
+        if image is None:
+            raise ImageNotInStoreError(f"Image {ref} is not in the image store of the worker, it has to be uploaded again.")
+        return image
+
+    @property
+    def stats(self):
+        return {
+            "entries": len(self.images),
+            "hits": self.hits,
+            "misses": self.misses,
+            "uploads": self.uploads,
+        }
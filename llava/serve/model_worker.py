@@ -9,7 +9,8 @@
 import uuid
 
 from fastapi import FastAPI, Request, BackgroundTasks
-from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 import requests
 import torch
 import uvicorn
@@ -19,13 +20,21 @@
 from llava.utils import (build_logger, server_error_msg,
     pretty_print_semaphore)
 from llava.model.builder import load_pretrained_model
-from llava.mm_utils import process_images, load_image_from_base64, tokenizer_image_token
+from llava.model import LlavaLlamaForCausalLM, LlavaMistralForCausalLM
+from llava.model.kv_cache import PagedKVCache, PrefixCache
+from llava.model.speculative import PromptLookupDrafter, DraftModelDrafter
+from llava.mm_utils import process_images, load_image_from_base64, tokenizer_image_token, count_image_tokens, KeywordsStoppingCriteria
+from llava.serve.scheduler import ContinuousBatchingScheduler, GenerationRequest
+from llava.serve.worker_metrics import WorkerMetrics
+from llava.serve.image_store import ImageStore, ImageNotInStoreError, is_image_ref
+from llava.serve.streaming import IncrementalDetokenizer, TextStream, TokenIdStreamer
 from llava.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
-from transformers import TextIteratorStreamer
+from transformers import AutoModelForCausalLM
 from threading import Thread
 
 
 GB = 1 << 30
+MB = 1 << 20
 
 worker_id = str(uuid.uuid4())[:6]
 logger = build_logger("model_worker", f"model_worker_{worker_id}.log")
@@ -45,7 +54,12 @@ class ModelWorker:
     def __init__(self, controller_addr, worker_addr,
                  worker_id, no_register,
                  model_path, model_base, model_name,
-                 load_8bit, load_4bit, device, use_flash_attn=False):
+                 load_8bit, load_4bit, device, use_flash_attn=False,
+                 image_feature_cache_size=0, image_feature_cache_dir=None,
+                 scheduler="thread", max_batch_size=16,
+                 kv_cache_blocks=0, kv_cache_block_size=16, prefix_cache_size=0,
+                 image_store_size=128, speculative_decoding="none",
+                 draft_model_path=None, num_draft_tokens=5, fast_load=False):
         self.controller_addr = controller_addr
         self.worker_addr = worker_addr
         self.worker_id = worker_id
@@ -63,8 +77,49 @@ def __init__(self, controller_addr, worker_addr,
         self.device = device
         logger.info(f"Loading the model {self.model_name} on worker {worker_id} ...")
         self.tokenizer, self.model, self.image_processor, self.context_len = load_pretrained_model(
-            model_path, model_base, self.model_name, load_8bit, load_4bit, device=self.device, use_flash_attn=use_flash_attn)
+            model_path, model_base, self.model_name, load_8bit, load_4bit, device=self.device, use_flash_attn=use_flash_attn,
+            fast_load=fast_load)
         self.is_multimodal = 'llava' in self.model_name.lower()
+        self.image_feature_cache = None
+        if self.is_multimodal and (image_feature_cache_size > 0 or image_feature_cache_dir is not None):
+            self.image_feature_cache = self.model.get_model().enable_image_feature_cache(
+                max_entries=image_feature_cache_size,
+                disk_dir=image_feature_cache_dir)
+
+        self.speculative_decoding = speculative_decoding
+        self.num_draft_tokens = num_draft_tokens
+        self.draft_model = None
+        if speculative_decoding != "none" and scheduler != "thread":
+            logger.warning("Speculative decoding requires the thread scheduler, it is disabled.")
+            self.speculative_decoding = "none"
+        elif speculative_decoding != "none" and not isinstance(self.model, (LlavaLlamaForCausalLM, LlavaMistralForCausalLM)):
+            # other models do not take a `drafter` in `generate`
+            logger.warning(f"Speculative decoding requires a LLaVA LLaMA or Mistral model, it is disabled for {type(self.model).__name__}.")
+            self.speculative_decoding = "none"
+        elif speculative_decoding == "draft_model":
+            if draft_model_path is None:
+                raise ValueError("--speculative-decoding draft_model requires --draft-model-path.")
+            logger.info(f"Loading the draft model {draft_model_path} ...")
+            self.draft_model = AutoModelForCausalLM.from_pretrained(
+                draft_model_path, torch_dtype=torch.float16).to(self.model.device)
+            self.draft_model.eval()
+
+        self.metrics = WorkerMetrics()
+        self.image_store = ImageStore(max_entries=image_store_size)
+        self.scheduler = None
+        if scheduler == "continuous":
+            kv_cache = prefix_cache = None
+            if kv_cache_blocks > 0:
+                kv_cache = PagedKVCache.from_model_config(
+                    self.model.config, kv_cache_blocks, block_size=kv_cache_block_size,
+                    dtype=self.model.dtype, device=self.model.device)
+                if prefix_cache_size > 0:
+                    prefix_cache = PrefixCache(kv_cache, max_entries=prefix_cache_size)
+            elif prefix_cache_size > 0:
+                logger.warning("The prefix cache requires the paged KV cache (--kv-cache-blocks), it is disabled.")
+            self.scheduler = ContinuousBatchingScheduler(
+                self.model, self.tokenizer, max_batch_size=max_batch_size,
+                kv_cache=kv_cache, prefix_cache=prefix_cache, logger=logger)
 
         if not no_register:
             self.register_to_controller()
@@ -87,7 +142,8 @@ def register_to_controller(self):
     def send_heart_beat(self):
         logger.info(f"Send heart beat. Models: {[self.model_name]}. "
                     f"Semaphore: {pretty_print_semaphore(model_semaphore)}. "
-                    f"global_counter: {global_counter}")
+                    f"global_counter: {global_counter}"
+                    + (f". Image feature cache: {self.image_feature_cache.stats}" if self.image_feature_cache is not None else ""))
 
         url = self.controller_addr + "/receive_heart_beat"
 
@@ -95,7 +151,8 @@ def send_heart_beat(self):
             try:
                 ret = requests.post(url, json={
                     "worker_name": self.worker_addr,
-                    "queue_length": self.get_queue_length()}, timeout=5)
+                    "queue_length": self.get_queue_length(),
+                    "metrics": self.get_metrics()}, timeout=5)
                 exist = ret.json()["exist"]
                 break
             except requests.exceptions.RequestException as e:
@@ -106,18 +163,70 @@ def send_heart_beat(self):
             self.register_to_controller()
 
     def get_queue_length(self):
+        if self.scheduler is not None:
+            return self.scheduler.get_queue_length()
         if model_semaphore is None:
             return 0
         else:
             return args.limit_model_concurrency - model_semaphore._value + (len(
                 model_semaphore._waiters) if model_semaphore._waiters is not None else 0)
 
+    def get_metrics(self, new_window=True):
+        """The load metrics; only heart beats start a new throughput measurement (`new_window`)."""
+        kv_cache_free_tokens = None
+        if self.scheduler is not None and self.scheduler.kv_cache is not None:
+            kv_cache = self.scheduler.kv_cache
+            kv_cache_free_tokens = kv_cache.allocator.num_free_blocks * kv_cache.block_size
+        if not new_window:
+            return self.metrics.peek(kv_cache_free_tokens=kv_cache_free_tokens)
+        return self.metrics.snapshot(kv_cache_free_tokens=kv_cache_free_tokens)
+
     def get_status(self):
-        return {
+        status = {
             "model_names": [self.model_name],
             "speed": 1,
             "queue_length": self.get_queue_length(),
         }
+        status["max_context_length"] = self.get_max_context_length()
+        status["metrics"] = self.get_metrics(new_window=False)
+        if self.scheduler is not None:
+            status["scheduler"] = self.scheduler.stats
+            status["pending_tokens"] = status["scheduler"]["pending_tokens"]
+        if self.image_feature_cache is not None:
+            status["image_feature_cache"] = self.image_feature_cache.stats
+        status["image_store"] = self.image_store.stats
+        return status
+
+    def get_max_context_length(self):
+        max_context_length = getattr(self.model.config, 'max_position_embeddings', 2048)
+        if self.scheduler is not None and self.scheduler.max_sequence_length is not None:
+            max_context_length = min(max_context_length, self.scheduler.max_sequence_length)
+        return max_context_length
+
+    def get_input_length(self, input_ids, images):
+        """Exact length of the prompt once every image token is replaced by its image features."""
+        if images is None:
+            return input_ids.shape[-1]
+        vision_tower = self.model.get_vision_tower()
+        num_image_tokens = sum(count_image_tokens(image.size, self.model.config, vision_tower) for image in images)
+        return input_ids.shape[-1] - len(images) + num_image_tokens
+
+    def downscale_images(self, images):
+        """
+        Shrinks the images so that anyres picks its smallest grid, for prompts whose
+        images do not leave room for the generation. Returns None if it would not help.
+        """
+        if getattr(self.model.config, 'image_aspect_ratio', None) != 'anyres':
+            return None
+        image_size = self.model.get_vision_tower().config.image_size
+        if all(max(image.size) <= image_size for image in images):
+            return None
+        downscaled = []
+        for image in images:
+            image = image.copy()
+            image.thumbnail((image_size, image_size))
+            downscaled.append(image)
+        return downscaled
 
     @torch.inference_mode()
     def generate_stream(self, params):
@@ -126,76 +235,149 @@ def generate_stream(self, params):
         prompt = params["prompt"]
         ori_prompt = prompt
         images = params.get("images", None)
-        num_image_tokens = 0
         if images is not None and len(images) > 0 and self.is_multimodal:
-            if len(images) > 0:
-                if len(images) != prompt.count(DEFAULT_IMAGE_TOKEN):
-                    raise ValueError("Number of images does not match number of <image> tokens in prompt")
-
-                images = [load_image_from_base64(image) for image in images]
-                image_sizes = [image.size for image in images]
-                images = process_images(images, image_processor, model.config)
-
-                if type(images) is list:
-                    images = [image.to(self.model.device, dtype=torch.float16) for image in images]
-                else:
-                    images = images.to(self.model.device, dtype=torch.float16)
+            if len(images) != prompt.count(DEFAULT_IMAGE_TOKEN):
+                raise ValueError("Number of images does not match number of <image> tokens in prompt")
 
-                replace_token = DEFAULT_IMAGE_TOKEN
-                if getattr(self.model.config, 'mm_use_im_start_end', False):
-                    replace_token = DEFAULT_IM_START_TOKEN + replace_token + DEFAULT_IM_END_TOKEN
-                prompt = prompt.replace(DEFAULT_IMAGE_TOKEN, replace_token)
+            # references to uploaded images, or base64 encoded images
+            images = [self.image_store.load(image) if is_image_ref(image) else load_image_from_base64(image)
+                      for image in images]
 
-                num_image_tokens = prompt.count(replace_token) * model.get_vision_tower().num_patches
-            else:
-                images = None
-                image_sizes = None
-            image_args = {"images": images, "image_sizes": image_sizes}
+            replace_token = DEFAULT_IMAGE_TOKEN
+            if getattr(self.model.config, 'mm_use_im_start_end', False):
+                replace_token = DEFAULT_IM_START_TOKEN + replace_token + DEFAULT_IM_END_TOKEN
+            prompt = prompt.replace(DEFAULT_IMAGE_TOKEN, replace_token)
         else:
             images = None
-            image_args = {}
 
         temperature = float(params.get("temperature", 1.0))
         top_p = float(params.get("top_p", 1.0))
-        max_context_length = getattr(model.config, 'max_position_embeddings', 2048)
+        max_context_length = self.get_max_context_length()
         max_new_tokens = min(int(params.get("max_new_tokens", 256)), 1024)
         stop_str = params.get("stop", None)
+        stream_protocol = int(params.get("stream_protocol", 1))
         do_sample = True if temperature > 0.001 else False
 
         input_ids = tokenizer_image_token(prompt, tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt').unsqueeze(0).to(self.device)
         keywords = [stop_str]
-        # stopping_criteria = KeywordsStoppingCriteria(keywords, tokenizer, input_ids)
-        streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=15)
-
-        max_new_tokens = min(max_new_tokens, max_context_length - input_ids.shape[-1] - num_image_tokens)
+        streamer = TokenIdStreamer(timeout=15)
+
+        # the budget is computed before prefill, from the image sizes; anyres images that
+        # leave less than a short answer are downscaled to the smallest grid first
+        num_input_tokens = self.get_input_length(input_ids, images)
+        if images is not None and max_context_length - num_input_tokens < min(max_new_tokens, 64):
+            downscaled = self.downscale_images(images)
+            if downscaled is not None:
+                logger.info(f"Downscaling the images of a prompt of {num_input_tokens} tokens.")
+                images = downscaled
+                num_input_tokens = self.get_input_length(input_ids, images)
+        max_new_tokens = min(max_new_tokens, max_context_length - num_input_tokens)
 
         if max_new_tokens < 1:
-            yield json.dumps({"text": ori_prompt + "Exceeds max token length. Please start a new conversation, thanks.", "error_code": 0}).encode() + b"\0"
+            stream = TextStream(ori_prompt, protocol=stream_protocol)
+            yield stream.push("Exceeds max token length. Please start a new conversation, thanks.")
+            summary = stream.finish("length", 0)
+            if summary is not None:
+                yield summary
             return
 
-        thread = Thread(target=model.generate, kwargs=dict(
-            inputs=input_ids,
-            do_sample=do_sample,
-            temperature=temperature,
-            top_p=top_p,
-            max_new_tokens=max_new_tokens,
-            streamer=streamer,
-            use_cache=True,
-            **image_args
-        ))
-        thread.start()
-
-        generated_text = ori_prompt
-        for new_text in streamer:
-            generated_text += new_text
-            if generated_text.endswith(stop_str):
-                generated_text = generated_text[:-len(stop_str)]
-            yield json.dumps({"text": generated_text, "error_code": 0}).encode() + b"\0"
+        if images is not None:
+            image_sizes = [image.size for image in images]
+            images = process_images(images, image_processor, model.config)
+
+            if type(images) is list:
+                images = [image.to(self.model.device, dtype=torch.float16) for image in images]
+            else:
+                images = images.to(self.model.device, dtype=torch.float16)
+            image_args = {"images": images, "image_sizes": image_sizes}
+        else:
+            image_args = {}
+
+        handle = self.metrics.start(num_input_tokens, max_new_tokens)
+        num_generated_tokens = 0
+        try:
+            if self.scheduler is not None:
+                request = GenerationRequest(
+                    prompt=ori_prompt,
+                    input_ids=input_ids[0].tolist(),
+                    images=list(images) if images is not None else None,
+                    image_sizes=image_args.get("image_sizes", None),
+                    temperature=temperature,
+                    top_p=top_p,
+                    max_new_tokens=max_new_tokens,
+                    stop_str=stop_str,
+                    num_input_tokens=num_input_tokens,
+                    stream_protocol=stream_protocol,
+                )
+                for chunk in self.scheduler.generate_stream(request):
+                    self.metrics.first_token(handle)
+                    num_generated_tokens = len(request.output_ids)
+                    yield chunk
+                return
+
+            # speculative decoding keeps the output of greedy decoding, sampled requests decode as usual
+            drafter = None
+            if not do_sample and self.speculative_decoding == "prompt_lookup":
+                drafter = PromptLookupDrafter(num_draft_tokens=self.num_draft_tokens)
+            elif not do_sample and self.speculative_decoding == "draft_model":
+                drafter = DraftModelDrafter(self.draft_model, num_draft_tokens=self.num_draft_tokens)
+            if drafter is not None:
+                image_args["drafter"] = drafter
+
+            thread = Thread(target=model.generate, kwargs=dict(
+                inputs=input_ids,
+                do_sample=do_sample,
+                temperature=temperature,
+                top_p=top_p,
+                max_new_tokens=max_new_tokens,
+                streamer=streamer,
+                # stops the generation at the stop string, instead of running to max_new_tokens
+                stopping_criteria=[KeywordsStoppingCriteria(keywords, tokenizer, input_ids)] if stop_str else None,
+                use_cache=True,
+                **image_args
+            ))
+            thread.start()
+
+            # the token ids are decoded incrementally, as in the scheduler; the end of
+            # sequence token is not counted
+            detokenizer = IncrementalDetokenizer(tokenizer)
+            stream = TextStream(ori_prompt, stop_str, protocol=stream_protocol)
+            eos_token_id = tokenizer.eos_token_id
+            for token_ids in streamer:
+                self.metrics.first_token(handle)
+                delta = ""
+                for token in token_ids:
+                    if token == eos_token_id:
+                        break
+                    num_generated_tokens += 1
+                    delta += detokenizer.add(token)
+                chunk = stream.push(delta)
+                if chunk is not None:
+                    yield chunk
+                if stream.stopped or eos_token_id in token_ids:
+                    break
+            chunk = stream.push(detokenizer.flush())
+            if chunk is not None:
+                yield chunk
+            if drafter is not None:
+                logger.info(f"Speculative decoding: {drafter.stats}")
+            summary = stream.finish("length" if num_generated_tokens >= max_new_tokens else "stop", num_generated_tokens)
+            if summary is not None:
+                yield summary
+        finally:
+            self.metrics.finish(handle, num_generated_tokens)
 
     def generate_stream_gate(self, params):
         try:
             for x in self.generate_stream(params):
                 yield x
+        except ImageNotInStoreError as e:
+            # the client sends the images again instead of showing an error
+            ret = {
+                "text": str(e),
+                "error_code": e.error_code,
+            }
+            yield json.dumps(ret).encode() + b"\0"
         except ValueError as e:
             print("Caught ValueError:", e)
             ret = {
@@ -234,16 +416,42 @@ async def generate_stream(request: Request):
     global_counter += 1
     params = await request.json()
 
-    if model_semaphore is None:
-        model_semaphore = asyncio.Semaphore(args.limit_model_concurrency)
-    await model_semaphore.acquire()
+    background_tasks = BackgroundTasks()
+    if worker.scheduler is None:
+        if model_semaphore is None:
+            model_semaphore = asyncio.Semaphore(args.limit_model_concurrency)
+        await model_semaphore.acquire()
+        background_tasks.add_task(partial(release_model_semaphore, fn=worker.send_heart_beat))
+    else:
+        # the continuous batching scheduler queues the requests beyond --max-batch-size itself
+        background_tasks.add_task(worker.send_heart_beat)
     worker.send_heart_beat()
     generator = worker.generate_stream_gate(params)
-    background_tasks = BackgroundTasks()
-    background_tasks.add_task(partial(release_model_semaphore, fn=worker.send_heart_beat))
     return StreamingResponse(generator, background=background_tasks)
 
 
+@app.post("/worker_check_images")
+async def check_images(request: Request):
+    data = await request.json()
+    return {"missing": worker.image_store.missing(data["hashes"])}
+
+
+@app.post("/worker_upload_image")
+async def upload_image(request: Request):
+    max_size = args.max_image_upload_size * MB
+    too_large = JSONResponse({"ok": False, "error": f"Images are limited to {args.max_image_upload_size} MB."}, status_code=413)
+    if int(request.headers.get("content-length", 0)) > max_size:
+        return too_large
+    data = bytearray()
+    async for chunk in request.stream():
+        data.extend(chunk)
+        if len(data) > max_size:
+            return too_large
+    # decoding the image would block the event loop that serves the streams
+    ok = await run_in_threadpool(worker.image_store.put, request.query_params["hash"], bytes(data))
+    return {"ok": ok}
+
+
 @app.post("/worker_get_status")
 async def get_status(request: Request):
     return worker.get_status()
@@ -262,12 +470,38 @@ async def get_status(request: Request):
     parser.add_argument("--model-name", type=str)
     parser.add_argument("--device", type=str, default="cuda")
     parser.add_argument("--multi-modal", action="store_true", help="Multimodal mode is automatically detected with model name, please make sure `llava` is included in the model path.")
-    parser.add_argument("--limit-model-concurrency", type=int, default=5)
+    parser.add_argument("--limit-model-concurrency", type=int, default=5,
+        help="Maximum number of concurrent requests of the thread scheduler.")
     parser.add_argument("--stream-interval", type=int, default=1)
     parser.add_argument("--no-register", action="store_true")
     parser.add_argument("--load-8bit", action="store_true")
     parser.add_argument("--load-4bit", action="store_true")
     parser.add_argument("--use-flash-attn", action="store_true")
+    parser.add_argument("--fast-load", action="store_true",
+        help="Load a merged safetensors checkpoint (see llava.model.convert_checkpoint) on the fast path.")
+    parser.add_argument("--scheduler", type=str, default="thread", choices=["thread", "continuous"],
+        help="`thread` runs one `model.generate` per request; `continuous` batches all requests in a single decode loop.")
+    parser.add_argument("--max-batch-size", type=int, default=16,
+        help="Maximum number of requests decoded together by the continuous batching scheduler.")
+    parser.add_argument("--kv-cache-blocks", type=int, default=0,
+        help="Number of blocks of the paged KV cache used by the continuous batching scheduler (LLaMA / Mistral models). 0 disables paging.")
+    parser.add_argument("--kv-cache-block-size", type=int, default=16)
+    parser.add_argument("--prefix-cache-size", type=int, default=0,
+        help="Number of finished conversations whose KV states are kept in the paged KV cache, so that the next turn only prefills the new message. 0 disables the prefix cache.")
+    parser.add_argument("--image-feature-cache-size", type=int, default=0,
+        help="Number of projected image features kept in memory for repeated images. 0 disables the in-memory cache.")
+    parser.add_argument("--image-feature-cache-dir", type=str, default=None,
+        help="Directory for the on-disk tier of the image feature cache.")
+    parser.add_argument("--image-store-size", type=int, default=128,
+        help="Number of uploaded images kept for requests that reference them by hash.")
+    parser.add_argument("--max-image-upload-size", type=int, default=32,
+        help="Maximum size of an uploaded image file, in MB.")
+    parser.add_argument("--speculative-decoding", type=str, default="none", choices=["none", "prompt_lookup", "draft_model"],
+        help="Speculative decoding of greedy requests (temperature 0) with the thread scheduler and LLaVA LLaMA / Mistral models: draft tokens by prompt lookup, or with a small draft model.")
+    parser.add_argument("--draft-model-path", type=str, default=None,
+        help="Causal LM with the tokenizer of the model, for --speculative-decoding draft_model.")
+    parser.add_argument("--num-draft-tokens", type=int, default=5,
+        help="Maximum number of draft tokens verified per forward pass.")
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
@@ -284,5 +518,17 @@ async def get_status(request: Request):
                          args.load_8bit,
                          args.load_4bit,
                          args.device,
-                         use_flash_attn=args.use_flash_attn)
+                         use_flash_attn=args.use_flash_attn,
+                         image_feature_cache_size=args.image_feature_cache_size,
+                         image_feature_cache_dir=args.image_feature_cache_dir,
+                         image_store_size=args.image_store_size,
+                         scheduler=args.scheduler,
+                         max_batch_size=args.max_batch_size,
+                         kv_cache_blocks=args.kv_cache_blocks,
+                         kv_cache_block_size=args.kv_cache_block_size,
+                         prefix_cache_size=args.prefix_cache_size,
+                         speculative_decoding=args.speculative_decoding,
+                         draft_model_path=args.draft_model_path,
+                         num_draft_tokens=args.num_draft_tokens,
+                         fast_load=args.fast_load)
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
@@ -0,0 +1,543 @@
+"""
+A continuous (in-flight) batching scheduler for the model worker.
+
+A single decode loop owns the model. New requests are admitted between decode
+steps: they are prefilled together as one batch, and their KV cache is merged
+into the running batch, so that all active requests share every decode forward
+pass. Finished requests leave the batch immediately.
+
+With a `PagedKVCache`, the KV states of every request live in a shared block
+pool instead of one left-padded tensor per layer, and requests are only
+admitted when their prompt plus `max_new_tokens` fit in the free blocks.
+With a `PrefixCache` on top of it, finished requests keep their KV states, and
+a new request (e.g. the next turn of a conversation) only prefills the part of
+its inputs that follows the longest cached prefix.
+"""
+import collections
+import dataclasses
+import itertools
+import json
+import queue
+import threading
+import time
+from typing import Any, List, Optional
+
+import torch
+
+from llava.constants import IMAGE_TOKEN_INDEX
+from llava.model.feature_cache import tensor_digest
+from llava.serve.streaming import IncrementalDetokenizer, TextStream
+from llava.utils import server_error_msg
+
+_seq_ids = itertools.count()
+
+
+@dataclasses.dataclass
+class GenerationRequest:
+    prompt: str
+    input_ids: List[int]
+    images: Optional[List[torch.Tensor]] = None
+    image_sizes: Optional[List[Any]] = None
+    temperature: float = 1.0
+    top_p: float = 1.0
+    max_new_tokens: int = 256
+    stop_str: Optional[str] = None
+    # length of the prompt after the image tokens are replaced by the image features
+    num_input_tokens: Optional[int] = None
+    # see llava/serve/streaming.py
+    stream_protocol: int = 1
+
+    output_ids: List[int] = dataclasses.field(default_factory=list)
+    detokenizer: Optional[IncrementalDetokenizer] = None
+    stream: Optional[TextStream] = None
+    finished: bool = False
+    # set by the consumer of the outputs, e.g. when the client disconnects
+    cancelled: bool = False
+    submit_time: float = dataclasses.field(default_factory=time.time)
+    first_token_time: Optional[float] = None
+    num_kv_blocks: int = 0
+    # KV cache sequence; unlike `id()`, never reused by a later request while cached
+    seq_id: int = dataclasses.field(default_factory=lambda: next(_seq_ids))
+    # prefix cache units covering the input positions of the prompt
+    prefix_units: Optional[List[Any]] = None
+    outputs: queue.Queue = dataclasses.field(default_factory=queue.Queue)
+
+
+def pad_left(tensors, value=0):
+    """Left-pads a list of tensors along their first dim and stacks them."""
+    max_len = max(x.shape[0] for x in tensors)
+    padded = []
+    for x in tensors:
+        pad = x.new_full((max_len - x.shape[0],) + tuple(x.shape[1:]), value)
+        padded.append(torch.cat((pad, x), dim=0))
+    return torch.stack(padded, dim=0)
+
+
+def sample_next_tokens(logits, temperatures, top_ps):
+    """
+    Samples one token per row, with per-row temperature and top-p.
+    Rows with a temperature close to zero are decoded greedily.
+
+    Args:
+        logits (torch.Tensor): The next token logits, in the shape of (batch_size, vocab_size).
+        temperatures (torch.Tensor): The temperature of each row.
+        top_ps (torch.Tensor): The top-p of each row.
+
+    Returns:
+        torch.Tensor: The next token of each row.
+    """
+    logits = logits.float()
+    greedy = temperatures <= 0.001
+    next_tokens = logits.argmax(dim=-1)
+    if greedy.all():
+        return next_tokens
+
+    logits = logits / temperatures.clamp(min=0.001)[:, None]
+    sorted_logits, sorted_indices = torch.sort(logits, dim=-1, descending=True)
+    cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+    # keep the smallest set of tokens whose cumulative probability exceeds top_p
+    sorted_to_remove = cumulative_probs - sorted_logits.softmax(dim=-1) >= top_ps[:, None]
+    sorted_logits = sorted_logits.masked_fill(sorted_to_remove, float('-inf'))
+    sampled = torch.multinomial(sorted_logits.softmax(dim=-1), num_samples=1)
+    sampled = sorted_indices.gather(-1, sampled).squeeze(-1)
+    return torch.where(greedy, next_tokens, sampled)
+
+
+class ContinuousBatchingScheduler:
+    def __init__(self, model, tokenizer, max_batch_size=16, max_prefill_batch_size=8, kv_cache=None, prefix_cache=None, logger=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_prefill_batch_size = max_prefill_batch_size
+        self.kv_cache = kv_cache
+        self.prefix_cache = prefix_cache
+        self.logger = logger
+
+        self.waiting = queue.Queue()
+        # requests that did not fit in the paged KV cache yet, admitted first
+        self.deferred = collections.deque()
+        self.running = []
+        # Running batch state: left-padded attention mask and legacy-format KV cache.
+        # With a paged KV cache, only `next_input_ids` is used.
+        self.attention_mask = None
+        self.past_key_values = None
+        self.next_input_ids = None
+
+        self.num_steps = 0
+        self.num_generated_tokens = 0
+
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def submit(self, request):
+        self.waiting.put(request)
+        return request
+
+    def get_queue_length(self):
+        return self.waiting.qsize() + len(self.deferred) + len(self.running)
+
+    @property
+    def max_sequence_length(self):
+        """Longest prompt plus generation the KV cache can hold, or None if unbounded."""
+        if self.kv_cache is None:
+            return None
+        return self.kv_cache.num_blocks * self.kv_cache.block_size
+
+    def get_pending_tokens(self):
+        """Prompt and generation tokens still to be processed or held by the queued and running requests."""
+        requests = list(self.waiting.queue) + list(self.deferred) + list(self.running)
+        return sum((r.num_input_tokens or len(r.input_ids)) + r.max_new_tokens - len(r.output_ids) for r in requests)
+
+    def cancel(self, request):
+        """Drops a request from the queue, or from the running batch at the next step."""
+        request.cancelled = True
+
+    def generate_stream(self, request, timeout=60):
+        """
+        Submits a request and yields its outputs in the worker stream format.
+
+        Only a request that is being decoded times out, if it gets no output for
+        `timeout` seconds; a queued request waits for its turn. The request is
+        cancelled when the generator is closed before the end, e.g. because the
+        client disconnected.
+        """
+        self.submit(request)
+        try:
+            while True:
+                try:
+                    chunk = request.outputs.get(timeout=timeout)
+                except queue.Empty:
+                    if request.first_token_time is None and not request.finished:
+                        continue
+                    raise
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            if not request.finished:
+                self.cancel(request)
+
+    def loop(self):
+        while True:
+            try:
+                # block for new requests only when there is nothing to decode
+                self.admit(block=len(self.running) == 0)
+                if len(self.running) > 0:
+                    self.step()
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.error(f"Continuous batching error: {e}")
+                for request in self.running:
+                    self.fail(request)
+                self.reset()
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+
+    def reset(self):
+        if self.prefix_cache is not None:
+            self.prefix_cache.clear()
+        if self.kv_cache is not None:
+            for seq_id in list(self.kv_cache.block_tables):
+                self.kv_cache.free_sequence(seq_id)
+        self.running = []
+        self.attention_mask = self.past_key_values = self.next_input_ids = None
+
+    def fail(self, request, text=server_error_msg):
+        if request.finished:
+            return
+        request.finished = True
+        ret = {
+            "text": text,
+            "error_code": 1,
+        }
+        request.outputs.put(json.dumps(ret).encode() + b"\0")
+        request.outputs.put(None)
+
+    @torch.inference_mode()
+    def admit(self, block=False):
+        new_requests = []
+        if block and len(self.deferred) == 0:
+            new_requests.append(self.waiting.get())
+        while len(self.running) + len(new_requests) < self.max_batch_size and len(new_requests) < self.max_prefill_batch_size:
+            if len(self.deferred) > 0:
+                new_requests.append(self.deferred.popleft())
+                continue
+            try:
+                new_requests.append(self.waiting.get_nowait())
+            except queue.Empty:
+                break
+        new_requests = [r for r in new_requests if not r.cancelled]
+        # reject requests that can never fit before running the vision tower on them
+        max_sequence_length = self.max_sequence_length
+        if max_sequence_length is not None:
+            for request in new_requests:
+                if request.num_input_tokens is not None and request.num_input_tokens + request.max_new_tokens > max_sequence_length:
+                    self.fail(request, "Exceeds the KV cache capacity of the worker. Please start a new conversation, thanks.")
+            new_requests = [r for r in new_requests if not r.finished]
+        if len(new_requests) == 0:
+            return
+
+        # Requests with and without images are prefilled separately, as
+        # `prepare_inputs_labels_for_multimodal` expects images for every sample.
+        try:
+            for group in (
+                [r for r in new_requests if r.images is not None],
+                [r for r in new_requests if r.images is None],
+            ):
+                if len(group) > 0:
+                    self.prefill(group)
+        except Exception:
+            for request in new_requests:
+                self.fail(request)
+            raise
+        self.evict_finished()
+
+    def embed_requests(self, requests):
+        input_ids = [torch.tensor(r.input_ids, dtype=torch.long, device=self.device) for r in requests]
+        if requests[0].images is None:
+            return [self.model.get_model().embed_tokens(x) for x in input_ids]
+
+        attention_mask = [torch.ones_like(x, dtype=torch.bool) for x in input_ids]
+        input_ids = torch.nn.utils.rnn.pad_sequence(input_ids, batch_first=True, padding_value=0)
+        attention_mask = torch.nn.utils.rnn.pad_sequence(attention_mask, batch_first=True, padding_value=False)
+        images = [image for r in requests for image in r.images]
+        image_sizes = [image_size for r in requests for image_size in r.image_sizes]
+        if all(image.ndim == 3 and image.shape == images[0].shape for image in images):
+            # batched as in `model.generate`, so that the image features match `count_image_tokens`
+            images = torch.stack(images, dim=0)
+        _, _, attention_mask, _, inputs_embeds, _ = self.model.prepare_inputs_labels_for_multimodal(
+            input_ids, None, attention_mask, None, None, images, image_sizes=image_sizes)
+        return [embeds[mask] for embeds, mask in zip(inputs_embeds, attention_mask.bool())]
+
+    def prefill(self, requests):
+        inputs_embeds = self.embed_requests(requests)
+        if self.kv_cache is not None:
+            return self.prefill_paged(requests, inputs_embeds)
+        attention_mask = pad_left([torch.ones(x.shape[0], dtype=torch.long, device=self.device) for x in inputs_embeds])
+        inputs_embeds = pad_left(inputs_embeds)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+        outputs = self.model(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True,
+            return_dict=True,
+        )
+        next_tokens = self.sample(requests, outputs.logits[:, -1])
+        self.merge(requests, attention_mask, outputs.past_key_values, next_tokens)
+        self.emit(requests, next_tokens)
+
+    def prefill_paged(self, requests, inputs_embeds):
+        kv_cache, prefix_cache = self.kv_cache, self.prefix_cache
+        block_size = kv_cache.block_size
+        free_blocks = kv_cache.allocator.num_free_blocks - sum(r.num_kv_blocks - len(kv_cache.block_tables[r.seq_id]) for r in self.running)
+        admitted, admitted_embeds = [], []
+        for request, embeds in zip(requests, inputs_embeds):
+            # reserve the blocks for the whole generation, so that running requests never run out of blocks
+            num_blocks = -(-(embeds.shape[0] + request.max_new_tokens) // block_size)
+            if num_blocks > kv_cache.num_blocks:
+                self.fail(request, "Exceeds the KV cache capacity of the worker. Please start a new conversation, thanks.")
+                continue
+            src_seq_id, num_cached = None, 0
+            if prefix_cache is not None:
+                request.prefix_units = self.prefix_units(request, embeds.shape[0])
+                if request.prefix_units is not None:
+                    src_seq_id, num_cached = prefix_cache.match(request.prefix_units)
+                    # the last prompt position is always recomputed, to get the logits of the first token
+                    num_cached = min(num_cached, embeds.shape[0] - 1)
+            # full blocks of the cached prefix are shared, not allocated
+            num_new_blocks = num_blocks - num_cached // block_size
+            while prefix_cache is not None and num_new_blocks > free_blocks:
+                num_free_blocks = kv_cache.allocator.num_free_blocks
+                if not prefix_cache.evict(exclude=src_seq_id):
+                    break
+                free_blocks += kv_cache.allocator.num_free_blocks - num_free_blocks
+            if num_new_blocks > free_blocks:
+                self.deferred.append(request)
+            else:
+                if prefix_cache is not None:
+                    prefix_cache.fork(src_seq_id, request.seq_id, num_cached)
+                else:
+                    kv_cache.add_sequence(request.seq_id)
+                request.num_kv_blocks = num_blocks
+                free_blocks -= num_new_blocks
+                admitted.append(request)
+                admitted_embeds.append(embeds[num_cached:])
+        if len(admitted) == 0:
+            return
+
+        seq_ids = [r.seq_id for r in admitted]
+        try:
+            input_length = max(x.shape[0] for x in admitted_embeds)
+            kv_cache.begin_forward(seq_ids, [x.shape[0] for x in admitted_embeds], input_length)
+            outputs = self.model(
+                inputs_embeds=pad_left(admitted_embeds),
+                attention_mask=kv_cache.attention_mask(),
+                position_ids=kv_cache.position_ids(input_length),
+                past_key_values=kv_cache,
+                use_cache=True,
+                return_dict=True,
+            )
+        except Exception:
+            for seq_id in seq_ids:
+                kv_cache.free_sequence(seq_id)
+            raise
+        next_tokens = self.sample(admitted, outputs.logits[:, -1])
+        self.running = self.running + admitted
+        self.next_input_ids = next_tokens if self.next_input_ids is None else torch.cat((self.next_input_ids, next_tokens), dim=0)
+        self.emit(admitted, next_tokens)
+
+    def prefix_units(self, request, num_positions):
+        """
+        Splits the input positions of a request into prefix cache units: one per text
+        token, and one for the span from the first to the last image, keyed by the image
+        digests and the tokens in between. Returns None if the image span would be
+        shorter than its image tokens, e.g. when the inputs were truncated.
+        """
+        input_ids = request.input_ids
+        image_positions = [i for i, token in enumerate(input_ids) if token == IMAGE_TOKEN_INDEX]
+        if len(image_positions) == 0 or request.images is None:
+            units = [(token, 1) for token in input_ids]
+        else:
+            first, last = image_positions[0], image_positions[-1]
+            span_length = num_positions - first - (len(input_ids) - 1 - last)
+            if span_length < last - first + 1:
+                return None
+            key = (tuple(tensor_digest(image) for image in request.images), tuple(input_ids[first:last + 1]))
+            units = [(token, 1) for token in input_ids[:first]] + [(key, span_length)] + [(token, 1) for token in input_ids[last + 1:]]
+        return units
+
+    def merge(self, requests, attention_mask, past_key_values, next_tokens):
+        """Merges a newly prefilled batch into the running batch, left-padding the shorter one."""
+        past_key_values = [tuple(x) for x in past_key_values]
+        if self.past_key_values is None:
+            self.running = list(requests)
+            self.attention_mask = attention_mask
+            self.past_key_values = past_key_values
+            self.next_input_ids = next_tokens
+            return
+
+        old_len, new_len = self.attention_mask.shape[1], attention_mask.shape[1]
+        max_len = max(old_len, new_len)
+
+        def pad_kv(x, length):
+            if length == max_len:
+                return x
+            pad = x.new_zeros(x.shape[:2] + (max_len - length,) + x.shape[3:])
+            return torch.cat((pad, x), dim=2)
+
+        def pad_mask(x, length):
+            return torch.cat((x.new_zeros(x.shape[0], max_len - length), x), dim=1)
+
+        self.past_key_values = [
+            tuple(torch.cat((pad_kv(old, old_len), pad_kv(new, new_len)), dim=0) for old, new in zip(old_layer, new_layer))
+            for old_layer, new_layer in zip(self.past_key_values, past_key_values)
+        ]
+        self.attention_mask = torch.cat((pad_mask(self.attention_mask, old_len), pad_mask(attention_mask, new_len)), dim=0)
+        self.next_input_ids = torch.cat((self.next_input_ids, next_tokens), dim=0)
+        self.running = self.running + list(requests)
+
+    def sample(self, requests, logits):
+        temperatures = torch.tensor([r.temperature for r in requests], dtype=torch.float, device=logits.device)
+        top_ps = torch.tensor([r.top_p for r in requests], dtype=torch.float, device=logits.device)
+        return sample_next_tokens(logits, temperatures, top_ps)
+
+    @torch.inference_mode()
+    def step(self):
+        if self.kv_cache is not None:
+            return self.step_paged()
+        self.attention_mask = torch.cat((self.attention_mask, self.attention_mask.new_ones(self.attention_mask.shape[0], 1)), dim=1)
+        position_ids = self.attention_mask.sum(-1, keepdim=True) - 1
+        outputs = self.model(
+            input_ids=self.next_input_ids[:, None],
+            attention_mask=self.attention_mask,
+            position_ids=position_ids,
+            past_key_values=self.past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        self.past_key_values = [tuple(x) for x in outputs.past_key_values]
+        self.next_input_ids = self.sample(self.running, outputs.logits[:, -1])
+        self.num_steps += 1
+        self.emit(self.running, self.next_input_ids)
+        self.evict_finished()
+
+    def step_paged(self):
+        kv_cache = self.kv_cache
+        kv_cache.begin_forward([r.seq_id for r in self.running], [1] * len(self.running), 1)
+        outputs = self.model(
+            input_ids=self.next_input_ids[:, None],
+            attention_mask=kv_cache.attention_mask(),
+            position_ids=kv_cache.position_ids(1),
+            past_key_values=kv_cache,
+            use_cache=True,
+            return_dict=True,
+        )
+        self.next_input_ids = self.sample(self.running, outputs.logits[:, -1])
+        self.num_steps += 1
+        self.emit(self.running, self.next_input_ids)
+        self.evict_finished()
+
+    def emit(self, requests, next_tokens):
+        eos_token_id = self.tokenizer.eos_token_id
+        for request, token in zip(requests, next_tokens.tolist()):
+            if request.cancelled:
+                request.finished = True
+            if request.finished:
+                continue
+            if request.first_token_time is None:
+                request.first_token_time = time.time()
+                request.detokenizer = IncrementalDetokenizer(self.tokenizer)
+                request.stream = TextStream(request.prompt, request.stop_str, request.stream_protocol)
+            self.num_generated_tokens += 1
+            finish_reason = "stop"
+            if token == eos_token_id:
+                request.finished = True
+                delta = request.detokenizer.flush()
+            else:
+                request.output_ids.append(token)
+                delta = request.detokenizer.add(token)
+                if len(request.output_ids) >= request.max_new_tokens:
+                    request.finished = True
+                    finish_reason = "length"
+                    delta += request.detokenizer.flush()
+            chunk = request.stream.push(delta)
+            if chunk is not None:
+                request.outputs.put(chunk)
+            if request.stream.stopped:
+                request.finished = True
+            if request.finished:
+                chunk = request.stream.finish(finish_reason, len(request.output_ids))
+                if chunk is not None:
+                    request.outputs.put(chunk)
+                request.outputs.put(None)
+
+    def evict_finished(self):
+        for request in self.running:
+            if request.cancelled:
+                request.finished = True
+        keep = [i for i, r in enumerate(self.running) if not r.finished]
+        if len(keep) == len(self.running):
+            return
+
+        if self.kv_cache is not None:
+            for request in self.running:
+                if request.finished:
+                    self.release(request)
+            if len(keep) == 0:
+                self.running = []
+                self.next_input_ids = None
+                return
+            index = torch.tensor(keep, dtype=torch.long, device=self.next_input_ids.device)
+            self.next_input_ids = self.next_input_ids.index_select(0, index)
+            self.running = [self.running[i] for i in keep]
+            return
+
+        if len(keep) == 0:
+            self.reset()
+            return
+
+        index = torch.tensor(keep, dtype=torch.long, device=self.attention_mask.device)
+        attention_mask = self.attention_mask.index_select(0, index)
+        # drop the columns that are padding for all remaining requests
+        start = int((attention_mask.sum(0) == 0).long().cumprod(0).sum().item())
+        self.attention_mask = attention_mask[:, start:]
+        self.past_key_values = [
+            tuple(x.index_select(0, index)[:, :, start:] for x in layer)
+            for layer in self.past_key_values
+        ]
+        self.next_input_ids = self.next_input_ids.index_select(0, index)
+        self.running = [self.running[i] for i in keep]
+
+    def release(self, request):
+        """Frees the KV cache sequence of a finished request, or keeps it in the prefix cache."""
+        seq_id = request.seq_id
+        if self.prefix_cache is None or request.prefix_units is None:
+            self.kv_cache.free_sequence(seq_id)
+            return
+        # the KV cache holds the prompt and every generated token but the last one
+        num_generated = self.kv_cache.seq_lens[seq_id] - sum(length for _, length in request.prefix_units)
+        if num_generated > len(request.output_ids):
+            self.kv_cache.free_sequence(seq_id)
+            return
+        self.prefix_cache.insert(seq_id, request.prefix_units + [(token, 1) for token in request.output_ids[:num_generated]])
+
+    @property
+    def stats(self):
+        stats = {
+            "running": len(self.running),
+            "waiting": self.waiting.qsize() + len(self.deferred),
+            "steps": self.num_steps,
+            "generated_tokens": self.num_generated_tokens,
+            "pending_tokens": self.get_pending_tokens(),
+        }
+        if self.kv_cache is not None:
+            stats["kv_cache"] = self.kv_cache.stats
+        if self.prefix_cache is not None:
+            stats["prefix_cache"] = self.prefix_cache.stats
+        return stats
@@ -0,0 +1,152 @@
+"""
+Incremental detokenization and the stream format of the worker protocol.
+
+Protocol 1 (the default, for old clients) sends the prompt and the whole output
+text in every chunk. Protocol 2 (`"stream_protocol": 2` in the request) sends
+only the new text of every chunk, with a sequence number, and a final summary:
+
+    {"delta": " a", "seq": 1, "error_code": 0}
+    {"delta": " cat", "seq": 2, "error_code": 0}
+    {"done": true, "seq": 3, "text": " a cat", "finish_reason": "stop",
+     "num_generated_tokens": 3, "error_code": 0}
+
+The deltas add up to the `text` of the summary. Errors are sent as in protocol
+1, with `text` and a non-zero `error_code`.
+"""
+import json
+import queue
+
+
+DELTA_PROTOCOL = 2
+
+
+class IncrementalDetokenizer:
+    """
+    Decodes generated tokens one at a time. Every step decodes only the last few
+    tokens, with the tokens before them as context, so that merges such as the
+    leading space of SentencePiece tokens come out right, and holds back text
+    until multi-byte characters are complete.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens=True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids = []
+        # token_ids[prefix_offset:read_offset] is the context of the next decode,
+        # and token_ids[read_offset:] the tokens whose text is not returned yet
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def decode(self, token_ids):
+        return self.tokenizer.decode(token_ids, skip_special_tokens=self.skip_special_tokens)
+
+    def add(self, token_id):
+        """Adds a token; returns the new text, empty while a character is incomplete."""
+        self.token_ids.append(token_id)
+        return self._read(final=False)
+
+    def flush(self):
+        """Returns the text held back, once no token follows."""
+        return self._read(final=True)
+
+    def _read(self, final):
+        if self.read_offset == len(self.token_ids):
+            return ""
+        prefix_text = self.decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self.decode(self.token_ids[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or (new_text.endswith('�') and not final):
+            return ""
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+
+class TokenIdStreamer:
+    """
+    A streamer for `generate` that passes the generated token ids on, to be
+    decoded by an `IncrementalDetokenizer`, instead of decoding them itself.
+    Iterating it yields the list of new token ids of every step; the prompt,
+    which `generate` puts first, is skipped.
+    """
+
+    def __init__(self, timeout=None):
+        self.queue = queue.Queue()
+        self.timeout = timeout
+        self.next_tokens_are_prompt = True
+
+    def put(self, value):
+        if self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+        self.queue.put(value.reshape(-1).tolist())
+
+    def end(self):
+        self.queue.put(None)
+
+    def __iter__(self):
+        while True:
+            token_ids = self.queue.get(timeout=self.timeout)
+            if token_ids is None:
+                return
+            yield token_ids
+
+
+class TextStream:
+    """
+    The output text of a request, encoded as chunks of the requested protocol.
+    Text that may be the start of the stop string is held back until it is not.
+    """
+
+    def __init__(self, prompt, stop_str=None, protocol=1):
+        self.prompt = prompt
+        self.stop_str = stop_str
+        self.protocol = protocol
+        self.text = ""
+        self.num_sent = 0
+        self.seq = 0
+        self.stopped = False
+
+    def push(self, delta):
+        """
+        Appends generated text, cut at the stop string. Returns the chunk to send,
+        or None if there is nothing to send yet.
+        """
+        if self.stopped or not delta:
+            return None
+        text = self.text + delta
+        num_ready = len(text)
+        if self.stop_str:
+            index = text.find(self.stop_str, max(0, len(self.text) - len(self.stop_str) + 1))
+            if index >= 0:
+                text = text[:index]
+                num_ready = len(text)
+                self.stopped = True
+            else:
+                num_ready -= next((k for k in range(len(self.stop_str) - 1, 0, -1)
+                                   if text.endswith(self.stop_str[:k])), 0)
+        self.text = text
+        return self._send(num_ready)
+
+    def finish(self, finish_reason, num_generated_tokens):
+        """Returns the text held back and, with protocol 2, the summary; or None."""
+        chunk = self._send(len(self.text)) or b""
+        if self.protocol == DELTA_PROTOCOL:
+            self.seq += 1
+            chunk += json.dumps({
+                "done": True,
+                "seq": self.seq,
+                "text": self.text,
+                "finish_reason": "stop" if self.stopped else finish_reason,
+                "num_generated_tokens": num_generated_tokens,
+                "error_code": 0,
+            }).encode() + b"\0"
+        return chunk or None
+
+    def _send(self, num_ready):
+        if num_ready <= self.num_sent:
+            return None
+        sent, self.num_sent = self.num_sent, num_ready
+        if self.protocol != DELTA_PROTOCOL:
+            return json.dumps({"text": self.prompt + self.text[:num_ready], "error_code": 0}).encode() + b"\0"
+        self.seq += 1
+        return json.dumps({"delta": self.text[sent:num_ready], "seq": self.seq, "error_code": 0}).encode() + b"\0"
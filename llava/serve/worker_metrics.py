@@ -0,0 +1,107 @@
+"""
+Live load metrics of a model worker, pushed to the controller with every heart
+beat for load-aware dispatch.
+"""
+import collections
+import threading
+import time
+
+
+class WorkerMetrics:
+    """
+    Tracks the requests of a worker: the tokens still to prefill and decode, the
+    recent time to first token, and the tokens processed (prompt and generated)
+    per second while the worker is busy, averaged over heart beats.
+
+    The clock can be replaced, e.g. by the simulated time of a benchmark.
+    """
+
+    def __init__(self, ema=0.5, num_recent=32, clock=time.monotonic):
+        self.lock = threading.Lock()
+        self.clock = clock
+        self.ema = ema
+        self.num_running = 0
+        self.pending_prefill_tokens = 0
+        self.pending_tokens = 0
+        self.tokens_per_second = None
+        self.ttfts = collections.deque(maxlen=num_recent)
+        self.request_tokens = collections.deque(maxlen=num_recent)
+        # tokens processed and busy time since the last snapshot
+        self._num_tokens = 0
+        self._busy_time = 0.0
+        self._busy_since = None
+
+    def start(self, num_input_tokens, max_new_tokens):
+        """Records a new request; returns the handle to pass to `first_token` and `finish`."""
+        with self.lock:
+            now = self.clock()
+            if self.num_running == 0:
+                self._busy_since = now
+            self.num_running += 1
+            self.pending_prefill_tokens += num_input_tokens
+            self.pending_tokens += num_input_tokens + max_new_tokens
+        return {"start_time": now, "num_input_tokens": num_input_tokens,
+                "max_new_tokens": max_new_tokens, "prefilled": False}
+
+    def first_token(self, handle):
+        with self.lock:
+            if handle["prefilled"]:
+                return
+            handle["prefilled"] = True
+            self.pending_prefill_tokens -= handle["num_input_tokens"]
+            self.pending_tokens -= handle["num_input_tokens"]
+            self.ttfts.append(self.clock() - handle["start_time"])
+
+    def finish(self, handle, num_generated_tokens):
+        with self.lock:
+            now = self.clock()
+            if not handle["prefilled"]:
+                handle["prefilled"] = True
+                self.pending_prefill_tokens -= handle["num_input_tokens"]
+                self.pending_tokens -= handle["num_input_tokens"]
+            self.pending_tokens -= handle["max_new_tokens"]
+            self.num_running -= 1
+            if self.num_running == 0:
+                self._busy_time += now - self._busy_since
+                self._busy_since = None
+            num_tokens = handle["num_input_tokens"] + num_generated_tokens
+            self._num_tokens += num_tokens
+            self.request_tokens.append(num_tokens)
+
+    def snapshot(self, **extra):
+        """Returns the metrics as a dict, and starts a new throughput measurement; called once per heart beat."""
+        with self.lock:
+            now = self.clock()
+            if self._busy_since is not None:
+                self._busy_time += now - self._busy_since
+                self._busy_since = now
+            # tokens are counted when their request finishes, so the busy time of
+            # long requests carries over until then
+            if self._busy_time > 0 and self._num_tokens > 0:
+                rate = self._num_tokens / self._busy_time
+                if self.tokens_per_second is None:
+                    self.tokens_per_second = rate
+                else:
+                    self.tokens_per_second = self.ema * rate + (1 - self.ema) * self.tokens_per_second
+                self._num_tokens = 0
+                self._busy_time = 0.0
+            metrics = self._metrics()
+        metrics.update(extra)
+        return metrics
+
+    def peek(self, **extra):
+        """Returns the metrics as a dict, without touching the throughput measurement, e.g. for status requests."""
+        with self.lock:
+            metrics = self._metrics()
+        metrics.update(extra)
+        return metrics
+
+    def _metrics(self):
+        return {
+            "num_running": self.num_running,
+            "pending_prefill_tokens": self.pending_prefill_tokens,
+            "pending_tokens": self.pending_tokens,
+            "tokens_per_second": self.tokens_per_second,
+            "ttft": sum(self.ttfts) / len(self.ttfts) if len(self.ttfts) > 0 else None,
+            "mean_request_tokens": sum(self.request_tokens) / len(self.request_tokens) if len(self.request_tokens) > 0 else None,
+        }
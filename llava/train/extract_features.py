@@ -0,0 +1,109 @@
+"""
+Extract the frozen vision tower features of a training set into a `VisionFeatureStore`.
+
+The stored features are the ones selected by `mm_vision_select_layer` and
+`mm_vision_select_feature`, i.e. the input of `mm_projector`. Train with
+`--vision_feature_store <output-dir>` to skip image decoding and the vision tower.
+"""
+import argparse
+import json
+import math
+import os
+
+import torch
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader
+from tqdm import tqdm
+
+from llava.mm_utils import expand2square
+from llava.model.multimodal_encoder.builder import build_vision_tower
+from llava.train.feature_store import VisionFeatureStoreWriter
+
+
+class ImageFileDataset(Dataset):
+    def __init__(self, image_files, image_folder, image_processor, image_aspect_ratio):
+        self.image_files = image_files
+        self.image_folder = image_folder
+        self.image_processor = image_processor
+        self.image_aspect_ratio = image_aspect_ratio
+
+    def __len__(self):
+        return len(self.image_files)
+
+    def __getitem__(self, index):
+        # Same preprocessing as `LazySupervisedDataset.__getitem__`.
+        processor = self.image_processor
+        image = Image.open(os.path.join(self.image_folder, self.image_files[index])).convert('RGB')
+        if self.image_aspect_ratio == 'pad':
+            image = expand2square(image, tuple(int(x*255) for x in processor.image_mean))
+        return processor.preprocess(image, return_tensors='pt')['pixel_values'][0]
+
+
+def collate_fn(batch):
+    return torch.stack(batch, dim=0)
+
+
+def extract_features(args):
+    if args.image_aspect_ratio not in ('square', 'pad'):
+        raise ValueError(f"Feature extraction does not support image_aspect_ratio={args.image_aspect_ratio}")
+
+    list_data_dict = json.load(open(args.data_path, "r"))
+    image_files = sorted(set(sample['image'] for sample in list_data_dict if 'image' in sample))
+    chunk_size = math.ceil(len(image_files) / args.num_chunks)
+    image_files = image_files[args.chunk_idx * chunk_size:(args.chunk_idx + 1) * chunk_size]
+
+    vision_tower = build_vision_tower(argparse.Namespace(
+        mm_vision_tower=args.vision_tower,
+        mm_vision_select_layer=args.mm_vision_select_layer,
+        mm_vision_select_feature=args.mm_vision_select_feature,
+    ))
+    dtype = torch.bfloat16 if args.bf16 else torch.float16
+    vision_tower.to(device=args.device, dtype=dtype)
+
+    feature_shape = (vision_tower.num_patches + (1 if args.mm_vision_select_feature == 'cls_patch' else 0), vision_tower.hidden_size)
+    writer = VisionFeatureStoreWriter(
+        args.output_dir, feature_shape,
+        meta={
+            "vision_tower": args.vision_tower,
+            "mm_vision_select_layer": args.mm_vision_select_layer,
+            "mm_vision_select_feature": args.mm_vision_select_feature,
+            "image_aspect_ratio": args.image_aspect_ratio,
+        },
+        prefix=str(args.chunk_idx),
+        shard_size=args.shard_size,
+    )
+
+    dataset = ImageFileDataset(image_files, args.image_folder, vision_tower.image_processor, args.image_aspect_ratio)
+    data_loader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers, shuffle=False, collate_fn=collate_fn)
+
+    offset = 0
+    for images in tqdm(data_loader, total=len(data_loader)):
+        with torch.inference_mode():
+            features = vision_tower(images.to(device=args.device, dtype=dtype))
+        features = features.to(dtype=torch.float16).cpu().numpy()
+        for feature in features:
+            writer.add(image_files[offset], feature)
+            offset += 1
+    writer.close()
+    print(f"Extracted {offset} image features to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data-path", type=str, required=True)
+    parser.add_argument("--image-folder", type=str, required=True)
+    parser.add_argument("--output-dir", type=str, required=True)
+    parser.add_argument("--vision-tower", type=str, default="openai/clip-vit-large-patch14-336")
+    parser.add_argument("--mm-vision-select-layer", type=int, default=-2)
+    parser.add_argument("--mm-vision-select-feature", type=str, default="patch")
+    parser.add_argument("--image-aspect-ratio", type=str, default="square")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--num-workers", type=int, default=8)
+    parser.add_argument("--shard-size", type=int, default=1024)
+    parser.add_argument("--num-chunks", type=int, default=1)
+    parser.add_argument("--chunk-idx", type=int, default=0)
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--bf16", action="store_true")
+    args = parser.parse_args()
+
+    extract_features(args)
@@ -0,0 +1,120 @@
+import glob
+import json
+import os
+
+import numpy as np
+
+
+class VisionFeatureStoreWriter:
+    """
+    Writes fixed-shape vision features into memory-mapped `.npy` shards.
+
+    Each writer owns the shards with its own `prefix`, so that several processes
+    (e.g. one per GPU) can extract into the same directory at the same time.
+    """
+
+    def __init__(self, store_dir, feature_shape, meta, prefix="0", shard_size=1024, dtype=np.float16):
+        self.store_dir = store_dir
+        self.feature_shape = tuple(feature_shape)
+        self.meta = dict(meta)
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.dtype = np.dtype(dtype)
+
+        self.index = {}
+        self.shards = []
+        self._shard = None
+        self._shard_rows = 0
+
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    def _new_shard(self):
+        self._flush()
+        shard_file = f"shard_{self.prefix}_{len(self.shards):05d}.npy"
+        self._shard = np.lib.format.open_memmap(
+            os.path.join(self.store_dir, shard_file), mode='w+',
+            dtype=self.dtype, shape=(self.shard_size,) + self.feature_shape)
+        self._shard_rows = 0
+        self.shards.append(shard_file)
+
+    def _flush(self):
+        if self._shard is not None:
+            self._shard.flush()
+            self._shard = None
+
+    def add(self, key, feature):
+        if key in self.index:
+            return
+        if tuple(feature.shape) != self.feature_shape:
+            raise ValueError(f"Unexpected feature shape for {key}: {tuple(feature.shape)}, expected {self.feature_shape}")
+        if self._shard is None or self._shard_rows == self.shard_size:
+            self._new_shard()
+        self._shard[self._shard_rows] = feature
+        self.index[key] = [self.shards[-1], self._shard_rows]
+        self._shard_rows += 1
+
+    def close(self):
+        self._flush()
+        meta = dict(self.meta)
+        meta["feature_shape"] = list(self.feature_shape)
+        meta["dtype"] = self.dtype.name
+        with open(os.path.join(self.store_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+        with open(os.path.join(self.store_dir, f"index_{self.prefix}.json"), "w") as f:
+            json.dump(self.index, f)
+
+
+class VisionFeatureStore:
+    """
+    Read-only view over the shards written by `VisionFeatureStoreWriter`.
+
+    Shards are opened lazily with `mmap_mode='r'`, so a store opened before the
+    dataloader workers are forked does not hold any feature data in memory.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.feature_shape = tuple(self.meta["feature_shape"])
+        self.dtype = np.dtype(self.meta["dtype"])
+
+        self.index = {}
+        for index_file in sorted(glob.glob(os.path.join(store_dir, "index_*.json"))):
+            with open(index_file, "r") as f:
+                self.index.update(json.load(f))
+        self._shards = {}
+
+    def check_compatible(self, vision_tower, mm_vision_select_layer, mm_vision_select_feature, image_aspect_ratio):
+        expected = {
+            "vision_tower": vision_tower,
+            "mm_vision_select_layer": mm_vision_select_layer,
+            "mm_vision_select_feature": mm_vision_select_feature,
+            "image_aspect_ratio": image_aspect_ratio,
+        }
+        for k, v in expected.items():
+            if self.meta.get(k) != v:
+                raise ValueError(f"Vision feature store {self.store_dir} was extracted with {k}={self.meta.get(k)}, but training uses {k}={v}.")
+
+    def _get_shard(self, shard_file):
+        shard = self._shards.get(shard_file, None)
+        if shard is None:
+            shard = np.load(os.path.join(self.store_dir, shard_file), mmap_mode='r')
+            self._shards[shard_file] = shard
+        return shard
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        shard_file, row = self.index[key]
+        return np.array(self._get_shard(shard_file)[row])
+
+    def __getstate__(self):
+        # Do not pickle open memory maps into dataloader workers.
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
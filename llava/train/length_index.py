@@ -0,0 +1,110 @@
+"""
+Exact token lengths of the training samples, for the length grouped sampler.
+
+The length of a sample is the length of its tokenized conversation, with every
+image token replaced by the number of image features the model inserts for it.
+The lengths are computed once, in parallel, and saved as a NumPy array next to
+the data file, keyed by everything they depend on.
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import numpy as np
+
+from llava.mm_utils import get_anyres_planner, projector_grid_side, TokenReduction
+
+
+@dataclass
+class ImageTokenCounter:
+    """Counts the image features `prepare_inputs_labels_for_multimodal` inserts for one image."""
+
+    num_base_tokens: int
+    num_patches_per_side: int
+    image_size: int
+    image_aspect_ratio: str = 'square'
+    image_grid_pinpoints: Optional[Any] = None
+    mm_patch_merge_type: str = 'flat'
+    mm_token_reduction: Optional[str] = None
+    mm_projector_type: str = 'linear'
+
+    @property
+    def needs_image_size(self):
+        return self.image_aspect_ratio == 'anyres'
+
+    def count(self, image_size=None):
+        """
+        Args:
+            image_size (tuple): The size of the image in the format (width, height); only used for anyres.
+        """
+        token_reduction = TokenReduction.parse(self.mm_token_reduction)
+        side = token_reduction.grid_side(projector_grid_side(self.mm_projector_type, self.num_patches_per_side))
+        num_base_tokens = self.num_base_tokens - self.num_patches_per_side ** 2 + side * side
+        if not self.needs_image_size:
+            return token_reduction.num_kept(num_base_tokens)
+        # the plan counts side ** 2 features for the base image
+        plan = get_anyres_planner(
+            self.image_grid_pinpoints, self.image_size,
+            side, self.mm_patch_merge_type).plan(image_size)
+        num_newlines = plan.unpad_box[1] - plan.unpad_box[0] if 'unpad' in self.mm_patch_merge_type else 0
+        return token_reduction.num_kept(plan.num_tokens - side * side + num_base_tokens, num_newlines)
+
+
+_sample_length_fn = None
+
+
+def _init_worker(sample_length_fn):
+    global _sample_length_fn
+    _sample_length_fn = sample_length_fn
+
+
+def _sample_lengths(samples):
+    return [_sample_length_fn(sample) for sample in samples]
+
+
+def compute_length_index(samples, sample_length_fn, num_workers=8, chunk_size=1000):
+    """
+    Computes `sample_length_fn(sample) -> (length, num_image_tokens)` for every sample,
+    in `num_workers` processes.
+
+    Returns:
+        np.ndarray: An int32 array in the shape of (num_samples, 2).
+    """
+    chunks = [samples[i:i + chunk_size] for i in range(0, len(samples), chunk_size)]
+    if num_workers <= 1:
+        _init_worker(sample_length_fn)
+        results = [_sample_lengths(chunk) for chunk in chunks]
+    else:
+        with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(sample_length_fn,)) as pool:
+            results = pool.map(_sample_lengths, chunks)
+    index = np.zeros((len(samples), 2), dtype=np.int32)
+    if len(samples) > 0:
+        index[:] = [x for result in results for x in result]
+    return index
+
+
+def length_index_path(data_path, meta):
+    """Path of the length index of `data_path`; `meta` lists the settings the lengths depend on."""
+    stat = os.stat(data_path)
+    meta = dict(meta, data_size=stat.st_size, data_mtime=int(stat.st_mtime))
+    key = hashlib.sha1(json.dumps(meta, sort_keys=True, default=str).encode()).hexdigest()[:16]
+    return f"{os.path.splitext(data_path)[0]}.lengths-{key}.npy"
+
+
+def load_or_compute_length_index(data_path, samples, sample_length_fn, meta, num_workers=8):
+    path = length_index_path(data_path, meta)
+    if os.path.exists(path):
+        index = np.load(path)
+        if index.shape == (len(samples), 2):
+            return index
+    index = compute_length_index(samples, sample_length_fn, num_workers=num_workers)
+    try:
+        tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, index)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not save the length index to {path}: {e}")
+    return index
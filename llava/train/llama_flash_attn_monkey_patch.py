@@ -12,6 +12,8 @@
     from flash_attn.flash_attn_interface import flash_attn_varlen_qkvpacked_func as flash_attn_unpadded_qkvpacked_func
 from flash_attn.bert_padding import unpad_input, pad_input
 
+from llava.train.packing import unpad_packed_input
+
 
 def forward(
     self,
@@ -82,7 +84,11 @@ def forward(
         output = output.view(bsz, q_len, -1)
     else:
         qkv = qkv.reshape(bsz, q_len, -1)
-        qkv, indices, cu_q_lens, max_s = unpad_input(qkv, key_padding_mask)
+        if key_padding_mask.dtype == torch.bool:
+            qkv, indices, cu_q_lens, max_s = unpad_input(qkv, key_padding_mask)
+        else:
+            # packed batches: the mask holds the sample index of every token (see llava/train/packing.py)
+            qkv, indices, cu_q_lens, max_s = unpad_packed_input(qkv, key_padding_mask)
         qkv = qkv.view(-1, 3, self.num_heads, self.head_dim)
         output_unpad = flash_attn_unpadded_qkvpacked_func(
             qkv, cu_q_lens, max_s, 0.0, softmax_scale=None, causal=True
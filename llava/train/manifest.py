@@ -0,0 +1,104 @@
+"""
+A memory-mapped training manifest.
+
+The instruction file is converted once to JSON Lines, with an index of the
+byte offset of every line. Samples are parsed on access from a memory map of
+the JSONL file, so startup does not parse the whole file, and dataloader
+workers share the pages of the file instead of each holding (and touching the
+refcounts of) a copy of millions of Python dicts.
+"""
+import json
+import mmap
+import os
+
+import numpy as np
+
+
+def build_offsets(jsonl_path):
+    """Returns the byte offsets of the non-empty lines of a JSONL file, followed by the file size."""
+    offsets = []
+    end = 0
+    with open(jsonl_path, "rb") as f:
+        for line in f:
+            if line.strip():
+                offsets.append(end)
+            end += len(line)
+    # every sample ends where the next one starts, trailing whitespace is ignored by `json.loads`
+    return np.array(offsets + [end], dtype=np.int64)
+
+
+def convert_json_to_jsonl(json_path, jsonl_path):
+    samples = json.load(open(json_path, "r"))
+    tmp_path = f"{jsonl_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        for sample in samples:
+            f.write(json.dumps(sample, ensure_ascii=False))
+            f.write("\n")
+    os.replace(tmp_path, jsonl_path)
+
+
+def _is_newer(path, than_path):
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(than_path)
+
+
+class Manifest:
+    """Read-only sequence of the samples of a JSONL file, parsed on access."""
+
+    def __init__(self, jsonl_path, offsets):
+        self.jsonl_path = jsonl_path
+        self.offsets = offsets
+        self._file = None
+        self._mmap = None
+
+    @classmethod
+    def open(cls, data_path):
+        """
+        Opens the manifest of a `.json` or `.jsonl` instruction file, converting
+        and indexing it the first time. The converted file and the index are
+        saved next to `data_path`.
+        """
+        if data_path.endswith(".jsonl"):
+            jsonl_path = data_path
+        else:
+            jsonl_path = os.path.splitext(data_path)[0] + ".manifest.jsonl"
+            if not _is_newer(jsonl_path, data_path):
+                convert_json_to_jsonl(data_path, jsonl_path)
+        offsets_path = jsonl_path + ".offsets.npy"
+        if _is_newer(offsets_path, jsonl_path):
+            offsets = np.load(offsets_path)
+        else:
+            offsets = build_offsets(jsonl_path)
+            tmp_path = f"{offsets_path}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, offsets)
+            os.replace(tmp_path, offsets_path)
+        return cls(jsonl_path, offsets)
+
+    def _open(self):
+        self._file = open(self.jsonl_path, "rb")
+        # mmap cannot map an empty file
+        if os.path.getsize(self.jsonl_path) > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"Manifest index {i} out of range.")
+        if self._file is None:
+            self._open()
+        return json.loads(self._mmap[self.offsets[i]:self.offsets[i + 1]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getstate__(self):
+        # every process maps the file itself
+        state = self.__dict__.copy()
+        state["_file"] = state["_mmap"] = None
+        return state
@@ -0,0 +1,137 @@
+"""
+Sequence packing for supervised fine-tuning.
+
+Several samples share one row, up to the token budget of the model. The
+attention mask of a packed batch holds the index of the sample of every token
+(1, 2, ... within a row, 0 for padding) instead of 0 / 1. The model uses it to
+restart the position ids of every sample (see `merge_multimodal_inputs_batched`),
+and flash attention uses it to build the `cu_seqlens` of the varlen kernels,
+so that attention never crosses samples.
+"""
+from dataclasses import dataclass
+from typing import Dict, Optional, Sequence
+
+import torch
+import torch.nn.functional as F
+import transformers
+
+from llava.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX
+from llava.train.length_index import ImageTokenCounter
+
+
+def pack_lengths(lengths, budget):
+    """
+    Groups samples into rows of at most `budget` tokens, first-fit by decreasing length.
+    Samples longer than the budget get a row of their own (and are truncated by the model).
+
+    Returns:
+        list: The sample indices of every row.
+    """
+    rows, row_lengths = [], []
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        for j in range(len(rows)):
+            if row_lengths[j] + lengths[i] <= budget:
+                rows[j].append(i)
+                row_lengths[j] += lengths[i]
+                break
+        else:
+            rows.append([i])
+            row_lengths.append(lengths[i])
+    # keep the dataset order within and across rows
+    rows = [sorted(row) for row in rows]
+    rows.sort(key=lambda row: row[0])
+    return rows
+
+
+def get_packed_unpad_data(attention_mask):
+    """
+    Drop-in replacement of `transformers.models.llama.modeling_llama._get_unpad_data`
+    for packed attention masks: every sample of a row is a separate sequence.
+
+    Returns:
+        tuple: The flat indices of the non-padding tokens, the cumulative sequence
+        lengths (int32) and the maximum sequence length.
+    """
+    flat_mask = attention_mask.flatten()
+    indices = torch.nonzero(flat_mask, as_tuple=False).flatten()
+    # (row, sample) of every token; samples are contiguous, so consecutive runs are the sequences
+    rows = torch.arange(attention_mask.shape[0], device=attention_mask.device).repeat_interleave(attention_mask.shape[1])
+    keys = rows[indices] * (int(attention_mask.max()) + 1) + flat_mask[indices].long()
+    seqlens = torch.unique_consecutive(keys, return_counts=True)[1].to(torch.int32)
+    max_seqlen = int(seqlens.max()) if seqlens.numel() > 0 else 0
+    cu_seqlens = F.pad(torch.cumsum(seqlens, dim=0, dtype=torch.int32), (1, 0))
+    return indices, cu_seqlens, max_seqlen
+
+
+def unpad_packed_input(hidden_states, attention_mask):
+    """Like `flash_attn.bert_padding.unpad_input`, for packed attention masks."""
+    indices, cu_seqlens, max_seqlen = get_packed_unpad_data(attention_mask)
+    hidden_states = hidden_states.reshape(-1, *hidden_states.shape[2:])[indices]
+    return hidden_states, indices, cu_seqlens, max_seqlen
+
+
+def enable_packed_flash_attention():
+    """Makes the `flash_attention_2` implementation of transformers split packed rows into their samples."""
+    transformers.models.llama.modeling_llama._get_unpad_data = get_packed_unpad_data
+
+
+@dataclass
+class DataCollatorForPackedSupervisedDataset(object):
+    """
+    Collate examples for supervised fine-tuning, packing several samples per row.
+
+    The length of a sample is counted after every image token is replaced by
+    the image features `image_token_counter` counts for the `image_size` of the
+    sample (anyres grids, newlines, token reduction and projector), as the model
+    will see it.
+    """
+
+    tokenizer: transformers.PreTrainedTokenizer
+    image_token_counter: Optional[ImageTokenCounter] = None
+
+    def sample_length(self, instance):
+        input_ids = instance["input_ids"]
+        num_images = int((input_ids == IMAGE_TOKEN_INDEX).sum())
+        if num_images == 0 or self.image_token_counter is None:
+            return input_ids.shape[0]
+        num_image_tokens = self.image_token_counter.count(instance.get("image_size", None))
+        return input_ids.shape[0] + num_images * (num_image_tokens - 1)
+
+    def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
+        budget = self.tokenizer.model_max_length
+        rows = pack_lengths([self.sample_length(instance) for instance in instances], budget)
+
+        input_ids, labels, attention_mask, images = [], [], [], []
+        for row in rows:
+            input_ids.append(torch.cat([instances[i]["input_ids"] for i in row]))
+            labels.append(torch.cat([instances[i]["labels"] for i in row]))
+            attention_mask.append(torch.cat([
+                torch.full_like(instances[i]["input_ids"], sample_idx + 1) for sample_idx, i in enumerate(row)]))
+            if 'image' in instances[0]:
+                # every image token consumes one image; a row without image tokens consumes a dummy one
+                row_images = [instances[i]["image"] for i in row if (instances[i]["input_ids"] == IMAGE_TOKEN_INDEX).any()]
+                images.extend(row_images if len(row_images) > 0 else [instances[row[0]]["image"]])
+
+        input_ids = torch.nn.utils.rnn.pad_sequence(
+            input_ids,
+            batch_first=True,
+            padding_value=self.tokenizer.pad_token_id)
+        labels = torch.nn.utils.rnn.pad_sequence(labels,
+                                                 batch_first=True,
+                                                 padding_value=IGNORE_INDEX)
+        attention_mask = torch.nn.utils.rnn.pad_sequence(attention_mask,
+                                                         batch_first=True,
+                                                         padding_value=0)
+        batch = dict(
+            input_ids=input_ids[:, :budget],
+            labels=labels[:, :budget],
+            attention_mask=attention_mask[:, :budget],
+        )
+
+        if 'image' in instances[0]:
+            if all(x is not None and x.shape == images[0].shape for x in images):
+                batch['images'] = torch.stack(images)
+            else:
+                batch['images'] = images
+
+        return batch
@@ -16,12 +16,15 @@
 
 import os
 import copy
-from dataclasses import dataclass, field
+from dataclasses import asdict, dataclass, field
+import functools
 import json
 import logging
 import pathlib
+from types import SimpleNamespace
 from typing import Dict, Optional, Sequence, List
 
+import numpy as np
 import torch
 
 import transformers
@@ -34,6 +37,10 @@
 from llava import conversation as conversation_lib
 from llava.model import *
 from llava.mm_utils import tokenizer_image_token
+from llava.train.feature_store import VisionFeatureStore
+from llava.train.manifest import Manifest
+from llava.train.length_index import ImageTokenCounter, load_or_compute_length_index
+from llava.train.packing import DataCollatorForPackedSupervisedDataset, enable_packed_flash_attention
 
 from PIL import Image
 
@@ -64,6 +71,8 @@ class ModelArguments:
     mm_use_im_patch_token: bool = field(default=True)
     mm_patch_merge_type: Optional[str] = field(default='flat')
     mm_vision_select_feature: Optional[str] = field(default="patch")
+    mm_token_reduction: Optional[str] = field(default=None,
+                           metadata={"help": "Reduction of the image features: poolN, tomeR or pruneR (see llava/mm_utils.py TokenReduction)."})
 
 
 @dataclass
@@ -74,6 +83,13 @@ class DataArguments:
     is_multimodal: bool = False
     image_folder: Optional[str] = field(default=None)
     image_aspect_ratio: str = 'square'
+    vision_feature_store: Optional[str] = field(default=None,
+                           metadata={"help": "Path to precomputed vision features (see llava/train/extract_features.py)."})
+    length_index: bool = field(default=False,
+                           metadata={"help": "Group by exact token lengths (tokenized text plus image features), computed once and saved next to the data file."})
+    length_index_workers: int = 8
+    mmap_manifest: bool = field(default=False,
+                           metadata={"help": "Read the samples lazily from a JSONL copy of the data file through mmap, instead of loading the whole file in every process."})
 
 
 @dataclass
@@ -110,6 +126,8 @@ class TrainingArguments(transformers.TrainingArguments):
     lora_bias: str = "none"
     mm_projector_lr: Optional[float] = None
     group_by_modality_length: bool = field(default=False)
+    sequence_packing: bool = field(default=False,
+                           metadata={"help": "Pack several samples into each row, up to model_max_length tokens. Requires flash attention."})
 
 
 def maybe_zero_3(param, ignore_status=False, name=None):
@@ -655,6 +673,25 @@ def get_tokenize_len(prompts):
     return dict(input_ids=input_ids, labels=targets)
 
 
+def sample_length(sample, tokenizer, data_args, conversation, image_token_counter):
+    """Returns the number of tokens of a sample as seen by the model, and how many of them are image features."""
+    conversation_lib.default_conversation = conversation
+    sources = [copy.deepcopy(sample["conversations"])]
+    has_image = 'image' in sample
+    if has_image:
+        sources = preprocess_multimodal(sources, data_args)
+    input_ids = preprocess(sources, tokenizer, has_image=has_image)["input_ids"][0]
+    num_images = int((input_ids == IMAGE_TOKEN_INDEX).sum())
+    if num_images == 0 or image_token_counter is None:
+        return input_ids.shape[0], 0
+    image_size = None
+    if image_token_counter.needs_image_size:
+        with Image.open(os.path.join(data_args.image_folder, sample['image'])) as image:
+            image_size = image.size
+    num_image_tokens = num_images * image_token_counter.count(image_size)
+    return input_ids.shape[0] - num_images + num_image_tokens, num_image_tokens
+
+
 class LazySupervisedDataset(Dataset):
     """Dataset for supervised fine-tuning."""
 
@@ -662,18 +699,47 @@ def __init__(self, data_path: str,
                  tokenizer: transformers.PreTrainedTokenizer,
                  data_args: DataArguments):
         super(LazySupervisedDataset, self).__init__()
-        list_data_dict = json.load(open(data_path, "r"))
+        if getattr(data_args, 'mmap_manifest', False):
+            list_data_dict = Manifest.open(data_path)
+        else:
+            list_data_dict = json.load(open(data_path, "r"))
 
         rank0_print("Formatting inputs...Skip in lazy mode")
         self.tokenizer = tokenizer
         self.list_data_dict = list_data_dict
         self.data_args = data_args
+        self.data_path = data_path
+        self.length_index = None
+        self.vision_feature_store = None
+        if getattr(data_args, 'vision_feature_store', None) is not None:
+            self.vision_feature_store = VisionFeatureStore(data_args.vision_feature_store)
 
     def __len__(self):
         return len(self.list_data_dict)
 
+    def load_length_index(self, image_token_counter=None, num_workers=8):
+        """Loads (or computes and saves) the exact token lengths used by `lengths` and `modality_lengths`."""
+        minimal_data_args = SimpleNamespace(
+            is_multimodal=self.data_args.is_multimodal,
+            mm_use_im_start_end=getattr(self.data_args, 'mm_use_im_start_end', False),
+            image_folder=self.data_args.image_folder)
+        conversation = conversation_lib.default_conversation
+        meta = dict(
+            tokenizer=self.tokenizer.name_or_path,
+            vocab_size=len(self.tokenizer),
+            conversation=[conversation.version, str(conversation.sep_style), conversation.system],
+            data_args=vars(minimal_data_args),
+            image_token_counter=None if image_token_counter is None else asdict(image_token_counter),
+        )
+        fn = functools.partial(sample_length, tokenizer=self.tokenizer, data_args=minimal_data_args,
+                               conversation=conversation, image_token_counter=image_token_counter)
+        self.length_index = load_or_compute_length_index(
+            self.data_path, self.list_data_dict, fn, meta, num_workers=num_workers)
+
     @property
     def lengths(self):
+        if self.length_index is not None:
+            return self.length_index[:, 0].tolist()
         length_list = []
         for sample in self.list_data_dict:
             img_tokens = 128 if 'image' in sample else 0
@@ -682,6 +748,9 @@ def lengths(self):
 
     @property
     def modality_lengths(self):
+        if self.length_index is not None:
+            lengths, num_image_tokens = self.length_index[:, 0], self.length_index[:, 1]
+            return np.where(num_image_tokens > 0, lengths, -lengths).tolist()
         length_list = []
         for sample in self.list_data_dict:
             cur_len = sum(len(conv['value'].split()) for conv in sample['conversations'])
@@ -690,15 +759,24 @@ def modality_lengths(self):
         return length_list
 
     def __getitem__(self, i) -> Dict[str, torch.Tensor]:
-        sources = self.list_data_dict[i]
+        sample = self.list_data_dict[i]
+        sources = sample
         if isinstance(i, int):
             sources = [sources]
         assert len(sources) == 1, "Don't know why it is wrapped to a list"  # FIXME
-        if 'image' in sources[0]:
-            image_file = self.list_data_dict[i]['image']
+        if 'image' in sources[0] and self.vision_feature_store is not None:
+            # precomputed vision tower features, fed directly to the projector
+            image_file = sample['image']
+            image = torch.from_numpy(self.vision_feature_store[image_file])
+            sources = preprocess_multimodal(
+                copy.deepcopy([e["conversations"] for e in sources]),
+                self.data_args)
+        elif 'image' in sources[0]:
+            image_file = sample['image']
             image_folder = self.data_args.image_folder
             processor = self.data_args.image_processor
             image = Image.open(os.path.join(image_folder, image_file)).convert('RGB')
+            image_size = image.size
             if self.data_args.image_aspect_ratio == 'pad':
                 def expand2square(pil_img, background_color):
                     width, height = pil_img.size
@@ -724,14 +802,19 @@ def expand2square(pil_img, background_color):
         data_dict = preprocess(
             sources,
             self.tokenizer,
-            has_image=('image' in self.list_data_dict[i]))
+            has_image=('image' in sample))
         if isinstance(i, int):
             data_dict = dict(input_ids=data_dict["input_ids"][0],
                              labels=data_dict["labels"][0])
 
         # image exist in the data
-        if 'image' in self.list_data_dict[i]:
+        if 'image' in sample:
             data_dict['image'] = image
+            if self.vision_feature_store is None:
+                # the number of image features of anyres images depends on the image size
+                data_dict['image_size'] = image_size
+        elif self.data_args.is_multimodal and self.vision_feature_store is not None:
+            data_dict['image'] = torch.zeros(self.vision_feature_store.feature_shape)
         elif self.data_args.is_multimodal:
             # image does not exist in the data, but the model is multimodal
             crop_size = self.data_args.image_processor.crop_size
@@ -774,12 +857,16 @@ def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
 
 
 def make_supervised_data_module(tokenizer: transformers.PreTrainedTokenizer,
-                                data_args) -> Dict:
+                                data_args, sequence_packing=False) -> Dict:
     """Make dataset and collator for supervised fine-tuning."""
     train_dataset = LazySupervisedDataset(tokenizer=tokenizer,
                                 data_path=data_args.data_path,
                                 data_args=data_args)
-    data_collator = DataCollatorForSupervisedDataset(tokenizer=tokenizer)
+    if sequence_packing:
+        data_collator = DataCollatorForPackedSupervisedDataset(
+            tokenizer=tokenizer, image_token_counter=getattr(data_args, 'image_token_counter', None))
+    else:
+        data_collator = DataCollatorForSupervisedDataset(tokenizer=tokenizer)
     return dict(train_dataset=train_dataset,
                 eval_dataset=None,
                 data_collator=data_collator)
@@ -792,6 +879,10 @@ def train(attn_implementation=None):
         (ModelArguments, DataArguments, TrainingArguments))
     model_args, data_args, training_args = parser.parse_args_into_dataclasses()
     local_rank = training_args.local_rank
+    if training_args.sequence_packing:
+        if attn_implementation != "flash_attention_2":
+            raise ValueError("Sequence packing requires flash attention, please use llava/train/train_mem.py.")
+        enable_packed_flash_attention()
     compute_dtype = (torch.float16 if training_args.fp16 else (torch.bfloat16 if training_args.bf16 else torch.float32))
 
     bnb_model_from_pretrained_args = {}
@@ -919,9 +1010,29 @@ def make_inputs_require_grad(module, input, output):
         data_args.image_processor = vision_tower.image_processor
         data_args.is_multimodal = True
 
+        if data_args.vision_feature_store is not None:
+            vision_feature_store = VisionFeatureStore(data_args.vision_feature_store)
+            vision_feature_store.check_compatible(
+                model_args.vision_tower, model_args.mm_vision_select_layer,
+                model_args.mm_vision_select_feature, data_args.image_aspect_ratio)
+            model.get_model().use_precomputed_image_features = True
+            data_args.num_image_tokens = vision_feature_store.feature_shape[0]
+        else:
+            data_args.num_image_tokens = vision_tower.num_patches + (1 if model_args.mm_vision_select_feature == 'cls_patch' else 0)
+        data_args.image_token_counter = ImageTokenCounter(
+            num_base_tokens=data_args.num_image_tokens,
+            num_patches_per_side=vision_tower.num_patches_per_side,
+            image_size=vision_tower.config.image_size,
+            image_aspect_ratio=data_args.image_aspect_ratio,
+            image_grid_pinpoints=getattr(model.config, 'image_grid_pinpoints', None),
+            mm_patch_merge_type=model_args.mm_patch_merge_type,
+            mm_token_reduction=model_args.mm_token_reduction,
+            mm_projector_type=model_args.mm_projector_type)
+
         model.config.image_aspect_ratio = data_args.image_aspect_ratio
         model.config.tokenizer_padding_side = tokenizer.padding_side
         model.config.tokenizer_model_max_length = tokenizer.model_max_length
+        model.config.sequence_packing = training_args.sequence_packing
 
         model.config.tune_mm_mlp_adapter = training_args.tune_mm_mlp_adapter = model_args.tune_mm_mlp_adapter
         if model_args.tune_mm_mlp_adapter:
@@ -956,8 +1067,17 @@ def make_inputs_require_grad(module, input, output):
                     if training_args.bf16 and module.weight.dtype == torch.float32:
                         module = module.to(torch.bfloat16)
 
-    data_module = make_supervised_data_module(tokenizer=tokenizer,
-                                              data_args=data_args)
+    # the main process converts and indexes the manifest, the others load it
+    with training_args.main_process_first(desc="training manifest"):
+        data_module = make_supervised_data_module(tokenizer=tokenizer,
+                                                  data_args=data_args,
+                                                  sequence_packing=training_args.sequence_packing)
+    if data_args.length_index:
+        # the main process computes and saves the index, the others load it
+        with training_args.main_process_first(desc="token length index"):
+            data_module['train_dataset'].load_length_index(
+                image_token_counter=getattr(data_args, 'image_token_counter', None),
+                num_workers=data_args.length_index_workers)
     trainer = LLaVATrainer(model=model,
                     tokenizer=tokenizer,
                     args=training_args,
@@ -0,0 +1,62 @@
+"""
+CPU benchmark of the batched, tensor-based anyres preprocessing against the
+per-patch PIL path.
+
+Generates random images of various sizes, checks that `process_anyres_images`
+matches `process_anyres_image` within tolerance, and reports the time per
+image of both paths.
+
+Usage:
+    python scripts/benchmark_anyres_preprocess.py --num-images 64
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from transformers import CLIPImageProcessor
+
+from llava.mm_utils import process_anyres_image, process_anyres_images
+
+
+GRID_PINPOINTS = [[336, 672], [672, 336], [672, 672], [1008, 336], [336, 1008]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-images", type=int, default=64)
+    parser.add_argument("--min-size", type=int, default=200)
+    parser.add_argument("--max-size", type=int, default=1600)
+    parser.add_argument("--image-size", type=int, default=336)
+    parser.add_argument("--atol", type=float, default=1e-5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    np_rng = np.random.default_rng(args.seed)
+    processor = CLIPImageProcessor(
+        size={"shortest_edge": args.image_size},
+        crop_size={"height": args.image_size, "width": args.image_size})
+    images = []
+    for _ in range(args.num_images):
+        width, height = rng.randint(args.min_size, args.max_size), rng.randint(args.min_size, args.max_size)
+        images.append(Image.fromarray(np_rng.integers(0, 256, (height, width, 3), dtype=np.uint8)))
+
+    torch.set_num_threads(1)
+    t0 = time.perf_counter()
+    expected = [process_anyres_image(image, processor, GRID_PINPOINTS) for image in images]
+    pil_time = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    actual = process_anyres_images(images, processor, GRID_PINPOINTS)
+    tensor_time = time.perf_counter() - t0
+
+    same_shapes = all(x.shape == y.shape for x, y in zip(expected, actual))
+    max_diff = max((x - y).abs().max().item() for x, y in zip(expected, actual)) if same_shapes else float('inf')
+    num_patches = sum(x.shape[0] for x in expected)
+    print(f"images={len(images)} patches={num_patches} same_shapes={same_shapes} "
+          f"max_abs_diff={max_diff:.2e} within_tolerance={max_diff <= args.atol}")
+    print(f"per-patch PIL: {1000 * pil_time / len(images):.1f}ms/image, "
+          f"tensor: {1000 * tensor_time / len(images):.1f}ms/image, speedup={pil_time / tensor_time:.2f}x")
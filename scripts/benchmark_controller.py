@@ -0,0 +1,141 @@
+"""
+Load test of the controller's stream proxying against local stand-in workers.
+
+Starts `--num-workers` stand-in workers that stream `--num-chunks` chunks,
+`--chunk-interval` seconds apart, then opens `--concurrency` streams at once
+through
+  - the previous controller proxy: a sync generator that posts with `requests`
+    (one threadpool slot and one new connection per stream), and
+  - the async controller of llava/serve/controller.py,
+and reports the wall time and the number of streams served concurrently.
+
+Usage:
+    python scripts/benchmark_controller.py --concurrency 256
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import threading
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+import httpx
+import requests
+import uvicorn
+
+import llava.serve.controller as controller_lib
+from llava.serve.controller import Controller
+
+
+MODEL_NAME = "stand-in"
+
+
+def build_worker_app(num_chunks, chunk_interval):
+    app = FastAPI()
+
+    @app.post("/worker_get_status")
+    async def get_status():
+        return {"model_names": [MODEL_NAME], "speed": 1, "queue_length": 0}
+
+    @app.post("/worker_generate_stream")
+    async def generate_stream(request: Request):
+        await request.json()
+
+        async def generator():
+            text = ""
+            for i in range(num_chunks):
+                await asyncio.sleep(chunk_interval)
+                text += f" token{i}"
+                yield json.dumps({"text": text, "error_code": 0}).encode() + b"\0"
+        return StreamingResponse(generator())
+
+    return app
+
+
+def build_legacy_proxy_app(worker_addrs):
+    """The blocking proxy of the previous controller, with round-robin dispatch."""
+    app = FastAPI()
+    workers = itertools.cycle(worker_addrs)
+
+    def generate_stream(worker_addr, params):
+        response = requests.post(worker_addr + "/worker_generate_stream",
+            json=params, stream=True, timeout=5)
+        for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
+            if chunk:
+                yield chunk + b"\0"
+
+    @app.post("/worker_generate_stream")
+    async def worker_api_generate_stream(request: Request):
+        params = await request.json()
+        return StreamingResponse(generate_stream(next(workers), params))
+
+    return app
+
+
+def serve(app, port):
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+async def stream(client, url):
+    start = time.perf_counter()
+    first_chunk = None
+    num_chunks = 0
+    async with client.stream("POST", url + "/worker_generate_stream", json={"model": MODEL_NAME, "prompt": ""}) as response:
+        async for data in response.aiter_bytes():
+            if first_chunk is None:
+                first_chunk = time.perf_counter() - start
+            num_chunks += data.count(b"\0")
+    return first_chunk, num_chunks
+
+
+async def load_test(url, concurrency):
+    async with httpx.AsyncClient(timeout=None, limits=httpx.Limits(max_connections=None)) as client:
+        start = time.perf_counter()
+        results = await asyncio.gather(*[stream(client, url) for _ in range(concurrency)])
+        wall_time = time.perf_counter() - start
+    first_chunks = sorted(x[0] for x in results if x[0] is not None)
+    return wall_time, first_chunks, sum(x[1] for x in results)
+
+
+def report(name, args, wall_time, first_chunks, num_chunks):
+    stream_time = args.num_chunks * args.chunk_interval
+    print(f"{name}: wall={wall_time:.2f}s chunks={num_chunks}/{args.concurrency * args.num_chunks} "
+          f"concurrent_streams={args.concurrency * stream_time / wall_time:.1f} "
+          f"first_chunk_p50={first_chunks[len(first_chunks) // 2]:.3f}s first_chunk_max={first_chunks[-1]:.3f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-workers", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=256)
+    parser.add_argument("--num-chunks", type=int, default=20)
+    parser.add_argument("--chunk-interval", type=float, default=0.1)
+    parser.add_argument("--port", type=int, default=31000)
+    args = parser.parse_args()
+
+    worker_addrs = []
+    for i in range(args.num_workers):
+        port = args.port + 10 + i
+        serve(build_worker_app(args.num_chunks, args.chunk_interval), port)
+        worker_addrs.append(f"http://127.0.0.1:{port}")
+
+    serve(build_legacy_proxy_app(worker_addrs), args.port)
+    legacy_url = f"http://127.0.0.1:{args.port}"
+
+    controller_lib.controller = Controller("shortest_queue")
+    serve(controller_lib.app, args.port + 1)
+    controller_url = f"http://127.0.0.1:{args.port + 1}"
+    for worker_addr in worker_addrs:
+        requests.post(controller_url + "/register_worker", json={
+            "worker_name": worker_addr, "check_heart_beat": False, "worker_status": None})
+
+    print(f"workers={args.num_workers} concurrency={args.concurrency} "
+          f"stream={args.num_chunks}x{args.chunk_interval}s")
+    report("sync requests proxy", args, *asyncio.run(load_test(legacy_url, args.concurrency)))
+    report("async httpx proxy", args, *asyncio.run(load_test(controller_url, args.concurrency)))
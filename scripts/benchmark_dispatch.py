@@ -0,0 +1,125 @@
+"""
+Simulated multi-worker benchmark of the controller dispatch methods.
+
+Simulates workers of different speeds (tokens per second, prompt and generated
+tokens alike) that serve their requests in order, with Poisson arrivals at
+`--load` times the total capacity. Every worker sends a heart beat with its
+queue length and the metrics of a `WorkerMetrics` on the simulated clock every
+`--heart-beat-interval` seconds. Requests are dispatched by
+`Controller.get_worker_address`, and the time to first token is reported for
+every dispatch method.
+
+Usage:
+    python scripts/benchmark_dispatch.py --worker-speeds 2000,2000,1000,500 --load 0.8
+"""
+import argparse
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+
+import numpy as np
+
+import llava.serve.controller as controller_lib
+from llava.constants import WORKER_HEART_BEAT_INTERVAL
+from llava.serve.controller import Controller
+from llava.serve.worker_metrics import WorkerMetrics
+
+
+MODEL_NAME = "stand-in"
+
+
+class SimulatedWorker:
+    def __init__(self, name, speed, clock):
+        self.name = name
+        self.speed = speed
+        self.metrics = WorkerMetrics(clock=clock)
+        self.free_time = 0.0
+        self.num_requests = 0
+
+
+async def simulate(args, dispatch_method, seed):
+    rng = random.Random(seed)
+    np.random.seed(seed)
+    now = 0.0
+    clock = lambda: now
+
+    controller = Controller(dispatch_method)
+    speeds = [float(x) for x in args.worker_speeds.split(",")]
+    workers = {}
+    for i, speed in enumerate(speeds):
+        worker = SimulatedWorker(f"http://worker-{i}", speed, clock)
+        workers[worker.name] = worker
+        await controller.register_worker(worker.name, False, {
+            "model_names": [MODEL_NAME], "speed": 1, "queue_length": 0})
+
+    mean_request_tokens = (args.min_prompt_tokens + args.max_prompt_tokens + args.min_new_tokens + args.max_new_tokens) / 2
+    arrival_rate = args.load * sum(speeds) / mean_request_tokens
+
+    # (time, sequence, kind, payload)
+    events = []
+    sequence = itertools.count()
+    heapq.heappush(events, (rng.expovariate(arrival_rate), next(sequence), "arrival", None))
+    for i, worker in enumerate(workers.values()):
+        # staggered heart beats
+        offset = args.heart_beat_interval * (i + 1) / len(workers)
+        heapq.heappush(events, (offset, next(sequence), "heart_beat", worker))
+
+    ttfts, latencies = [], []
+    num_arrivals = 0
+    while len(events) > 0:
+        now, _, kind, payload = heapq.heappop(events)
+        if kind == "arrival":
+            num_arrivals += 1
+            if num_arrivals < args.num_requests:
+                heapq.heappush(events, (now + rng.expovariate(arrival_rate), next(sequence), "arrival", None))
+            num_input_tokens = rng.randint(args.min_prompt_tokens, args.max_prompt_tokens)
+            num_new_tokens = rng.randint(args.min_new_tokens, args.max_new_tokens)
+            worker = workers[await controller.get_worker_address(MODEL_NAME)]
+            handle = worker.metrics.start(num_input_tokens, num_new_tokens)
+            worker.num_requests += 1
+            start_time = max(now, worker.free_time)
+            first_token_time = start_time + num_input_tokens / worker.speed
+            worker.free_time = first_token_time + num_new_tokens / worker.speed
+            heapq.heappush(events, (first_token_time, next(sequence), "first_token", (worker, handle)))
+            heapq.heappush(events, (worker.free_time, next(sequence), "finish", (worker, handle, num_new_tokens)))
+            if num_arrivals > args.num_warmup_requests:
+                ttfts.append(first_token_time - now)
+                latencies.append(worker.free_time - now)
+        elif kind == "first_token":
+            worker, handle = payload
+            worker.metrics.first_token(handle)
+        elif kind == "finish":
+            worker, handle, num_new_tokens = payload
+            worker.metrics.finish(handle, num_new_tokens)
+            worker.num_requests -= 1
+        elif kind == "heart_beat":
+            worker = payload
+            controller.receive_heart_beat(worker.name, worker.num_requests, worker.metrics.snapshot())
+            if num_arrivals < args.num_requests:
+                heapq.heappush(events, (now + args.heart_beat_interval, next(sequence), "heart_beat", worker))
+    return np.array(ttfts), np.array(latencies)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--worker-speeds", type=str, default="2000,2000,1000,500",
+        help="Comma separated tokens per second of every worker.")
+    parser.add_argument("--load", type=float, default=0.8)
+    parser.add_argument("--num-requests", type=int, default=20000)
+    parser.add_argument("--num-warmup-requests", type=int, default=1000)
+    parser.add_argument("--min-prompt-tokens", type=int, default=100)
+    parser.add_argument("--max-prompt-tokens", type=int, default=3000)
+    parser.add_argument("--min-new-tokens", type=int, default=20)
+    parser.add_argument("--max-new-tokens", type=int, default=500)
+    parser.add_argument("--heart-beat-interval", type=float, default=WORKER_HEART_BEAT_INTERVAL)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    controller_lib.logger.setLevel(logging.WARNING)
+    print(f"workers={args.worker_speeds} load={args.load} heart_beat_interval={args.heart_beat_interval}s")
+    for dispatch_method in ["lottery", "shortest_queue", "load_aware"]:
+        ttfts, latencies = asyncio.run(simulate(args, dispatch_method, args.seed))
+        print(f"{dispatch_method:>14}: ttft mean={ttfts.mean():.2f}s p50={np.percentile(ttfts, 50):.2f}s "
+              f"p99={np.percentile(ttfts, 99):.2f}s latency mean={latencies.mean():.2f}s p99={np.percentile(latencies, 99):.2f}s")
@@ -0,0 +1,120 @@
+"""
+CPU benchmark of the paged KV cache against dynamically concatenated per-batch KV tensors.
+See scripts/check_kv_cache.py for the check that both give the same logits.
+
+Simulates a stream of chat requests with random prompt / generation lengths,
+decoded together as in the continuous batching scheduler, and reports the peak
+KV memory (in token slots), block utilisation, fragmentation and step latency.
+
+Usage:
+    python scripts/benchmark_kv_cache.py --num-requests 64 --max-batch-size 16
+"""
+import argparse
+import random
+import time
+
+import torch
+
+from llava.model.kv_cache import PagedKVCache
+
+
+def simulate(args, paged):
+    rng = random.Random(args.seed)
+    requests = [(rng.randint(args.min_prompt_len, args.max_prompt_len), rng.randint(1, args.max_new_tokens))
+                for _ in range(args.num_requests)]
+    heads, dim = args.num_kv_heads, args.head_dim
+
+    kv_cache = PagedKVCache(1, heads, dim, args.num_blocks, block_size=args.block_size, dtype=torch.float32) if paged else None
+    past = None  # contiguous: (batch, heads, len, dim), left-padded
+    lengths = []
+    running = []  # (seq_id, remaining_tokens)
+
+    peak_slots, utilization, fragmentation, steps, step_time = 0, [], [], 0, 0.0
+    next_id = 0
+    while next_id < len(requests) or len(running) > 0:
+        # admit
+        while next_id < len(requests) and len(running) < args.max_batch_size:
+            prompt_len, gen_len = requests[next_id]
+            if paged and not kv_cache.can_allocate({next_id: prompt_len + gen_len}):
+                break
+            x = torch.randn(1, heads, prompt_len, dim)
+            t0 = time.perf_counter()
+            if paged:
+                kv_cache.add_sequence(next_id)
+                kv_cache.begin_forward([next_id], [prompt_len], prompt_len)
+                kv_cache.update(x, x, 0)
+            else:
+                if past is None:
+                    past = x
+                else:
+                    max_len = max(past.shape[2], prompt_len)
+                    pad = lambda t: torch.cat((t.new_zeros(t.shape[0], heads, max_len - t.shape[2], dim), t), dim=2)
+                    past = torch.cat((pad(past), pad(x)), dim=0)
+                lengths.append(prompt_len)
+            step_time += time.perf_counter() - t0
+            running.append([next_id, gen_len])
+            next_id += 1
+
+        # decode one token for every running sequence
+        x = torch.randn(len(running), heads, 1, dim)
+        t0 = time.perf_counter()
+        if paged:
+            kv_cache.begin_forward([seq_id for seq_id, _ in running], [1] * len(running), 1)
+            kv_cache.update(x, x, 0)
+        else:
+            past = torch.cat((past, x), dim=2)
+            lengths = [l + 1 for l in lengths]
+        step_time += time.perf_counter() - t0
+        steps += 1
+
+        if paged:
+            stats = kv_cache.stats
+            peak_slots = max(peak_slots, stats["used_blocks"] * args.block_size)
+            utilization.append(stats["block_utilization"])
+            fragmentation.append(stats["fragmentation"])
+        else:
+            peak_slots = max(peak_slots, past.shape[0] * past.shape[2])
+            fragmentation.append(1 - sum(lengths) / (past.shape[0] * past.shape[2]))
+
+        # evict finished sequences
+        for r in running:
+            r[1] -= 1
+        keep = [i for i, r in enumerate(running) if r[1] > 0]
+        if paged:
+            for r in running:
+                if r[1] <= 0:
+                    kv_cache.free_sequence(r[0])
+        elif len(keep) == 0:
+            past, lengths = None, []
+        else:
+            past = past[keep]
+            lengths = [lengths[i] for i in keep]
+            start = past.shape[2] - max(lengths)
+            past = past[:, :, start:]
+        running = [running[i] for i in keep]
+
+    return {
+        "peak_kv_slots": peak_slots,
+        "mean_block_utilization": sum(utilization) / len(utilization) if utilization else None,
+        "mean_fragmentation": sum(fragmentation) / len(fragmentation),
+        "steps": steps,
+        "ms_per_step": 1000 * step_time / steps,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-requests", type=int, default=64)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--min-prompt-len", type=int, default=64)
+    parser.add_argument("--max-prompt-len", type=int, default=1024)
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--num-blocks", type=int, default=2048)
+    parser.add_argument("--block-size", type=int, default=16)
+    parser.add_argument("--num-kv-heads", type=int, default=8)
+    parser.add_argument("--head-dim", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for name, paged in (("contiguous", False), ("paged", True)):
+        print(name, simulate(args, paged))
@@ -0,0 +1,107 @@
+"""
+Benchmark of the batched multimodal input merge against the per-sample loop.
+
+Builds random batches of text tokens with image placeholders and random image
+features, checks that `merge_multimodal_inputs_batched` is bit-exact with
+`merge_multimodal_inputs_loop` for both padding sides, and reports the time
+per batch of each implementation.
+
+Usage:
+    python scripts/benchmark_mm_merge.py --batch-size 16 --device cuda
+"""
+import argparse
+import random
+import time
+from types import SimpleNamespace
+
+import torch
+import torch.nn as nn
+
+from llava.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX
+from llava.model.llava_arch import LlavaMetaForCausalLM
+
+
+class MergeOnlyModel(LlavaMetaForCausalLM):
+    """Just enough of a LLaVA model to run the input merge."""
+
+    def __init__(self, config, vocab_size, hidden_size, device, dtype):
+        self.config = config
+        self.embed_tokens = nn.Embedding(vocab_size, hidden_size).to(device=device, dtype=dtype)
+
+    def get_model(self):
+        return self
+
+    @property
+    def device(self):
+        return self.embed_tokens.weight.device
+
+
+def make_batch(args, rng, device, dtype):
+    input_ids, labels, image_features = [], [], []
+    for _ in range(args.batch_size):
+        num_images = rng.choice([0, 1, 1, 1, 2])
+        ids = [rng.randrange(1, args.vocab_size) for _ in range(rng.randint(args.min_text_len, args.max_text_len))]
+        for _ in range(num_images):
+            ids.insert(rng.randrange(len(ids) + 1), IMAGE_TOKEN_INDEX)
+        # samples without image tokens still consume one image
+        for _ in range(max(num_images, 1)):
+            num_features = args.image_tokens if not args.anyres else rng.choice([576, 1728, 2304, 2880])
+            image_features.append(torch.randn(num_features, args.hidden_size, device=device, dtype=dtype))
+        input_ids.append(torch.tensor(ids, dtype=torch.long))
+        labels.append(torch.tensor([IGNORE_INDEX if x == IMAGE_TOKEN_INDEX or rng.random() < 0.3 else x for x in ids], dtype=torch.long))
+
+    attention_mask = [torch.ones_like(x, dtype=torch.bool) for x in input_ids]
+    input_ids = torch.nn.utils.rnn.pad_sequence(input_ids, batch_first=True, padding_value=0).to(device)
+    labels = torch.nn.utils.rnn.pad_sequence(labels, batch_first=True, padding_value=IGNORE_INDEX).to(device)
+    attention_mask = torch.nn.utils.rnn.pad_sequence(attention_mask, batch_first=True, padding_value=False).to(device)
+    position_ids = torch.arange(0, input_ids.shape[1], dtype=torch.long, device=device)
+    if not args.anyres:
+        image_features = torch.stack(image_features, dim=0)
+    return input_ids, attention_mask, position_ids, labels, image_features
+
+
+def timeit(fn, device, repeats):
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return 1000 * (time.perf_counter() - t0) / repeats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--min-text-len", type=int, default=32)
+    parser.add_argument("--max-text-len", type=int, default=512)
+    parser.add_argument("--image-tokens", type=int, default=576)
+    parser.add_argument("--anyres", action="store_true", help="Use a variable number of image features per image.")
+    parser.add_argument("--hidden-size", type=int, default=1024)
+    parser.add_argument("--vocab-size", type=int, default=32000)
+    parser.add_argument("--model-max-length", type=int, default=None)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    dtype = torch.float16 if device.type == "cuda" else torch.float32
+    rng = random.Random(args.seed)
+    torch.manual_seed(args.seed)
+
+    for padding_side in ("right", "left"):
+        config = SimpleNamespace(tokenizer_padding_side=padding_side, tokenizer_model_max_length=args.model_max_length)
+        model = MergeOnlyModel(config, args.vocab_size, args.hidden_size, device, dtype)
+        batch = make_batch(args, rng, device, dtype)
+
+        with torch.no_grad():
+            expected = model.merge_multimodal_inputs_loop(*batch)
+            actual = model.merge_multimodal_inputs_batched(*batch)
+            exact = all(torch.equal(x, y) and x.dtype == y.dtype for x, y in zip(expected, actual))
+            loop_ms = timeit(lambda: model.merge_multimodal_inputs_loop(*batch), device, args.repeats)
+            batched_ms = timeit(lambda: model.merge_multimodal_inputs_batched(*batch), device, args.repeats)
+        print(f"padding_side={padding_side} bit_exact={exact} "
+              f"loop={loop_ms:.2f}ms batched={batched_ms:.2f}ms speedup={loop_ms / batched_ms:.2f}x")
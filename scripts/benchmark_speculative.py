@@ -0,0 +1,140 @@
+"""
+Acceptance rate and speedup of speculative decoding in `LlavaLlamaForCausalLM.generate`.
+
+Decodes the same multimodal prompt greedily with `generate` as before, and with
+a drafter from `llava.model.speculative`, asserts that both produce the same
+tokens, and reports the acceptance rate of the draft tokens and the speedup.
+See scripts/check_speculative.py for the check of `generate` of every model.
+
+Without --model-path, runs on CPU with a tiny random model, with random
+embeddings in place of the image features of the prompt. The prompt repeats a
+passage, so that prompt lookup finds matches, as with OCR-like answers.
+
+Usage:
+    python scripts/benchmark_speculative.py --drafter prompt_lookup
+    python scripts/benchmark_speculative.py --drafter draft_model --draft-layers 1
+    python scripts/benchmark_speculative.py --model-path liuhaotian/llava-v1.5-7b --image-file view.jpg \\
+        --query "Transcribe the text in the image." --drafter prompt_lookup
+"""
+import argparse
+import random
+import time
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from llava.constants import IMAGE_TOKEN_INDEX
+from llava.model.language_model.llava_llama import LlavaConfig, LlavaLlamaForCausalLM
+from llava.model.speculative import DraftModelDrafter, PromptLookupDrafter, speculative_generate
+
+
+def tiny_random_inputs(args):
+    torch.manual_seed(args.seed)
+    rng = random.Random(args.seed)
+    config = dict(vocab_size=512, hidden_size=64, intermediate_size=128, num_attention_heads=4,
+                  num_key_value_heads=4, max_position_embeddings=4096)
+    model = LlavaLlamaForCausalLM(LlavaConfig(num_hidden_layers=args.num_layers, **config)).eval()
+    # no end of sequence, so that both decode max_new_tokens
+    model.generation_config.eos_token_id = None
+    draft_model = None
+    if args.drafter == "draft_model":
+        draft_model = LlamaForCausalLM(LlamaConfig(num_hidden_layers=args.draft_layers, **config)).eval()
+
+    passage = [rng.randrange(3, 512) for _ in range(64)]
+    before = [1] + [rng.randrange(3, 512) for _ in range(8)]
+    after = passage * 3
+    prompt_ids = torch.tensor([before + [IMAGE_TOKEN_INDEX] + after])
+    embed_tokens = model.get_model().embed_tokens
+    with torch.no_grad():
+        inputs_embeds = torch.cat([
+            embed_tokens(torch.tensor([before])),
+            torch.randn(1, args.num_image_tokens, config["hidden_size"]) * embed_tokens.weight.std(),
+            embed_tokens(torch.tensor([after])),
+        ], dim=1)
+    return model, draft_model, prompt_ids, inputs_embeds
+
+
+def pretrained_inputs(args):
+    from PIL import Image
+    from llava.conversation import conv_templates
+    from llava.mm_utils import get_model_name_from_path, process_images, tokenizer_image_token
+    from llava.model.builder import load_pretrained_model
+    from transformers import AutoModelForCausalLM
+
+    model_name = get_model_name_from_path(args.model_path)
+    tokenizer, model, image_processor, _ = load_pretrained_model(args.model_path, None, model_name, device=args.device)
+    draft_model = None
+    if args.drafter == "draft_model":
+        draft_model = AutoModelForCausalLM.from_pretrained(
+            args.draft_model_path, torch_dtype=torch.float16).to(model.device).eval()
+
+    conv = conv_templates[args.conv_mode].copy()
+    conv.append_message(conv.roles[0], "<image>\n" + args.query)
+    conv.append_message(conv.roles[1], None)
+    prompt_ids = tokenizer_image_token(conv.get_prompt(), tokenizer, IMAGE_TOKEN_INDEX, return_tensors="pt").unsqueeze(0).to(model.device)
+    image = Image.open(args.image_file).convert("RGB")
+    images = process_images([image], image_processor, model.config).to(model.device, dtype=torch.float16)
+    with torch.no_grad():
+        _, _, _, _, inputs_embeds, _ = model.prepare_inputs_labels_for_multimodal(
+            prompt_ids, None, None, None, None, images, image_sizes=[image.size])
+    return model, draft_model, prompt_ids, inputs_embeds
+
+
+def timed(fn):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    result = fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, default=None,
+        help="A LLaVA checkpoint; a tiny random model on CPU if not set.")
+    parser.add_argument("--image-file", type=str, default=None)
+    parser.add_argument("--query", type=str, default="Transcribe the text in the image.")
+    parser.add_argument("--conv-mode", type=str, default="llava_v1")
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--drafter", type=str, default="prompt_lookup", choices=["prompt_lookup", "draft_model"])
+    parser.add_argument("--draft-model-path", type=str, default=None)
+    parser.add_argument("--num-draft-tokens", type=int, default=5)
+    parser.add_argument("--max-new-tokens", type=int, default=256)
+    parser.add_argument("--num-layers", type=int, default=4, help="Layers of the tiny random model.")
+    parser.add_argument("--draft-layers", type=int, default=1, help="Layers of the tiny random draft model.")
+    parser.add_argument("--num-image-tokens", type=int, default=576)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.model_path is None:
+        model, draft_model, prompt_ids, inputs_embeds = tiny_random_inputs(args)
+    else:
+        model, draft_model, prompt_ids, inputs_embeds = pretrained_inputs(args)
+
+    if args.drafter == "prompt_lookup":
+        drafter = PromptLookupDrafter(num_draft_tokens=args.num_draft_tokens)
+    else:
+        drafter = DraftModelDrafter(draft_model, num_draft_tokens=args.num_draft_tokens)
+
+    with torch.no_grad():
+        # the generate of LlavaLlamaForCausalLM without images, from the same inputs_embeds
+        baseline, baseline_time = timed(lambda: LlamaForCausalLM.generate(
+            model, inputs_embeds=inputs_embeds, do_sample=False, num_beams=1,
+            max_new_tokens=args.max_new_tokens, use_cache=True))
+        # what it runs with a drafter, after merging the image features into inputs_embeds
+        speculative, speculative_time = timed(lambda: speculative_generate(
+            model, inputs_embeds, drafter, prompt_ids=prompt_ids, max_new_tokens=args.max_new_tokens))
+
+    stats = drafter.stats
+    num_tokens = speculative.shape[1]
+    print(f"prefix={inputs_embeds.shape[1]} tokens, generated={num_tokens} tokens, drafter={args.drafter}, "
+          f"num_draft_tokens={args.num_draft_tokens}")
+    assert torch.equal(baseline.cpu(), speculative.cpu()), \
+        f"speculative decoding changed the greedy output: {speculative.tolist()} != {baseline.tolist()}"
+    print("same tokens as greedy generate: True")
+    print(f"acceptance rate: {stats['acceptance_rate']:.1%} ({stats['accepted']}/{stats['drafted']} draft tokens), "
+          f"{num_tokens / (stats['steps'] + 1):.2f} tokens per forward pass")
+    print(f"generate: {1e3 * baseline_time / num_tokens:.1f}ms/token, "
+          f"speculative: {1e3 * speculative_time / num_tokens:.1f}ms/token, speedup={baseline_time / speculative_time:.2f}x")
@@ -0,0 +1,108 @@
+"""
+Time per generated token of the stop string check, before and after
+`StopSequenceMatcher`.
+
+Generates a batch of random token rows, plants the stop string (tokenized
+alone, and tokenized after other text) in some of them, and feeds the rows one
+token at a time to the previous `KeywordsStoppingCriteria`, one row at a time,
+and to the new one, for the whole batch. Checks that both find the same first
+stop of every row, and reports the time per step.
+
+Usage:
+    python scripts/benchmark_stop_matcher.py --model-path lmsys/vicuna-7b-v1.5 --stop-str "</s>" --batch-size 16
+"""
+import argparse
+import random
+import time
+
+import torch
+import transformers
+
+from llava.mm_utils import KeywordsStoppingCriteria
+
+
+class LegacyKeywordsStoppingCriteria:
+    """The stopping criteria before `StopSequenceMatcher`, for one row."""
+
+    def __init__(self, keywords, tokenizer, input_ids):
+        self.keywords = keywords
+        self.keyword_ids = []
+        self.max_keyword_len = 0
+        for keyword in keywords:
+            cur_keyword_ids = tokenizer(keyword).input_ids
+            if len(cur_keyword_ids) > 1 and cur_keyword_ids[0] == tokenizer.bos_token_id:
+                cur_keyword_ids = cur_keyword_ids[1:]
+            if len(cur_keyword_ids) > self.max_keyword_len:
+                self.max_keyword_len = len(cur_keyword_ids)
+            self.keyword_ids.append(torch.tensor(cur_keyword_ids))
+        self.tokenizer = tokenizer
+        self.start_len = input_ids.shape[1]
+
+    def call_for_batch(self, output_ids):
+        offset = min(output_ids.shape[1] - self.start_len, self.max_keyword_len)
+        self.keyword_ids = [keyword_id.to(output_ids.device) for keyword_id in self.keyword_ids]
+        for keyword_id in self.keyword_ids:
+            truncated_output_ids = output_ids[0, -keyword_id.shape[0]:]
+            if torch.equal(truncated_output_ids, keyword_id):
+                return True
+        outputs = self.tokenizer.batch_decode(output_ids[:, -offset:], skip_special_tokens=True)[0]
+        for keyword in self.keywords:
+            if keyword in outputs:
+                return True
+        return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, default="lmsys/vicuna-7b-v1.5")
+    parser.add_argument("--stop-str", type=str, default="###")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--num-tokens", type=int, default=512)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained(args.model_path, use_fast=False)
+    rng = random.Random(args.seed)
+    stop_variants = [
+        tokenizer(args.stop_str, add_special_tokens=False).input_ids,
+        tokenizer("Done." + args.stop_str, add_special_tokens=False).input_ids,
+    ]
+    rows = []
+    for i in range(args.batch_size):
+        row = [rng.randrange(3, tokenizer.vocab_size) for _ in range(args.num_tokens)]
+        if i % 2 == 0:
+            # plant a stop string in half of the rows
+            variant = stop_variants[(i // 2) % len(stop_variants)]
+            position = rng.randrange(args.num_tokens // 2, args.num_tokens - len(variant))
+            row[position:position + len(variant)] = variant
+        rows.append(row)
+    prompt = torch.ones((args.batch_size, 8), dtype=torch.long, device=args.device)
+    output_ids = torch.cat((prompt, torch.tensor(rows, device=args.device)), dim=1)
+
+    legacy = [LegacyKeywordsStoppingCriteria([args.stop_str], tokenizer, prompt) for _ in range(args.batch_size)]
+    legacy_stops = [None] * args.batch_size
+    start = time.perf_counter()
+    for step in range(1, args.num_tokens + 1):
+        for i in range(args.batch_size):
+            if legacy[i].call_for_batch(output_ids[i:i + 1, :prompt.shape[1] + step]) and legacy_stops[i] is None:
+                legacy_stops[i] = step
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    criteria = KeywordsStoppingCriteria([args.stop_str], tokenizer, prompt)
+    setup_time = time.perf_counter() - start
+    stops = [None] * args.batch_size
+    start = time.perf_counter()
+    for step in range(1, args.num_tokens + 1):
+        criteria(output_ids[:, :prompt.shape[1] + step], None)
+        for i in criteria.stopped.nonzero()[:, 0].tolist():
+            if stops[i] is None:
+                stops[i] = step
+    matcher_time = time.perf_counter() - start
+
+    print(f"stop_str={args.stop_str!r} batch_size={args.batch_size} tokens={args.num_tokens} device={args.device}")
+    print(f"same first stops: {stops == legacy_stops} ({sum(x is not None for x in stops)} rows stopped)")
+    print(f"legacy: {1e6 * legacy_time / args.num_tokens:.0f}us/step, "
+          f"matcher: {1e6 * matcher_time / args.num_tokens:.0f}us/step "
+          f"(one-off setup {setup_time:.2f}s, shared per tokenizer), speedup={legacy_time / matcher_time:.1f}x")
@@ -0,0 +1,95 @@
+"""
+Bytes on the wire and CPU time per token of the worker stream protocols.
+
+Replays a long generation token by token through
+  - protocol 1 as the worker produced it before: the whole output decoded
+    again and sent with the prompt on every token, and
+  - protocol 2: `IncrementalDetokenizer` and delta chunks of `TextStream`,
+checks that both end with the same text, and reports the bytes sent and the
+CPU time per token.
+
+Usage:
+    python scripts/benchmark_stream_protocol.py --model-path lmsys/vicuna-7b-v1.5 --num-tokens 2048
+"""
+import argparse
+import json
+import random
+import time
+
+import transformers
+
+from llava.serve.streaming import DELTA_PROTOCOL, IncrementalDetokenizer, TextStream
+
+
+SAMPLE_TEXT = (
+    "The image shows a busy street market in the evening. Vendors sell fruit, spices and "
+    "textiles under bright lamps, and a sign reads «Marché de nuit — 夜市 — ночной рынок». "
+    "Prices are listed as 3,50 € or ¥480, and a child holds a balloon 🎈 next to a cart. "
+)
+
+
+def replay_legacy(tokenizer, prompt, token_ids):
+    num_bytes = 0
+    output_ids, output_text = [], ""
+    for i, token in enumerate(token_ids):
+        output_ids.append(token)
+        text = tokenizer.decode(output_ids, skip_special_tokens=True)
+        finished = i == len(token_ids) - 1
+        if text != output_text and (finished or not text.endswith('�')):
+            output_text = text
+            num_bytes += len(json.dumps({"text": prompt + text, "error_code": 0}).encode()) + 1
+    return num_bytes, output_text
+
+
+def replay_delta(tokenizer, prompt, token_ids):
+    num_bytes = 0
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    stream = TextStream(prompt, protocol=DELTA_PROTOCOL)
+    for i, token in enumerate(token_ids):
+        delta = detokenizer.add(token)
+        if i == len(token_ids) - 1:
+            delta += detokenizer.flush()
+        chunk = stream.push(delta)
+        if chunk is not None:
+            num_bytes += len(chunk)
+    num_bytes += len(stream.finish("length", len(token_ids)))
+    return num_bytes, stream.text
+
+
+def measure(fn, *args):
+    start = time.process_time()
+    result = fn(*args)
+    return result, time.process_time() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, default="lmsys/vicuna-7b-v1.5")
+    parser.add_argument("--num-tokens", type=int, default=2048)
+    parser.add_argument("--prompt-length", type=int, default=1000,
+        help="Characters of the prompt, which protocol 1 sends with every chunk.")
+    parser.add_argument("--random-tokens", action="store_true",
+        help="Replay random token ids instead of the tokenized sample text.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained(args.model_path, use_fast=False)
+    if args.random_tokens:
+        rng = random.Random(args.seed)
+        token_ids = [rng.randrange(3, tokenizer.vocab_size) for _ in range(args.num_tokens)]
+    else:
+        token_ids = []
+        while len(token_ids) < args.num_tokens:
+            token_ids += tokenizer(SAMPLE_TEXT, add_special_tokens=False).input_ids
+        token_ids = token_ids[:args.num_tokens]
+    prompt = ("USER: <image>\nDescribe the image in detail. " * args.prompt_length)[:args.prompt_length] + " ASSISTANT:"
+
+    (legacy_bytes, legacy_text), legacy_time = measure(replay_legacy, tokenizer, prompt, token_ids)
+    (delta_bytes, delta_text), delta_time = measure(replay_delta, tokenizer, prompt, token_ids)
+
+    print(f"tokens={len(token_ids)} prompt_chars={len(prompt)} same_text={legacy_text == delta_text}")
+    print(f"protocol 1: {legacy_bytes / 1e6:.2f}MB ({legacy_bytes / len(token_ids):.0f}B/token), "
+          f"{1e6 * legacy_time / len(token_ids):.0f}us/token")
+    print(f"protocol 2: {delta_bytes / 1e6:.2f}MB ({delta_bytes / len(token_ids):.0f}B/token), "
+          f"{1e6 * delta_time / len(token_ids):.0f}us/token")
+    print(f"gain: {legacy_bytes / delta_bytes:.1f}x fewer bytes, {legacy_time / max(delta_time, 1e-9):.1f}x less CPU")
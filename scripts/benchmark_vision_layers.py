@@ -0,0 +1,91 @@
+"""
+Latency and memory of the vision tower features, with all hidden states as
+before, and with the encoder run only up to `mm_vision_select_layer`.
+
+Uses a tiny random CLIP vision model by default, saved to a temporary directory
+so that the tower loads it as a pretrained one, or a real one with
+--vision-tower. Checks that both give identical features. Reports the peak
+memory on CUDA, and on CPU the memory of the hidden states that are kept.
+
+Usage:
+    python scripts/benchmark_vision_layers.py --batch-size 16
+    python scripts/benchmark_vision_layers.py --vision-tower openai/clip-vit-large-patch14-336 --device cuda --batch-size 64
+"""
+import argparse
+import tempfile
+import time
+from types import SimpleNamespace
+
+import torch
+from transformers import CLIPImageProcessor, CLIPVisionConfig, CLIPVisionModel
+
+from llava.model.multimodal_encoder.clip_encoder import CLIPVisionTower
+
+
+def measure(tower, images, repeats):
+    tower(images)
+    if images.device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base_memory = torch.cuda.memory_allocated()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        features = tower(images)
+    if images.device.type == "cuda":
+        torch.cuda.synchronize()
+        peak_memory = torch.cuda.max_memory_allocated() - base_memory
+    else:
+        peak_memory = None
+    return features, (time.perf_counter() - start) / repeats, peak_memory
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vision-tower", type=str, default=None,
+        help="A CLIP vision tower; a tiny random one if not set.")
+    parser.add_argument("--select-layer", type=int, default=-2)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--image-size", type=int, default=224)
+    parser.add_argument("--hidden-size", type=int, default=128)
+    parser.add_argument("--num-layers", type=int, default=6)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    with tempfile.TemporaryDirectory() as model_dir:
+        if args.vision_tower is None:
+            config = CLIPVisionConfig(
+                hidden_size=args.hidden_size, intermediate_size=4 * args.hidden_size,
+                num_hidden_layers=args.num_layers, num_attention_heads=4,
+                image_size=args.image_size, patch_size=14)
+            CLIPVisionModel(config).save_pretrained(model_dir)
+            CLIPImageProcessor(crop_size=args.image_size, size=args.image_size).save_pretrained(model_dir)
+            vision_tower = model_dir
+        else:
+            vision_tower = args.vision_tower
+        tower = CLIPVisionTower(vision_tower, SimpleNamespace(mm_vision_select_layer=args.select_layer))
+        tower = tower.to(device=args.device, dtype=getattr(torch, args.dtype)).eval()
+
+    config = tower.config
+    images = torch.randn(args.batch_size, 3, config.image_size, config.image_size,
+                         device=args.device, dtype=tower.dtype)
+    tower.truncate_layers = False
+    full, full_time, full_memory = measure(tower, images, args.repeats)
+    tower.truncate_layers = True
+    truncated, truncated_time, truncated_memory = measure(tower, images, args.repeats)
+
+    num_tokens = (config.image_size // config.patch_size) ** 2 + 1
+    hidden_state_bytes = args.batch_size * num_tokens * config.hidden_size * images.element_size()
+    print(f"batch={args.batch_size} layers={config.num_hidden_layers} select_layer={args.select_layer} "
+          f"(runs {tower.num_selected_layers} layers) device={args.device} dtype={args.dtype}")
+    print(f"identical features: {torch.equal(full, truncated)}")
+    print(f"all hidden states: {1e3 * full_time:.1f}ms, selected layer only: {1e3 * truncated_time:.1f}ms, "
+          f"speedup={full_time / truncated_time:.2f}x")
+    if full_memory is not None:
+        print(f"peak memory: {full_memory / 2**20:.1f}MB -> {truncated_memory / 2**20:.1f}MB")
+    else:
+        print(f"hidden states kept: {(config.num_hidden_layers + 1) * hidden_state_bytes / 2**20:.1f}MB -> "
+              f"{hidden_state_bytes / 2**20:.1f}MB")
@@ -0,0 +1,78 @@
+"""
+Time of `CLIPVisionTower.forward` on a list of images, one forward per image as
+before, and batched by shape with different micro-batch sizes.
+
+Runs on CPU with a tiny random CLIP vision model, saved to a temporary
+directory so that the tower loads it as a pretrained one. Checks that the
+batched features match the per-image ones, in the same order.
+
+Usage:
+    python scripts/benchmark_vision_tower.py --num-images 32 --micro-batch-sizes 0,4,16
+"""
+import argparse
+import tempfile
+import time
+from types import SimpleNamespace
+
+import torch
+from transformers import CLIPImageProcessor, CLIPVisionConfig, CLIPVisionModel
+
+from llava.model.multimodal_encoder.clip_encoder import CLIPVisionTower
+
+
+def legacy_forward(tower, images):
+    """`CLIPVisionTower.forward` on a list before batching: one forward per image."""
+    image_features = []
+    for image in images:
+        image_forward_out = tower.vision_tower(image.to(device=tower.device, dtype=tower.dtype).unsqueeze(0), output_hidden_states=True)
+        image_features.append(tower.feature_select(image_forward_out).to(image.dtype))
+    return image_features
+
+
+def measure(fn, repeats):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = fn()
+    return result, (time.perf_counter() - start) / repeats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-images", type=int, default=32)
+    parser.add_argument("--image-size", type=int, default=224)
+    parser.add_argument("--patch-size", type=int, default=14)
+    parser.add_argument("--hidden-size", type=int, default=128)
+    parser.add_argument("--num-layers", type=int, default=4)
+    parser.add_argument("--micro-batch-sizes", type=str, default="0,4,16",
+        help="Comma separated; 0 runs all images of the same shape at once.")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=0, help="torch CPU threads, 0 keeps the default.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+    config = CLIPVisionConfig(
+        hidden_size=args.hidden_size, intermediate_size=4 * args.hidden_size,
+        num_hidden_layers=args.num_layers, num_attention_heads=4,
+        image_size=args.image_size, patch_size=args.patch_size)
+    images = [torch.randn(3, args.image_size, args.image_size) for _ in range(args.num_images)]
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        CLIPVisionModel(config).save_pretrained(model_dir)
+        CLIPImageProcessor(crop_size=args.image_size, size=args.image_size).save_pretrained(model_dir)
+        tower = CLIPVisionTower(model_dir, SimpleNamespace(mm_vision_select_layer=-2)).eval()
+
+        with torch.no_grad():
+            reference, legacy_time = measure(lambda: legacy_forward(tower, images), args.repeats)
+        print(f"images={args.num_images} size={args.image_size} hidden={args.hidden_size} layers={args.num_layers} "
+              f"threads={torch.get_num_threads()}")
+        print(f"per image: {1e3 * legacy_time:.1f}ms")
+        for micro_batch_size in map(int, args.micro_batch_sizes.split(",")):
+            tower.micro_batch_size = micro_batch_size
+            features, batched_time = measure(lambda: tower(images), args.repeats)
+            max_diff = max((x - y).abs().max().item() for x, y in zip(features, reference))
+            print(f"batched, micro_batch_size={micro_batch_size}: {1e3 * batched_time:.1f}ms, "
+                  f"speedup={legacy_time / batched_time:.2f}x, max abs diff={max_diff:.2e}")
@@ -0,0 +1,165 @@
+"""
+CPU check that the paged KV cache gives the logits of the contiguous KV cache of `transformers`.
+
+Decodes random prompts with a tiny random LLaMA model through `PagedKVCache`, as
+the continuous batching scheduler does, and compares the logits of every step
+with decoding each sequence alone with the contiguous (legacy) KV cache:
+
+1. a left-padded batched prefill and batched decoding, across block boundaries;
+2. a new sequence that reuses the freed blocks of a finished one, decoded
+   together with a running sequence;
+3. sequences forked from a `PrefixCache` entry, after a partial and after a
+   full block, and the cached entry itself, which the forks must not modify.
+
+Fails with an AssertionError on the first mismatch.
+
+Usage:
+    python scripts/check_kv_cache.py
+"""
+import argparse
+import random
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from llava.model.kv_cache import PagedKVCache, PrefixCache
+
+
+@torch.inference_mode()
+def contiguous_logits(model, prompt, continuation):
+    """Logits after the prompt and after every token of the continuation, with the contiguous KV cache."""
+    outputs = model(input_ids=torch.tensor([prompt]), use_cache=True)
+    logits = [outputs.logits[0, -1]]
+    for token in continuation:
+        outputs = model(input_ids=torch.tensor([[token]]), past_key_values=outputs.past_key_values, use_cache=True)
+        logits.append(outputs.logits[0, -1])
+    return torch.stack(logits)
+
+
+@torch.inference_mode()
+def paged_step(model, kv_cache, seq_ids, inputs):
+    """One forward pass of the new tokens of every sequence, left-padded. Returns the last logits of every row."""
+    input_length = max(len(x) for x in inputs)
+    kv_cache.begin_forward(seq_ids, [len(x) for x in inputs], input_length)
+    outputs = model(
+        input_ids=torch.tensor([[0] * (input_length - len(x)) + x for x in inputs]),
+        attention_mask=kv_cache.attention_mask(),
+        position_ids=kv_cache.position_ids(input_length),
+        past_key_values=kv_cache,
+        use_cache=True,
+        return_dict=True,
+    )
+    return outputs.logits[:, -1]
+
+
+class Checker:
+    def __init__(self, model, kv_cache, atol):
+        self.model = model
+        self.kv_cache = kv_cache
+        self.atol = atol
+        # tokens fed to every sequence, and the logits of every step from the end of its prompt
+        self.prompts = {}
+        self.tokens = {}
+        self.logits = {}
+
+    def prefill(self, seq_ids, prompts, num_cached=None):
+        num_cached = num_cached or [0] * len(seq_ids)
+        logits = paged_step(self.model, self.kv_cache, seq_ids, [p[n:] for p, n in zip(prompts, num_cached)])
+        for seq_id, prompt, row in zip(seq_ids, prompts, logits):
+            self.prompts[seq_id] = list(prompt)
+            self.tokens[seq_id] = list(prompt)
+            self.logits[seq_id] = [row]
+
+    def decode(self, seq_ids, num_steps):
+        for _ in range(num_steps):
+            next_tokens = [int(self.logits[seq_id][-1].argmax()) for seq_id in seq_ids]
+            logits = paged_step(self.model, self.kv_cache, seq_ids, [[token] for token in next_tokens])
+            for seq_id, token, row in zip(seq_ids, next_tokens, logits):
+                self.tokens[seq_id].append(token)
+                self.logits[seq_id].append(row)
+
+    def check(self, name, seq_id):
+        prompt = self.prompts[seq_id]
+        expected = contiguous_logits(self.model, prompt, self.tokens[seq_id][len(prompt):])
+        torch.testing.assert_close(torch.stack(self.logits[seq_id]), expected, atol=self.atol, rtol=0)
+        assert self.kv_cache.seq_lens[seq_id] == len(self.tokens[seq_id])
+        print(f"ok: {name} ({len(prompt)} prompt tokens, {len(self.tokens[seq_id]) - len(prompt)} decoded)")
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    rng = random.Random(args.seed)
+    config = LlamaConfig(vocab_size=97, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=256)
+    model = LlamaForCausalLM(config).eval()
+    block_size = args.block_size
+    # small enough that the second phase has to reuse the blocks freed by the first
+    kv_cache = PagedKVCache.from_model_config(config, num_blocks=10, block_size=block_size, dtype=torch.float32)
+    checker = Checker(model, kv_cache, args.atol)
+
+    def random_tokens(n):
+        return [rng.randrange(1, config.vocab_size) for _ in range(n)]
+
+    # 1. batched prefill of prompts of different lengths, and batched decoding
+    a, b, c, d, e, f = range(6)
+    for seq_id in (a, b):
+        kv_cache.add_sequence(seq_id)
+    checker.prefill([a, b], [random_tokens(7), random_tokens(13)])
+    checker.decode([a, b], 6)
+    checker.check("batched prefill and decoding", a)
+    checker.check("batched prefill and decoding, longest row", b)
+
+    # 2. free-list reuse: a new sequence gets the blocks of a finished one, which still hold its keys and values
+    a_blocks = set(kv_cache.block_tables[a])
+    kv_cache.free_sequence(a)
+    kv_cache.add_sequence(c)
+    checker.prefill([c], [random_tokens(10)])
+    checker.decode([b, c], 5)
+    assert len(a_blocks & set(kv_cache.block_tables[c])) > 0, "the freed blocks were not reused"
+    checker.check("decoding with a sequence in reused blocks", b)
+    checker.check("sequence in reused blocks", c)
+
+    # 3. prefix cache: forks of a finished sequence share its full blocks and copy its partial block
+    kv_cache.free_sequence(c)
+    prefix_cache = PrefixCache(kv_cache)
+    b_cached = checker.tokens[b]
+    prefix_cache.insert(b, [(token, 1) for token in b_cached])
+    for seq_id, num_shared in ((d, 2 * block_size + 2), (e, 4 * block_size)):
+        suffix = random_tokens(5)
+        while suffix[0] == b_cached[num_shared]:
+            suffix = random_tokens(5)
+        prompt = b_cached[:num_shared] + suffix
+        src_seq_id, num_cached = prefix_cache.match([(token, 1) for token in prompt])
+        assert (src_seq_id, num_cached) == (b, num_shared)
+        prefix_cache.fork(src_seq_id, seq_id, num_cached)
+        shared_blocks = kv_cache.block_tables[b][:num_shared // block_size]
+        assert kv_cache.block_tables[seq_id][:len(shared_blocks)] == shared_blocks
+        assert all(kv_cache.allocator.ref_counts[block] == 2 for block in shared_blocks)
+        checker.prefill([seq_id], [prompt], num_cached=[num_cached])
+        checker.decode([seq_id], 3)
+        checker.check(f"fork of {num_shared} cached tokens", seq_id)
+        kv_cache.free_sequence(seq_id)
+        assert all(kv_cache.allocator.ref_counts[block] == 1 for block in shared_blocks)
+
+    # the forks wrote after the shared blocks only: the cached sequence still decodes as before
+    src_seq_id, num_cached = prefix_cache.match([(token, 1) for token in b_cached])
+    assert (src_seq_id, num_cached) == (b, len(b_cached))
+    # as in the scheduler, the last prompt position is recomputed to get the logits of the first token
+    num_cached -= 1
+    prefix_cache.fork(b, f, num_cached)
+    checker.prefill([f], [b_cached], num_cached=[num_cached])
+    checker.decode([f], 2)
+    checker.check("cached sequence after the forks", f)
+
+    prefix_cache.clear()
+    kv_cache.free_sequence(f)
+    assert kv_cache.allocator.num_free_blocks == kv_cache.num_blocks
+    print("All checks passed.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--block-size", type=int, default=4)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
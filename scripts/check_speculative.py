@@ -0,0 +1,85 @@
+"""
+CPU check that speculative decoding keeps the output of greedy decoding.
+
+Runs `generate` of tiny random LLaVA LLaMA and Mistral models with and without
+every drafter of `llava.model.speculative`, on prompts that repeat a passage (so
+that prompt lookup accepts draft tokens) and on random prompts, and with an end
+of sequence token that is generated halfway. Fails with an AssertionError on
+the first difference.
+
+Usage:
+    python scripts/check_speculative.py
+"""
+import argparse
+import random
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from llava.model.language_model.llava_llama import LlavaConfig, LlavaLlamaForCausalLM
+from llava.model.language_model.llava_mistral import LlavaMistralConfig, LlavaMistralForCausalLM
+from llava.model.speculative import DraftModelDrafter, PromptLookupDrafter
+
+
+CONFIG = dict(vocab_size=256, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+              num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=1024)
+
+
+def make_drafters(draft_model, num_draft_tokens):
+    return {
+        "prompt_lookup": PromptLookupDrafter(num_draft_tokens=num_draft_tokens),
+        "draft_model": DraftModelDrafter(draft_model, num_draft_tokens=num_draft_tokens),
+    }
+
+
+@torch.no_grad()
+def check_model(name, model, draft_model, prompts, args):
+    # no end of sequence at first, so that both decode max_new_tokens
+    model.generation_config.eos_token_id = None
+    for prompt_name, prompt in prompts.items():
+        input_ids = torch.tensor([prompt])
+        greedy = model.generate(input_ids, do_sample=False, max_new_tokens=args.max_new_tokens, use_cache=True)
+        # an end of sequence token that greedy decoding generates halfway
+        eos_token_id = int(greedy[0, args.max_new_tokens // 2])
+        greedy_eos = model.generate(input_ids, do_sample=False, max_new_tokens=args.max_new_tokens,
+                                    eos_token_id=eos_token_id, use_cache=True)
+        assert greedy_eos.shape[1] <= args.max_new_tokens // 2 + 1
+        for num_draft_tokens in (1, args.num_draft_tokens):
+            for drafter_name, drafter in make_drafters(draft_model, num_draft_tokens).items():
+                speculative = model.generate(input_ids, do_sample=False, max_new_tokens=args.max_new_tokens,
+                                             use_cache=True, drafter=drafter)
+                assert torch.equal(speculative, greedy), \
+                    f"{name}, {prompt_name} prompt, {drafter_name} drafter: {speculative.tolist()} != {greedy.tolist()}"
+                drafter = make_drafters(draft_model, num_draft_tokens)[drafter_name]
+                speculative_eos = model.generate(input_ids, do_sample=False, max_new_tokens=args.max_new_tokens,
+                                                 eos_token_id=eos_token_id, use_cache=True, drafter=drafter)
+                assert torch.equal(speculative_eos, greedy_eos), \
+                    f"{name}, {prompt_name} prompt, {drafter_name} drafter, with eos: {speculative_eos.tolist()} != {greedy_eos.tolist()}"
+                print(f"ok: {name}, {prompt_name} prompt, {drafter_name} drafter, {num_draft_tokens} draft tokens, "
+                      f"acceptance rate {drafter.stats['acceptance_rate']:.1%}")
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+    rng = random.Random(args.seed)
+    passage = [rng.randrange(3, CONFIG["vocab_size"]) for _ in range(24)]
+    prompts = {
+        "repeated": [1] + passage * 3,
+        "random": [1] + [rng.randrange(3, CONFIG["vocab_size"]) for _ in range(40)],
+    }
+    draft_model = LlamaForCausalLM(LlamaConfig(**dict(CONFIG, num_hidden_layers=1))).eval()
+    models = {
+        "llava_llama": LlavaLlamaForCausalLM(LlavaConfig(**CONFIG)).eval(),
+        "llava_mistral": LlavaMistralForCausalLM(LlavaMistralConfig(**CONFIG)).eval(),
+    }
+    for name, model in models.items():
+        check_model(name, model, draft_model, prompts, args)
+    print("All checks passed.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--num-draft-tokens", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
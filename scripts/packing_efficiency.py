@@ -0,0 +1,80 @@
+"""
+Padding efficiency of sequence packing on a training set.
+
+Tokenizes a random subset of the conversations as in training, counts
+`--num-image-tokens` image features per image, and reports the share of the
+batch slots filled with real tokens when every batch is padded to its longest
+sample, and when the samples of every batch are packed into rows of at most
+`--model-max-length` tokens (see llava/train/packing.py).
+
+Usage:
+    python scripts/packing_efficiency.py --model-path lmsys/vicuna-7b-v1.5 \
+        --data-path ./playground/data/llava_v1_5_mix665k.json --version v1
+"""
+import argparse
+import copy
+import json
+import random
+from types import SimpleNamespace
+
+import transformers
+
+from llava import conversation as conversation_lib
+from llava.constants import IMAGE_TOKEN_INDEX
+from llava.train.packing import pack_lengths
+from llava.train.train import preprocess, preprocess_multimodal
+
+
+def sample_lengths(args, tokenizer, samples):
+    data_args = SimpleNamespace(is_multimodal=True, mm_use_im_start_end=False)
+    lengths = []
+    for sample in samples:
+        sources = [copy.deepcopy(sample["conversations"])]
+        if 'image' in sample:
+            sources = preprocess_multimodal(sources, data_args)
+        input_ids = preprocess(sources, tokenizer, has_image='image' in sample)["input_ids"][0]
+        num_images = int((input_ids == IMAGE_TOKEN_INDEX).sum())
+        lengths.append(min(input_ids.shape[0], args.model_max_length) + num_images * (args.num_image_tokens - 1))
+    return lengths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--data-path", type=str, required=True)
+    parser.add_argument("--version", type=str, default="v1")
+    parser.add_argument("--model-max-length", type=int, default=2048)
+    parser.add_argument("--num-image-tokens", type=int, default=576)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--num-samples", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained(
+        args.model_path, model_max_length=args.model_max_length, padding_side="right", use_fast=False)
+    tokenizer.pad_token = tokenizer.unk_token
+    conversation_lib.default_conversation = conversation_lib.conv_templates.get(
+        args.version, conversation_lib.conv_templates["vicuna_v1"])
+
+    samples = json.load(open(args.data_path, "r"))
+    random.Random(args.seed).shuffle(samples)
+    lengths = [min(x, args.model_max_length) for x in sample_lengths(args, tokenizer, samples[:args.num_samples])]
+
+    num_tokens = padded_slots = packed_slots = num_rows = num_batches = 0
+    for start in range(0, len(lengths), args.batch_size):
+        batch = lengths[start:start + args.batch_size]
+        rows = pack_lengths(batch, args.model_max_length)
+        row_lengths = [sum(batch[i] for i in row) for row in rows]
+        num_tokens += sum(batch)
+        padded_slots += len(batch) * max(batch)
+        # the model adds one padding column to packed batches
+        packed_slots += len(rows) * (max(row_lengths) + 1)
+        num_rows += len(rows)
+        num_batches += 1
+
+    padded_efficiency = num_tokens / padded_slots
+    packed_efficiency = num_tokens / packed_slots
+    print(f"samples={len(lengths)} mean_length={num_tokens / len(lengths):.1f} batch_size={args.batch_size}")
+    print(f"padded: efficiency={padded_efficiency:.1%} slots={padded_slots}")
+    print(f"packed: efficiency={packed_efficiency:.1%} slots={packed_slots} rows_per_batch={num_rows / num_batches:.2f}")
+    print(f"gain: {padded_slots / packed_slots:.2f}x fewer slots")
@@ -0,0 +1,46 @@
+#!/bin/bash
+
+# Accuracy and throughput of POPE and CLEVR with every token reduction of REDUCTIONS.
+# Usage: bash scripts/v1_5/eval/token_reduction.sh [MODEL_PATH] [CLEVR_SPLIT]
+
+MODEL_PATH="${1:-liuhaotian/llava-v1.6-vicuna-7b}"
+SPLIT="${2:-valA}"
+REDUCTIONS="${REDUCTIONS:-none pool2 tome0.5 prune0.5 prune0.25}"
+MODEL_NAME=${MODEL_PATH##*/}
+
+POPE_DIR="./playground/data/eval/pope"
+CLEVR_DIR="./playground/data/eval/clevr_cogent"
+CLEVR_DATASET_DIR="./Dataset/CLEVR_CoGenT_v1.0"
+
+for REDUCTION in $REDUCTIONS; do
+    echo "=========================================="
+    echo "Token reduction: $REDUCTION"
+    echo "=========================================="
+
+    python -m llava.eval.model_vqa_loader \
+        --model-path $MODEL_PATH \
+        --question-file $POPE_DIR/llava_pope_test.jsonl \
+        --image-folder $POPE_DIR/val2014 \
+        --answers-file $POPE_DIR/answers/${MODEL_NAME}_${REDUCTION}.jsonl \
+        --token-reduction $REDUCTION \
+        --temperature 0 \
+        --conv-mode vicuna_v1
+
+    python llava/eval/eval_pope.py \
+        --annotation-dir $POPE_DIR/coco \
+        --question-file $POPE_DIR/llava_pope_test.jsonl \
+        --result-file $POPE_DIR/answers/${MODEL_NAME}_${REDUCTION}.jsonl
+
+    python -m llava.eval.model_vqa \
+        --model-path $MODEL_PATH \
+        --question-file $CLEVR_DIR/clevr_${SPLIT}_questions.jsonl \
+        --image-folder $CLEVR_DATASET_DIR/images/${SPLIT} \
+        --answers-file $CLEVR_DIR/answers/${MODEL_NAME}_${SPLIT}_${REDUCTION}.jsonl \
+        --token-reduction $REDUCTION \
+        --temperature 0 \
+        --conv-mode llava_v1
+
+    python llava/eval/eval_clevr.py \
+        --annotation-file $CLEVR_DATASET_DIR/questions/CLEVR_${SPLIT}_questions.json \
+        --result-file $CLEVR_DIR/answers/${MODEL_NAME}_${SPLIT}_${REDUCTION}.jsonl
+done